@@ -3,6 +3,7 @@
 This Python module defines the classes and functions used by the coding agent in the backend of an application. The coding agent is responsible for interacting with various components such as the database, memory management system, and external APIs to facilitate code generation, manipulation, and management tasks. It utilizes models for code generation, applies AST (Abstract Syntax Tree) operations to modify code, and manages the working context and system prompts for the user. Additionally, it handles the execution of generated code operations and integrates with external services like OpenAI and AWS for enhanced functionality.
 """
 
+import os
 import logging
 import re
 import json
@@ -129,6 +130,22 @@ class CodingAgent:
         else:
             self.tools = None
 
+    def set_model(self, model: str) -> bool:
+        """
+        Sets the model the agent sends to, and the tokenizer its memory and codebase count with.
+
+        Args:
+            model (str): The model name, e.g. "gpt-4-turbo" or "anthropic".
+
+        Returns:
+            bool: True if the codebase counts with another tokenizer from now on.
+        """
+        self.GPT_MODEL = model
+        self.memory_manager.set_model(model)
+        if self.codebase is None:
+            return False
+        return self.codebase.set_model(model)
+
     def query(
         self, input: str, command: Optional[str] = None, file: Optional[str] = None
     ) -> List[str]:
@@ -145,6 +162,11 @@ class CodingAgent:
         # if file is None:
         # input = f"Original Question: {input}\n\nEnhanced Question: {self.rewrite_input(input)}"
         # logging.warning(f"Re-written Query: {input}")
+        prompt_handler = self.memory_manager.prompt_handler
+        if prompt_handler.excerpt is not None and prompt_handler.files_in_prompt:
+            # Large files in the prompt are cut down to the chunks relevant to this message
+            prompt_handler.query = input
+            prompt_handler.set_files_in_prompt()
         self.memory_manager.add_message("user", input)
 
         message_history = [
@@ -268,6 +290,7 @@ class CodingAgent:
                 )
 
             op.file_name = self.normalize_path(op.file_name)
+            op.file_name = self.resolve_op_file(op)
 
             # Read the existing code from the file
             try:
@@ -303,6 +326,14 @@ class CodingAgent:
 
             # self.ops_to_execute = [op for op in self.ops_to_execute if op != op]
 
+        if diffs and self.memory_manager is not None:
+            # The cached diff from main predates these writes, the next prompt must show them
+            prompt_handler = self.memory_manager.prompt_handler
+            directory = prompt_handler.get_directory()
+            if directory:
+                prompt_handler.diff_cache.notify_changed(directory, wait=True)
+            prompt_handler.set_system()
+
         return diffs
 
     def process_json(self, args: str) -> str:
@@ -477,6 +508,42 @@ class CodingAgent:
             # The input path is not a subpath of the working directory
             return str(resolved_input_path)
 
+    def resolve_op_file(self, op) -> str:
+        """
+        Finds the file an operation targets when its file_name does not exist.
+
+        The model often guesses file names. When the guess is wrong, the symbol the
+        operation refers to is looked up in the codebase's symbols table, and the file
+        defining it is used if exactly one file does. New functions and classes have no
+        definition to look up, so their file_name is kept as is.
+
+        Args:
+            op: The operation about to be executed.
+
+        Returns:
+            str: The path of the file to modify.
+        """
+        if self.codebase is None or os.path.exists(op.file_name):
+            return op.file_name
+        op_type = type(op).__name__
+        class_name = getattr(op, "class_name", None)
+        method_name = getattr(op, "method_name", None)
+        function_name = getattr(op, "function_name", None)
+        if method_name and not op_type.startswith("Add"):
+            matches = self.codebase.find_symbol(method_name, "method", class_name)
+        elif class_name and (method_name or not op_type.startswith("Add")):
+            matches = self.codebase.find_symbol(class_name, "class")
+        elif function_name and not op_type.startswith("Add"):
+            matches = self.codebase.find_symbol(function_name, "function")
+        else:
+            return op.file_name
+        file_paths = {match["file_path"] for match in matches}
+        if len(file_paths) != 1:
+            return op.file_name
+        file_path = self.normalize_path(file_paths.pop())
+        print(f"Resolved {op.file_name} to {file_path} from the symbol index")
+        return file_path
+
     def rewrite_input(self, input: str) -> str:
         """
         Rewrites the input to include the system prompt and context.
@@ -1,6 +1,5 @@
 # app_setup.py
 import os
-import sqlite3
 import sys
 from agent.coding_agent import CodingAgent
 from agent.agent_prompts import (
@@ -11,7 +10,10 @@ from agent.agent_prompts import (
 )
 from agent.agent_functions.file_ops import _OP_LIST
 from memory.memory_manager import MemoryManager
+from memory.summarizer import OpenAISummarizer, TruncatingSummarizer
+from memory.retention import RetentionPolicy, enable_incremental_vacuum
 from database.my_codebase import MyCodebase
+from database.connection import ConnectionManager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from typing import Any, Callable
@@ -83,11 +85,19 @@ sys.stderr = StreamToLogger(logger, logging.ERROR)
 
 IGNORE_DIRS = ["node_modules", ".next", ".venv", "__pycache__", ".git"]
 FILE_EXTENSIONS = [".js", ".py", ".md", "Dockerfile", ".txt", ".ts", ".yaml"]
+# Read connections handed out by the connection manager, writes share a single one
+DB_READERS = int(os.getenv("DB_READERS", 8))
+# Messages are inserted in batches by a background writer, and flushed on shutdown
+MEMORY_WRITE_BEHIND = os.getenv("MEMORY_WRITE_BEHIND", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
 
 
-def create_database_connection() -> sqlite3.Connection:
+def create_database_connection() -> ConnectionManager:
     try:
-        conn = sqlite3.connect("database.db", check_same_thread=False)
+        conn = ConnectionManager("database.db", pool_size=DB_READERS)
         logger.info("Successfully connected to database")
         return conn
     except Exception as e:
@@ -97,6 +107,34 @@ def create_database_connection() -> sqlite3.Connection:
 
 DB_CONNECTION = create_database_connection()
 DIRECTORY = os.getenv("PROJECT_DIRECTORY", ".")
+INDEX_WORKERS = int(os.getenv("INDEX_WORKERS", 0)) or None
+WATCH_FILES = os.getenv("WATCH_FILES", "").lower() in ("1", "true", "yes")
+# Summarizes long messages in the background: "none" (default), "truncate" (local) or "openai"
+SUMMARIZER = os.getenv("SUMMARIZER", "none").lower()
+# Messages with more tokens than this are summarized, into summaries of at most SUMMARY_TOKENS
+SUMMARY_THRESHOLD_TOKENS = int(os.getenv("SUMMARY_THRESHOLD_TOKENS", 500))
+SUMMARY_TOKENS = int(os.getenv("SUMMARY_TOKENS", 200))
+# Turns that leave the message window are folded into session, day and project digests of
+# at most DIGEST_TOKENS each, sent at the head of the context. Off by default, the digests
+# take up to half of the message window.
+COMPACT_HISTORY = os.getenv("COMPACT_HISTORY", "false").lower() in ("1", "true", "yes")
+DIGEST_TOKENS = int(os.getenv("DIGEST_TOKENS", 150))
+# Messages older than MEMORY_RETENTION_DAYS, and the oldest ones once the memory table
+# holds more than MEMORY_MAX_MB, are archived to compressed segments in MEMORY_ARCHIVE_DIR
+MEMORY_RETENTION_DAYS = float(os.getenv("MEMORY_RETENTION_DAYS", 0)) or None
+MEMORY_MAX_MB = float(os.getenv("MEMORY_MAX_MB", 0)) or None
+MEMORY_ARCHIVE_DIR = os.getenv("MEMORY_ARCHIVE_DIR", "memory_archive")
+# Directories are collapsed once the tree in the system prompt would exceed this many tokens,
+# e.g. TREE_TOKEN_BUDGET=4000 for large repositories. Unset or 0 (default) sends the full tree.
+TREE_TOKEN_BUDGET = int(os.getenv("TREE_TOKEN_BUDGET", 0)) or None
+# Files in the prompt with more tokens than this are cut down to the chunks that best match
+# the user's message. Unset or 0 (default) sends them whole.
+FILE_TOKEN_BUDGET = int(os.getenv("FILE_TOKEN_BUDGET", 0)) or None
+# "numpy" (brute force, default) or "hnsw" (requires hnswlib)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND")
+# Codec for file bodies stored in the database: "none" (default), "zlib" or "zstd" (requires
+# zstandard). The full-text index keeps its own uncompressed copy of every file either way.
+FILE_COMPRESSION = os.getenv("FILE_COMPRESSION", "none").lower()
 
 app = FastAPI()
 app.add_middleware(
@@ -118,7 +156,9 @@ class FunctionCall(BaseModel):
 
 
 def setup_memory_manager(**kwargs) -> MemoryManager:
-    memory_manager = MemoryManager(db_connection=DB_CONNECTION, **kwargs)
+    memory_manager = MemoryManager(
+        db_connection=DB_CONNECTION, write_behind=MEMORY_WRITE_BEHIND, **kwargs
+    )
     return memory_manager
 
 
@@ -128,6 +168,10 @@ def setup_codebase() -> MyCodebase:
         db_connection=DB_CONNECTION,
         file_extensions=FILE_EXTENSIONS,
         ignore_dirs=IGNORE_DIRS,
+        max_workers=INDEX_WORKERS,
+        tree_token_budget=TREE_TOKEN_BUDGET,
+        embedding_backend=EMBEDDING_BACKEND,
+        compression=None if FILE_COMPRESSION == "none" else FILE_COMPRESSION,
     )
 
     my_codebase.ignore_dirs = IGNORE_DIRS
@@ -136,12 +180,48 @@ def setup_codebase() -> MyCodebase:
 
 def setup_app() -> CodingAgent:
     print("Setting up app")
+    if MEMORY_RETENTION_DAYS or MEMORY_MAX_MB:
+        # Rebuilds a database created without incremental vacuum once, before it is shared
+        enable_incremental_vacuum(DB_CONNECTION)
     codebase = setup_codebase()
     memory = setup_memory_manager(
         tree=codebase.tree(),
         identity=DEFAULT_SYSTEM_PROMPT_V2,
     )
+    if FILE_TOKEN_BUDGET:
+        memory.prompt_handler.excerpt = codebase.excerpt
+        memory.prompt_handler.file_token_budget = FILE_TOKEN_BUDGET
     agent = CodingAgent(
         memory_manager=memory, function_map=[_OP_LIST], codebase=codebase
     )
+
+    def refresh_prompt_context(changed_paths):
+        # Files changed on disk, keep the tree and file contents in the prompt current
+        memory.prompt_handler.diff_cache.notify_changed(codebase.directory)
+        memory.prompt_handler.tree = codebase.tree()
+        memory.prompt_handler.set_files_in_prompt()
+
+    codebase.add_listener(refresh_prompt_context)
+    if SUMMARIZER == "truncate":
+        memory.start_summarizer(
+            TruncatingSummarizer(SUMMARY_TOKENS, memory.tokenizer),
+            threshold_tokens=SUMMARY_THRESHOLD_TOKENS,
+        )
+    elif SUMMARIZER == "openai":
+        memory.start_summarizer(
+            OpenAISummarizer(max_tokens=SUMMARY_TOKENS),
+            threshold_tokens=SUMMARY_THRESHOLD_TOKENS,
+        )
+    if COMPACT_HISTORY:
+        memory.enable_compaction(digest_tokens=DIGEST_TOKENS)
+    if MEMORY_RETENTION_DAYS or MEMORY_MAX_MB:
+        memory.start_retention(
+            RetentionPolicy(
+                max_age_days=MEMORY_RETENTION_DAYS,
+                max_bytes=int(MEMORY_MAX_MB * 1024 * 1024) if MEMORY_MAX_MB else None,
+            ),
+            MEMORY_ARCHIVE_DIR,
+        )
+    if WATCH_FILES:
+        codebase.start_watcher()
     return agent, codebase
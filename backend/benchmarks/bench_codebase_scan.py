@@ -0,0 +1,98 @@
+"""
+Benchmark for MyCodebase directory scans.
+
+Creates synthetic trees of increasing size and times a cold scan (every file is new), a
+warm rescan (nothing changed) and a rescan after deleting 1% of the files. Per-file times
+should stay roughly flat as the tree grows, i.e. scan time grows linearly with file count.
+It also times a full-text search for one module's unique function name, which should take
+milliseconds at any size.
+
+Run from the backend directory:
+    python -m benchmarks.bench_codebase_scan --sizes 1000 10000 100000
+"""
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from database.my_codebase import MyCodebase
+
+FILES_PER_DIRECTORY = 100
+FILE_BODY = "def function_{i}():\n    return {i}\n"
+
+
+def make_tree(root: str, file_count: int) -> None:
+    for i in range(file_count):
+        directory = os.path.join(root, f"pkg{i // FILES_PER_DIRECTORY}")
+        if i % FILES_PER_DIRECTORY == 0:
+            os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"module{i}.py"), "w") as file:
+            file.write(FILE_BODY.format(i=i))
+
+
+def timed(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def run(file_count: int) -> dict:
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, file_count)
+        conn = sqlite3.connect(os.path.join(root, "bench.db"), check_same_thread=False)
+        codebase = None
+
+        def cold():
+            nonlocal codebase
+            codebase = MyCodebase(
+                root,
+                db_connection=conn,
+                ignore_dirs=[],
+                file_extensions=[".py"],
+            )
+
+        cold_time = timed(cold)
+        warm_time = timed(codebase._update_files_and_embeddings)
+
+        for i in range(0, file_count, 100):
+            os.remove(
+                os.path.join(root, f"pkg{i // FILES_PER_DIRECTORY}", f"module{i}.py")
+            )
+        delete_time = timed(codebase._update_files_and_embeddings)
+        search_time = timed(lambda: codebase.search(f"function_{file_count - 1}", 10))
+        remaining = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        conn.close()
+
+    assert remaining == file_count - len(range(0, file_count, 100))
+    return {
+        "cold": cold_time,
+        "warm": warm_time,
+        "delete": delete_time,
+        "search": search_time,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000]
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'files':>8} {'cold s':>8} {'warm s':>8} {'delete s':>9} {'warm us/file':>13} "
+        f"{'search ms':>10}"
+    )
+    for file_count in args.sizes:
+        result = run(file_count)
+        print(
+            f"{file_count:>8} {result['cold']:>8.2f} {result['warm']:>8.2f} "
+            f"{result['delete']:>9.2f} {result['warm'] / file_count * 1e6:>13.1f} "
+            f"{result['search'] * 1e3:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
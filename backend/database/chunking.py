@@ -0,0 +1,151 @@
+"""
+This module splits file contents into chunks for the chunks table maintained by MyCodebase. Python files are chunked along function and class boundaries taken from the ast module, with large classes split into their methods; other files, and Python files that do not parse, are cut into fixed windows of lines. ``parse_python`` parses a file once for both ``chunk_file`` and ``extract_symbols``. Chunks cover the whole file without overlap so that any span of the file can be rebuilt from them.
+"""
+
+import ast
+import io
+from typing import List, NamedTuple, Optional
+
+WINDOW_LINES = 80
+
+
+class Chunk(NamedTuple):
+    """A span of a file. Line numbers are 1-based and inclusive."""
+
+    start_line: int
+    end_line: int
+    kind: str
+    name: Optional[str]
+    text: str
+
+
+def split_lines(text: str) -> List[str]:
+    """
+    Splits a text into lines, keeping their endings.
+
+    Unlike ``str.splitlines``, only ``\\n``, ``\\r\\n`` and ``\\r`` end a line, the line
+    endings ``ast`` counts, so chunk line numbers match the parsed definitions.
+
+    Args:
+        text (str): The text to split.
+
+    Returns:
+        List[str]: The lines, joining them gives back the text.
+    """
+    return io.StringIO(text, newline="").readlines()
+
+
+def parse_python(file_path: str, text: str) -> Optional[ast.Module]:
+    """
+    Parses a Python file.
+
+    Args:
+        file_path (str): The path of the file, only ``.py`` files are parsed.
+        text (str): The contents of the file.
+
+    Returns:
+        Optional[ast.Module]: The module, an empty one if the file does not parse, or None
+            for other files.
+    """
+    if not file_path.endswith(".py"):
+        return None
+    try:
+        return ast.parse(text)
+    except (SyntaxError, ValueError):
+        return ast.Module(body=[], type_ignores=[])
+
+
+def chunk_file(
+    file_path: str,
+    text: str,
+    window_lines: int = WINDOW_LINES,
+    tree: Optional[ast.Module] = None,
+) -> List[Chunk]:
+    """
+    Splits a file into chunks.
+
+    Args:
+        file_path (str): The path of the file, used to pick the chunking strategy.
+        text (str): The contents of the file.
+        window_lines (int): The maximum number of lines in a chunk that is not a definition.
+        tree (Optional[ast.Module]): The file as returned by ``parse_python``, parsed here if not given.
+
+    Returns:
+        List[Chunk]: The chunks in file order.
+    """
+    lines = split_lines(text)
+    if not lines:
+        return []
+    if file_path.endswith(".py"):
+        if tree is None:
+            tree = parse_python(file_path, text)
+        # A file that does not parse has an empty body and is cut into windows
+        return _chunk_python(tree.body, lines, 1, len(lines), window_lines)
+    return _chunk_lines(lines, 1, len(lines), window_lines)
+
+
+def _chunk_lines(
+    lines: List[str], start: int, end: int, window_lines: int, kind: str = "lines"
+) -> List[Chunk]:
+    chunks = []
+    for window_start in range(start, end + 1, window_lines):
+        window_end = min(window_start + window_lines - 1, end)
+        body = "".join(lines[window_start - 1 : window_end])
+        if body.strip():
+            chunks.append(Chunk(window_start, window_end, kind, None, body))
+    return chunks
+
+
+def _definition_start(node: ast.AST) -> int:
+    decorators = getattr(node, "decorator_list", [])
+    return min([node.lineno] + [decorator.lineno for decorator in decorators])
+
+
+def _chunk_python(
+    body: List[ast.stmt],
+    lines: List[str],
+    start: int,
+    end: int,
+    window_lines: int,
+    parent: Optional[str] = None,
+) -> List[Chunk]:
+    """
+    Chunks the statements of a module or class body between two lines.
+
+    Functions and classes become chunks of their own. A class longer than two windows is
+    split into its methods, with the lines between them grouped like module code.
+    """
+    chunks = []
+    cursor = start
+    for node in body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+        node_start, node_end = _definition_start(node), node.end_lineno
+        if node_start > cursor:
+            chunks.extend(_chunk_lines(lines, cursor, node_start - 1, window_lines))
+        name = f"{parent}.{node.name}" if parent else node.name
+        if isinstance(node, ast.ClassDef):
+            if node_end - node_start + 1 > 2 * window_lines:
+                chunks.extend(
+                    _chunk_python(
+                        node.body, lines, node_start, node_end, window_lines, name
+                    )
+                )
+                cursor = node_end + 1
+                continue
+            kind = "class"
+        else:
+            kind = "method" if parent else "function"
+        chunks.append(
+            Chunk(
+                node_start,
+                node_end,
+                kind,
+                name,
+                "".join(lines[node_start - 1 : node_end]),
+            )
+        )
+        cursor = node_end + 1
+    if cursor <= end:
+        chunks.extend(_chunk_lines(lines, cursor, end, window_lines))
+    return chunks
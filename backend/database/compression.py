@@ -0,0 +1,185 @@
+"""
+This module compresses the file bodies stored in the file_blobs table by MyCodebase. Each row records the codec it was written with, so compressed and plain rows can coexist and the codec can be changed without re-indexing. zlib is always available and zstd is used when the zstandard package is installed. Both can use a shared dictionary trained on the project's own files, which matters for source code because most files are too small to compress well on their own.
+"""
+
+import zlib
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Union
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, zlib is always available
+    zstandard = None
+
+CODECS = ("zlib", "zstd")
+# zlib can only look back 32KB, so larger preset dictionaries are wasted
+DICTIONARY_SIZE = 32 * 1024
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+# Keeps IN (...) lists under SQLite's default limit on bound parameters
+QUERY_BATCH_SIZE = 500
+
+
+def check_codec(codec: Optional[str]) -> None:
+    """Raises if a codec is unknown or its library is not installed."""
+    if codec is None:
+        return
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec: {codec}")
+    if codec == "zstd" and zstandard is None:
+        raise ImportError("zstandard is required for zstd compression")
+
+
+def compress_text(
+    text: str, codec: Optional[str], dictionary: Optional[bytes] = None
+) -> Union[str, bytes]:
+    """
+    Compresses a file body for storage.
+
+    Args:
+        text (str): The contents of the file.
+        codec (Optional[str]): "zlib", "zstd" or None to store the text as is.
+        dictionary (Optional[bytes]): A dictionary from ``train_dictionary`` for this codec.
+
+    Returns:
+        Union[str, bytes]: The compressed bytes, or the text itself when codec is None.
+    """
+    if codec is None:
+        return text
+    data = text.encode("utf-8")
+    if codec == "zlib":
+        if dictionary:
+            compressor = zlib.compressobj(ZLIB_LEVEL, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(ZLIB_LEVEL)
+        return compressor.compress(data) + compressor.flush()
+    check_codec(codec)
+    return _zstd_compressor(dictionary).compress(data)
+
+
+def decompress_text(
+    value: Union[str, bytes, None],
+    codec: Optional[str],
+    dictionary: Optional[bytes] = None,
+) -> Optional[str]:
+    """
+    Restores a file body written by ``compress_text``.
+
+    Args:
+        value (Union[str, bytes, None]): The stored value.
+        codec (Optional[str]): The codec the value was written with.
+        dictionary (Optional[bytes]): The dictionary the value was written with, if any.
+
+    Returns:
+        Optional[str]: The contents of the file.
+    """
+    if value is None or codec is None:
+        return value
+    if codec == "zlib":
+        if dictionary:
+            decompressor = zlib.decompressobj(zdict=dictionary)
+        else:
+            decompressor = zlib.decompressobj()
+        data = decompressor.decompress(value) + decompressor.flush()
+    else:
+        check_codec(codec)
+        data = _zstd_decompressor(dictionary).decompress(value)
+    return data.decode("utf-8")
+
+
+def read_file_texts(cursor, file_paths: Iterable[str]) -> Dict[str, str]:
+    """
+    Reads and decompresses the stored contents of some files.
+
+    Only the requested rows are read, so the bodies of other files are never loaded or
+    decompressed.
+
+    Args:
+        cursor: A cursor on the database holding the files table.
+        file_paths (Iterable[str]): The paths of the files as stored in the files table.
+
+    Returns:
+        Dict[str, str]: The contents of the files that are indexed, keyed by path.
+    """
+    file_paths = list(dict.fromkeys(file_paths))
+    texts = {}
+    for start in range(0, len(file_paths), QUERY_BATCH_SIZE):
+        batch = file_paths[start : start + QUERY_BATCH_SIZE]
+        cursor.execute(
+            f"""
+            SELECT f.file_path, b.text, b.codec, d.data
+            FROM files f JOIN file_blobs b ON b.content_hash = f.content_hash
+            LEFT JOIN compression_dicts d ON d.dict_id = b.dict_id
+            WHERE f.file_path IN ({", ".join("?" for _ in batch)})
+            """,
+            batch,
+        )
+        for file_path, value, codec, dictionary in cursor.fetchall():
+            texts[file_path] = decompress_text(value, codec, dictionary)
+    return texts
+
+
+def train_dictionary(
+    samples: Iterable[str], codec: str, size: int = DICTIONARY_SIZE
+) -> bytes:
+    """
+    Builds a shared dictionary from sample file bodies.
+
+    zstd trains its own dictionary. zlib has no trainer, so its dictionary is made of the
+    lines that recur across the samples (imports, license headers, common idioms), with
+    the most frequent lines last where zlib finds them cheapest.
+
+    Args:
+        samples (Iterable[str]): Contents of representative files.
+        codec (str): The codec the dictionary is for.
+        size (int): The maximum size of the dictionary in bytes.
+
+    Returns:
+        bytes: The dictionary, empty if the samples were not enough to build one.
+    """
+    samples = list(samples)
+    check_codec(codec)
+    if codec == "zstd":
+        try:
+            return zstandard.train_dictionary(
+                size, [sample.encode("utf-8") for sample in samples]
+            ).as_bytes()
+        except zstandard.ZstdError:
+            return b""
+    counts = Counter(
+        line
+        for sample in samples
+        for line in set(sample.splitlines(keepends=True))
+        if len(line.strip()) > 3
+    )
+    lines, used = [], 0
+    for line, count in counts.most_common():
+        if count < 2:
+            break
+        encoded = line.encode("utf-8")
+        if used + len(encoded) > size:
+            break
+        lines.append(encoded)
+        used += len(encoded)
+    return b"".join(reversed(lines))
+
+
+def _zstd_compressor(dictionary: Optional[bytes]):
+    # zstandard compressors are not thread safe, so one is made per call
+    if dictionary:
+        return zstandard.ZstdCompressor(
+            level=ZSTD_LEVEL, dict_data=_zstd_dictionary(dictionary)
+        )
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+
+
+def _zstd_decompressor(dictionary: Optional[bytes]):
+    if dictionary:
+        return zstandard.ZstdDecompressor(dict_data=_zstd_dictionary(dictionary))
+    return zstandard.ZstdDecompressor()
+
+
+@lru_cache(maxsize=8)
+def _zstd_dictionary(dictionary: bytes):
+    return zstandard.ZstdCompressionDict(dictionary)
@@ -0,0 +1,236 @@
+"""
+This module provides the ConnectionManager, which owns the SQLite connections shared by MyCodebase, MemoryManager, SystemPromptHandler and the API endpoints. The database is opened in WAL mode so readers never wait for a writer: every write goes through a single connection serialized by the manager's lock, while reads borrow a connection of their own from a small pool and see the last committed state. The manager can be passed wherever a sqlite3 connection is expected, in which case cursor() and commit() act on the writer. The async API runs the components' blocking methods on the manager's threads through ``run_blocking``, reads on a pool as large as the reader pool and writes on a single thread, so the event loop never waits on SQLite.
+"""
+
+import asyncio
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Iterator, List, Optional
+
+# Memory-mapped reads and page cache per connection, in bytes
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE = 64 * 1024 * 1024
+# How long a connection waits on a lock held by another process before failing
+BUSY_TIMEOUT_MS = 5000
+
+
+class ConnectionManager:
+    """
+    A serialized writer and a pool of read connections on one SQLite database.
+
+    Attributes:
+        path (str): The database file.
+        lock (threading.RLock): Held for the whole of every write transaction.
+        writer (sqlite3.Connection): The only connection that writes.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        pool_size: int = 8,
+        mmap_size: int = MMAP_SIZE,
+        cache_size: int = CACHE_SIZE,
+    ):
+        """
+        Opens the writer and switches the database to WAL mode.
+
+        Args:
+            path (str): The database file. ":memory:" works but has no separate readers.
+            pool_size (int): The maximum number of read connections open at once.
+            mmap_size (int): Bytes of the database file memory-mapped by each connection.
+            cache_size (int): Bytes of page cache per connection.
+        """
+        self.path = path
+        self.pool_size = pool_size
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.lock = threading.RLock()
+        self.writer = self._connect()
+        # Lets the memory retention return freed pages a few at a time; only takes effect
+        # on a new database, existing ones are switched by the retention's first VACUUM
+        self.writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        journal_mode = self.writer.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        # An in-memory database has no file for other connections to open
+        self.has_readers = journal_mode.lower() == "wal"
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._readers: List[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        self._executors = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path, check_same_thread=False, timeout=BUSY_TIMEOUT_MS / 1000
+        )
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        # A negative cache_size is in KiB rather than pages
+        conn.execute(f"PRAGMA cache_size={-int(self.cache_size // 1024)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    @contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        """
+        Borrows a read connection for the duration of a block.
+
+        Falls back to the writer, under the lock, when the database has no separate
+        readers. Results must be fetched before the block ends.
+
+        Yields:
+            sqlite3.Connection: A connection that only reads.
+        """
+        if not self.has_readers:
+            with self.lock:
+                yield self.writer
+            return
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    def _acquire_reader(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._readers_lock:
+            if len(self._readers) < self.pool_size:
+                conn = self._connect()
+                conn.execute("PRAGMA query_only=ON")
+                self._readers.append(conn)
+                return conn
+        return self._idle.get()
+
+    @contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        """
+        Runs a block as one write transaction on the writer.
+
+        The transaction is committed when the block ends and rolled back if it raises.
+
+        Yields:
+            sqlite3.Connection: The writer.
+        """
+        with self.lock:
+            try:
+                yield self.writer
+                self.writer.commit()
+            except Exception:
+                self.writer.rollback()
+                raise
+
+    def executor(self, kind: Optional[str]) -> Optional[Executor]:
+        """
+        Returns the threads that run blocking calls of a kind for ``run_blocking``.
+
+        Args:
+            kind (Optional[str]): "read" for the reader pool, "write" for the single writer
+                thread, or None for long jobs such as scans, which run on the event loop's
+                default executor so they do not hold up short writes.
+
+        Returns:
+            Optional[Executor]: The executor, None for the default one.
+        """
+        if kind is None:
+            return None
+        with self._readers_lock:
+            if kind not in self._executors:
+                self._executors[kind] = ThreadPoolExecutor(
+                    max_workers=self.pool_size if kind == "read" else 1,
+                    thread_name_prefix=f"db-{kind}",
+                )
+            return self._executors[kind]
+
+    def cursor(self) -> sqlite3.Cursor:
+        """Returns a cursor on the writer. Writes through it must hold ``lock``."""
+        return self.writer.cursor()
+
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        return self.writer.execute(sql, parameters)
+
+    def commit(self) -> None:
+        self.writer.commit()
+
+    def rollback(self) -> None:
+        self.writer.rollback()
+
+    def create_function(self, name: str, narg: int, func: Callable) -> None:
+        """Registers an SQL function on the writer, for writes that compute values in Python."""
+        self.writer.create_function(name, narg, func)
+
+    def close(self) -> None:
+        """Closes every connection, folding the write-ahead log back into the database."""
+        with self._readers_lock:
+            executors, self._executors = self._executors, {}
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+            self._idle = queue.LifoQueue()
+        with self.lock:
+            self.writer.close()
+
+
+def write_lock(db_connection, default=None) -> threading.RLock:
+    """
+    Returns the lock that serializes writes on a connection.
+
+    Components sharing a ConnectionManager share its lock. Any other connection gets
+    ``default``, or a new lock, as before the manager existed.
+    """
+    if isinstance(db_connection, ConnectionManager):
+        return db_connection.lock
+    return default if default is not None else threading.RLock()
+
+
+@contextmanager
+def read_cursor(db_connection, lock, cursor) -> Iterator[sqlite3.Cursor]:
+    """
+    Yields a cursor for a read that must not wait behind a write.
+
+    Args:
+        db_connection: The component's connection, a ConnectionManager or a plain connection.
+        lock: The component's write lock, held when there is no separate reader.
+        cursor: The component's own cursor, used when there is no separate reader.
+
+    Yields:
+        sqlite3.Cursor: A cursor on a read connection, or the given cursor under the lock.
+    """
+    if isinstance(db_connection, ConnectionManager) and db_connection.has_readers:
+        with db_connection.read() as conn:
+            yield conn.cursor()
+    else:
+        with lock:
+            yield cursor
+
+
+async def run_blocking(
+    db_connection, func: Callable, *args, kind: Optional[str] = "read", **kwargs
+) -> Any:
+    """
+    Runs a blocking method of a component off the event loop and awaits its result.
+
+    Args:
+        db_connection: The component's connection. Plain connections use the loop's default executor.
+        func (Callable): The blocking function.
+        *args: Positional arguments for ``func``.
+        kind (Optional[str]): "read", "write" or None, see ``ConnectionManager.executor``.
+        **kwargs: Keyword arguments for ``func``.
+
+    Returns:
+        Any: What ``func`` returned.
+    """
+    executor = None
+    if isinstance(db_connection, ConnectionManager):
+        executor = db_connection.executor(kind)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
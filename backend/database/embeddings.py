@@ -0,0 +1,203 @@
+"""
+This module provides the embedding stage used by MyCodebase to fill the embedding column of the file_blobs table and answer "which files are relevant to this query" lookups. The default HashingEmbedder is deterministic and runs fully offline by hashing word and character n-grams into a fixed number of buckets. Vectors are stored as packed float32 blobs and searched with a NumPy brute-force cosine index, with an optional HNSW backend when hnswlib is installed.
+"""
+
+import re
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:  # hnswlib is optional, the NumPy index is always available
+    hnswlib = None
+
+WORD_PATTERN = re.compile(r"[A-Z]+(?![a-z])|[A-Za-z][a-z0-9]*|\d+")
+
+
+def pack_vector(vector: np.ndarray) -> bytes:
+    """Packs a vector into the float32 blob stored in the embedding column."""
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def unpack_vector(blob: bytes) -> np.ndarray:
+    """Unpacks a float32 blob from the embedding column."""
+    return np.frombuffer(blob, dtype=np.float32)
+
+
+class HashingEmbedder:
+    """
+    Embeds text by hashing word unigrams, word bigrams and character n-grams into buckets.
+
+    Identifiers are split on case and underscores so ``get_file_contents`` and
+    ``getFileContents`` share features. The result is L2-normalized, so a dot product
+    between two vectors is their cosine similarity.
+
+    Attributes:
+        dimensions (int): The length of the produced vectors.
+        char_ngram (int): The length of the character n-grams taken from each word.
+    """
+
+    def __init__(self, dimensions: int = 256, char_ngram: int = 3):
+        self.dimensions = dimensions
+        self.char_ngram = char_ngram
+
+    def _features(self, text: str) -> List[str]:
+        words = [word.lower() for word in WORD_PATTERN.findall(text)]
+        features = list(words)
+        features.extend(f"{a} {b}" for a, b in zip(words, words[1:]))
+        n = self.char_ngram
+        for word in words:
+            padded = f"<{word}>"
+            features.extend(padded[i : i + n] for i in range(len(padded) - n + 1))
+        return features
+
+    def embed(self, text: str) -> np.ndarray:
+        """
+        Embeds a single text.
+
+        Args:
+            text (str): The text to embed.
+
+        Returns:
+            np.ndarray: A normalized float32 vector of length ``dimensions``.
+        """
+        buckets = np.array(
+            [
+                zlib.crc32(feature.encode("utf-8")) % self.dimensions
+                for feature in self._features(text)
+            ],
+            dtype=np.int64,
+        )
+        vector = np.bincount(buckets, minlength=self.dimensions).astype(np.float32)
+        # Damp very frequent features so long files are not dominated by boilerplate
+        np.log1p(vector, out=vector)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed_many(self, texts: Iterable[str]) -> np.ndarray:
+        """Embeds several texts, returning one row per text."""
+        return np.vstack([self.embed(text) for text in texts])
+
+
+class VectorIndex:
+    """
+    Brute-force cosine index over normalized vectors held in one NumPy matrix.
+
+    The matrix is rebuilt lazily on the first search after vectors were added or removed.
+    """
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+        self._vectors: Dict[str, np.ndarray] = {}
+        self._paths: List[str] = []
+        self._matrix = np.zeros((0, dimensions), dtype=np.float32)
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self._vectors)
+
+    def add(self, key: str, vector: np.ndarray) -> None:
+        self._vectors[key] = np.asarray(vector, dtype=np.float32)
+        self._dirty = True
+
+    def remove(self, key: str) -> None:
+        if self._vectors.pop(key, None) is not None:
+            self._dirty = True
+
+    def search(self, query: np.ndarray, k: int = 10) -> List[Tuple[str, float]]:
+        """
+        Finds the keys whose vectors are most similar to the query.
+
+        Args:
+            query (np.ndarray): A normalized query vector.
+            k (int): The number of results to return.
+
+        Returns:
+            List[Tuple[str, float]]: (key, cosine similarity) pairs, most similar first.
+        """
+        if self._dirty:
+            self._paths = list(self._vectors)
+            self._matrix = (
+                np.vstack([self._vectors[key] for key in self._paths])
+                if self._paths
+                else np.zeros((0, self.dimensions), dtype=np.float32)
+            )
+            self._dirty = False
+        if not self._paths or k <= 0:
+            return []
+        scores = self._matrix @ np.asarray(query, dtype=np.float32)
+        k = min(k, len(self._paths))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self._paths[i], float(scores[i])) for i in top]
+
+
+class HnswVectorIndex:
+    """
+    Approximate cosine index backed by hnswlib, with the same interface as VectorIndex.
+    """
+
+    def __init__(self, dimensions: int, max_elements: int = 1024):
+        if hnswlib is None:
+            raise ImportError("hnswlib is required for the hnsw embedding index")
+        self.dimensions = dimensions
+        self._index = hnswlib.Index(space="cosine", dim=dimensions)
+        self._index.init_index(max_elements=max_elements, allow_replace_deleted=True)
+        self._labels: Dict[str, int] = {}
+        self._keys: Dict[int, str] = {}
+        self._next_label = 0
+
+    def __len__(self) -> int:
+        return len(self._labels)
+
+    def add(self, key: str, vector: np.ndarray) -> None:
+        label = self._labels.get(key)
+        if label is None:
+            label = self._next_label
+            self._next_label += 1
+        if self._index.get_current_count() >= self._index.get_max_elements():
+            self._index.resize_index(self._index.get_max_elements() * 2)
+        self._index.add_items(
+            np.asarray([vector], dtype=np.float32), [label], replace_deleted=True
+        )
+        self._labels[key] = label
+        self._keys[label] = key
+
+    def remove(self, key: str) -> None:
+        label = self._labels.pop(key, None)
+        if label is not None:
+            self._index.mark_deleted(label)
+            del self._keys[label]
+
+    def search(self, query: np.ndarray, k: int = 10) -> List[Tuple[str, float]]:
+        k = min(k, len(self._labels))
+        if k <= 0:
+            return []
+        self._index.set_ef(max(50, k))
+        labels, distances = self._index.knn_query(
+            np.asarray([query], dtype=np.float32), k=k
+        )
+        return [
+            (self._keys[label], 1.0 - float(distance))
+            for label, distance in zip(labels[0], distances[0])
+        ]
+
+
+def create_vector_index(dimensions: int, backend: Optional[str] = None):
+    """
+    Creates a vector index for the given backend.
+
+    Args:
+        dimensions (int): The length of the indexed vectors.
+        backend (Optional[str]): "numpy" (the default) or "hnsw".
+
+    Returns:
+        VectorIndex | HnswVectorIndex: An empty index.
+    """
+    if backend == "hnsw":
+        return HnswVectorIndex(dimensions)
+    if backend not in (None, "numpy"):
+        raise ValueError(f"Unknown embedding index backend: {backend}")
+    return VectorIndex(dimensions)
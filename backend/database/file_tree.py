@@ -0,0 +1,225 @@
+"""
+This module defines the FileTree class, an in-memory trie of the project's file paths used by MyCodebase.tree(). Files are added and removed incrementally as the index changes, every change bumps a version counter, and the rendered tree string is memoized against that version so repeated renders of an unchanged tree cost nothing. The tree can also be rendered within a token budget, in which case directories that do not fit are collapsed into a single summary line.
+"""
+
+import heapq
+import itertools
+import os
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+
+class _Node:
+    __slots__ = ("children", "is_file", "file_count")
+
+    def __init__(self, is_file: bool = False):
+        self.children: Dict[str, "_Node"] = {}
+        self.is_file = is_file
+        # Number of files below this node, used for collapsed directory summaries
+        self.file_count = 0
+
+
+def _estimate_tokens(text: str) -> int:
+    """Rough token count used to plan budgeted renders, about four characters per token."""
+    return (len(text) + 3) // 4
+
+
+class FileTree:
+    """
+    A trie of path components with a memoized string rendering.
+
+    Attributes:
+        version (int): Incremented whenever a file is added or removed.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self.version = 0
+        self._rendered: Optional[str] = None
+        self._rendered_version = -1
+        self._budgeted_key = None
+        self._budgeted: Optional[Tuple[str, int]] = None
+
+    def add(self, parts: List[str]) -> bool:
+        """
+        Adds a file to the tree.
+
+        Args:
+            parts (List[str]): The path components of the file.
+
+        Returns:
+            bool: True if the file was not in the tree before.
+        """
+        path = [self.root]
+        for part in parts[:-1]:
+            path.append(path[-1].children.setdefault(part, _Node()))
+        if parts[-1] in path[-1].children:
+            return False
+        path[-1].children[parts[-1]] = _Node(is_file=True)
+        for node in path:
+            node.file_count += 1
+        self.version += 1
+        return True
+
+    def remove(self, parts: List[str]) -> bool:
+        """
+        Removes a file from the tree, pruning directories left empty.
+
+        Args:
+            parts (List[str]): The path components of the file.
+
+        Returns:
+            bool: True if the file was in the tree.
+        """
+        path = [self.root]
+        for part in parts:
+            child = path[-1].children.get(part)
+            if child is None:
+                return False
+            path.append(child)
+        if not path[-1].is_file:
+            return False
+        for node in path[:-1]:
+            node.file_count -= 1
+        for depth in range(len(parts), 0, -1):
+            del path[depth - 1].children[parts[depth - 1]]
+            if path[depth - 1].children or depth == 1:
+                break
+        self.version += 1
+        return True
+
+    def render(self) -> str:
+        """
+        Renders the tree, reusing the previous rendering if nothing changed since.
+
+        Returns:
+            str: Each node on its own line prefixed by "+--" and indented four spaces per level.
+        """
+        if self._rendered_version != self.version:
+            lines = []
+            self._render(self.root, "", lines)
+            self._rendered = "".join(lines)
+            self._rendered_version = self.version
+        return self._rendered
+
+    def render_budgeted(
+        self,
+        token_budget: int,
+        focus: Sequence[List[str]] = (),
+        count_tokens: Optional[Callable[[str], int]] = None,
+        tokenizer_name: Optional[str] = None,
+    ) -> Tuple[str, int]:
+        """
+        Renders the tree within a token budget.
+
+        The top level and the directories leading to the focus files are always expanded.
+        Other directories are expanded shallowest and smallest first while the estimated
+        cost fits the budget, and the rest are collapsed to a line such as
+        "+--tests/ (412 files)". If the exact count of the result is over budget the plan
+        is redone with a proportionally smaller estimate.
+
+        Args:
+            token_budget (int): The maximum number of tokens the rendering should use.
+            focus (Sequence[List[str]]): Path components of files whose directories stay expanded.
+            count_tokens (Optional[Callable[[str], int]]): Exact token counter for the result. Defaults to an estimate.
+            tokenizer_name (Optional[str]): Identifies ``count_tokens``, a rendering for another tokenizer is redone.
+
+        Returns:
+            Tuple[str, int]: The rendered tree and its token count.
+        """
+        key = (
+            self.version,
+            token_budget,
+            tuple(tuple(parts) for parts in focus),
+            tokenizer_name,
+        )
+        if self._budgeted_key == key:
+            return self._budgeted
+        count_tokens = count_tokens or _estimate_tokens
+        planning_budget = token_budget
+        for _ in range(4):
+            rendered = self._render_budgeted(planning_budget, focus)
+            tokens = count_tokens(rendered)
+            if tokens <= token_budget or planning_budget <= 0:
+                break
+            planning_budget = int(planning_budget * token_budget / tokens * 0.9)
+        self._budgeted_key, self._budgeted = key, (rendered, tokens)
+        return self._budgeted
+
+    def _render_budgeted(self, budget: int, focus: Sequence[List[str]]) -> str:
+        expanded = {id(self.root)}
+        cost = self._listing_cost(self.root, 0)
+        for parts in focus:
+            node = self.root
+            for depth, part in enumerate(parts[:-1], start=1):
+                node = node.children.get(part)
+                if node is None or node.is_file:
+                    break
+                if id(node) not in expanded:
+                    expanded.add(id(node))
+                    cost += self._listing_cost(node, depth)
+
+        # Candidates are collapsed directories whose parent is expanded
+        counter = itertools.count()
+        candidates = []
+
+        def push_children(node: _Node, depth: int) -> None:
+            for child in node.children.values():
+                if not child.is_file:
+                    heapq.heappush(
+                        candidates,
+                        (depth, child.file_count, next(counter), child),
+                    )
+
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            for child in node.children.values():
+                if id(child) in expanded:
+                    stack.append((child, depth + 1))
+            push_children(node, depth + 1)
+
+        while candidates:
+            depth, _, _, node = heapq.heappop(candidates)
+            if id(node) in expanded:
+                continue
+            listing_cost = self._listing_cost(node, depth)
+            if cost + listing_cost > budget:
+                continue
+            expanded.add(id(node))
+            cost += listing_cost
+            push_children(node, depth + 1)
+
+        lines = []
+        self._render(self.root, "", lines, expanded)
+        return "".join(lines)
+
+    def _listing_cost(self, node: _Node, depth: int) -> int:
+        indent = "    " * depth
+        return sum(
+            _estimate_tokens(f"{indent}+--{self._label(name, child, False)}\n")
+            for name, child in node.children.items()
+        )
+
+    @staticmethod
+    def _label(name: str, node: _Node, expanded: bool) -> str:
+        if node.is_file or expanded:
+            return name
+        noun = "file" if node.file_count == 1 else "files"
+        return f"{name}/ ({node.file_count} {noun})"
+
+    def _render(
+        self, node: _Node, indent: str, lines: List[str], expanded=None
+    ) -> None:
+        for name, child in self._sorted_children(node):
+            is_expanded = expanded is None or id(child) in expanded
+            lines.append(f"{indent}+--{self._label(name, child, is_expanded)}\n")
+            if is_expanded:
+                self._render(child, indent + "    ", lines, expanded)
+
+    @staticmethod
+    def _sorted_children(node: _Node):
+        # Directories sort as "name/" so siblings come out in the order of their sorted full paths
+        return sorted(
+            node.children.items(),
+            key=lambda item: item[0] if item[1].is_file else item[0] + os.path.sep,
+        )
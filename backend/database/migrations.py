@@ -0,0 +1,100 @@
+"""
+This module provides the versioned schema migrations shared by the components that keep tables in the SQLite database (MyCodebase, MemoryManager and SystemPromptHandler). Each component owns a scope and an ordered list of migrations, and the versions applied so far are recorded per scope in the schema_migrations table. Every migration runs in its own transaction at startup, so a database is upgraded once and later startups only read which versions are already there.
+"""
+
+from typing import Callable, List, NamedTuple, Sequence, Tuple, Union
+
+from database.connection import write_lock
+
+Step = Union[str, Callable]
+
+
+class Migration(NamedTuple):
+    """
+    A schema change applied once per database.
+
+    Attributes:
+        version (int): The position of the migration in its scope, starting at 1.
+        description (str): What the migration changes, recorded with the version.
+        steps (Sequence[Step]): SQL statements, or callables taking the cursor, run in order.
+    """
+
+    version: int
+    description: str
+    steps: Sequence[Step]
+
+
+def run_migrations(conn, scope: str, migrations: Sequence[Migration]) -> List[int]:
+    """
+    Applies the migrations of a scope that the database has not recorded yet.
+
+    Args:
+        conn: The database connection.
+        scope (str): The name under which the versions are recorded, e.g. "codebase".
+        migrations (Sequence[Migration]): Every migration of the scope.
+
+    Returns:
+        List[int]: The versions applied by this call, in order.
+    """
+    with write_lock(conn):
+        return _run_migrations(conn, scope, migrations)
+
+
+def _run_migrations(conn, scope: str, migrations: Sequence[Migration]) -> List[int]:
+    cur = conn.cursor()
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            scope TEXT NOT NULL,
+            version INT NOT NULL,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (scope, version)
+        );
+        """
+    )
+    cur.execute("SELECT version FROM schema_migrations WHERE scope = ?", (scope,))
+    applied = {row[0] for row in cur.fetchall()}
+    conn.commit()
+
+    newly_applied = []
+    for migration in sorted(migrations, key=lambda migration: migration.version):
+        if migration.version in applied:
+            continue
+        print(
+            f"Migrating {scope} to version {migration.version}: {migration.description}"
+        )
+        # DDL does not open a transaction implicitly, so one is started explicitly
+        cur.execute("BEGIN")
+        try:
+            for step in migration.steps:
+                if callable(step):
+                    step(cur)
+                else:
+                    cur.execute(step)
+            cur.execute(
+                "INSERT INTO schema_migrations (scope, version, description) VALUES (?, ?, ?)",
+                (scope, migration.version, migration.description),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        newly_applied.append(migration.version)
+    return newly_applied
+
+
+def prefix_range(prefix: str) -> Tuple[str, str]:
+    """
+    Turns a string prefix into the bounds of a range query.
+
+    ``column >= low AND column < high`` selects the same rows as a prefix match but can
+    be answered from an index on the column.
+
+    Args:
+        prefix (str): A non-empty prefix, e.g. a directory ending with a separator.
+
+    Returns:
+        Tuple[str, str]: The inclusive lower and exclusive upper bound.
+    """
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
@@ -1,17 +1,99 @@
 """
-This module defines the MyCodebase class, which is responsible for managing the database operations related to codebase management. It includes functionalities such as initializing the database connection, setting up the directory to scan for code, creating necessary database tables, updating files and embeddings, and removing old files from the database. The class utilizes an external encoder (tiktoken) for encoding model specifics and interacts with the database to store and manage the codebase information efficiently.
+This module defines the MyCodebase class, which is responsible for managing the database operations related to codebase management. It includes functionalities such as initializing the database connection, setting up the directory to scan for code, creating necessary database tables, updating files and embeddings, and removing old files from the database. The class counts tokens with the shared tokenizer (tiktoken) and interacts with the database to store and manage the codebase information efficiently.
 """
 
 import os
+import re
+import sqlite3
 import datetime
-import tiktoken
+import hashlib
+import threading
+import time
+from database.embeddings import (
+    HashingEmbedder,
+    create_vector_index,
+    pack_vector,
+    unpack_vector,
+)
+from database.chunking import Chunk, chunk_file, parse_python, split_lines
+from database.connection import read_cursor, run_blocking, write_lock
+from database.compression import (
+    QUERY_BATCH_SIZE,
+    check_codec,
+    compress_text,
+    decompress_text,
+    read_file_texts,
+    train_dictionary,
+)
+from database.symbols import Symbol, extract_symbols
+from database.tokenizer import DEFAULT_MODEL, get_tokenizer
+from database.file_tree import FileTree
+from database.migrations import Migration, prefix_range, run_migrations
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 
-ENCODER = tiktoken.encoding_for_model("gpt-3.5-turbo")
+# Shared with the rest of the process, counts of unchanged texts are served from its cache
+TOKENIZER = get_tokenizer(DEFAULT_MODEL)
+ENCODER = TOKENIZER.encoding
+
+# Stat columns of every file compared by rescans, answered from the files_stat covering index
+FILE_INDEX_QUERY = """
+    SELECT file_path, size, mtime_ns,
+        CASE WHEN COALESCE(index_version, 0) < ? THEN NULL ELSE content_hash END
+    FROM files
+"""
+# Files under a directory, a range walk of the primary key, see MyCodebase._directory_range
+DIRECTORY_FILES_QUERY = """
+    SELECT file_path FROM files WHERE file_path >= ? AND file_path < ?
+"""
+# Files outside a directory, bounded the same way
+OTHER_FILES_QUERY = """
+    SELECT file_path FROM files WHERE file_path < ? OR file_path >= ?
+"""
+
+
+class IndexedFile(NamedTuple):
+    """A file read by the indexing pool, ready to be written to the files table."""
+
+    file_path: str
+    stat_result: os.stat_result
+    content_hash: str
+    text: Optional[str]
+    token_count: Optional[int]
+    # (chunk, token count) pairs for the chunks table
+    chunks: Optional[List[Tuple[Chunk, int]]] = None
+    symbols: Optional[List[Symbol]] = None
+    # The text as stored, with the codec and dictionary it was compressed with
+    body: Union[str, bytes, None] = None
+    codec: Optional[str] = None
+    dict_id: Optional[str] = None
+    # The name of the tokenizer token_count was counted with
+    token_model: Optional[str] = None
 
 
 class MyCodebase:
+    # When True every scan re-reads and re-tokenizes files regardless of stat/hash
     UPDATE_FULL = False
+    # Bump when indexing derives new data from file contents, older rows are re-indexed once
+    INDEX_VERSION = 3
+    # Tables derived from file contents, keyed by file_path and deleted along with the file
+    DERIVED_TABLES = ("chunks", "symbols")
+    # A compression dictionary is trained once this many files are indexed, from a sample of them
+    DICTIONARY_MIN_FILES = 64
+    DICTIONARY_SAMPLES = 256
 
     def __init__(
         self,
@@ -19,13 +101,62 @@ class MyCodebase:
         db_connection=None,
         ignore_dirs=None,
         file_extensions=None,
+        max_workers: Optional[int] = None,
+        batch_size: int = 500,
+        flush_interval_ms: int = 250,
+        tree_token_budget: Optional[int] = None,
+        embedder: Optional[HashingEmbedder] = None,
+        embedding_backend: Optional[str] = None,
+        compression: Optional[str] = None,
+        model: Optional[str] = None,
     ):
         self.directory = directory
         self.conn = db_connection
         self.cur = self.conn.cursor()
         self.ignore_dirs = ignore_dirs
         self.file_extensions = file_extensions
+        # Size of the thread pool that reads and token-counts files during a scan
+        self.max_workers = max_workers or os.cpu_count() or 1
+        # Indexed files are written in one transaction per batch_size files or flush_interval_ms
+        self.batch_size = batch_size
+        self.flush_interval_ms = flush_interval_ms
+        self._pending_files: List[IndexedFile] = []
+        self._last_flush = time.monotonic()
+        # Serializes scans and the in-memory tree and index between request handlers
+        # and the file watcher
+        self.lock = threading.RLock()
+        # Held only around write transactions, shared with the other components when
+        # the connection is a ConnectionManager; reads go through read_cursor instead
+        self.write_lock = write_lock(db_connection, self.lock)
+        self.listeners: List[Callable[[Set[str]], None]] = []
+        self.watcher = None
+        # Built from the files table on first use, then kept up to date incrementally
+        self.file_tree: Optional[FileTree] = None
+        self._tree_tokens = 0
+        self._tree_tokens_version = -1
+        # Token budget for tree() and the files whose directories it keeps expanded
+        self.tree_token_budget = tree_token_budget
+        self.focus_paths: List[str] = []
+        # Fills the embedding of stored bodies on the first similarity search after they
+        # are written, set to None to stop embedding files
+        self.embedder = embedder if embedder is not None else HashingEmbedder()
+        self.embedding_backend = embedding_backend
+        self.vector_index = None
+        # Files indexed since the vector index was loaded, embedded by the next search
+        self._unembedded: Set[str] = set()
+        # Set by create_tables, False when SQLite was built without FTS5
+        self.fts_enabled = False
+        # Codec for stored file bodies ("zlib", "zstd" or None) and its (dict_id, data) dictionary
+        check_codec(compression)
+        self.compression = compression
+        self._dictionary: Optional[Tuple[str, bytes]] = None
+        # Counts token_count columns; counts made by another tokenizer are recomputed from
+        # the stored bodies when they are read next, see recount_tokens
+        self.tokenizer = TOKENIZER if model is None else get_tokenizer(model)
+        # Names of the tokenizers every stored count is known to be made with
+        self._recounted: Set[str] = set()
         self.create_tables()
+        self._dictionary = self._load_dictionary()
         self._update_files_and_embeddings()
         self.remove_old_files()
 
@@ -41,171 +172,1487 @@ class MyCodebase:
         directory (str): The path to the new root directory to scan.
         """
         print(f"Setting directory to {directory}")
+        watching = self.watcher is not None
+        self.stop_watcher()
         self.directory = directory
-        self.cur.execute(
-            """
-            INSERT INTO config (field, value, last_updated)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(field)
-            DO UPDATE SET value = excluded.value, last_updated = excluded.last_updated
-            WHERE field = 'directory';
-            """,
-            ("directory", directory),
-        )
-        self.conn.commit()
+        self.file_tree = None
+        self._tree_tokens_version = -1
+        self.vector_index = None
+        with self.write_lock:
+            self.cur.execute(
+                """
+                INSERT INTO config (field, value, last_updated)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(field)
+                DO UPDATE SET value = excluded.value, last_updated = excluded.last_updated
+                WHERE field = 'directory';
+                """,
+                ("directory", directory),
+            )
+            self.conn.commit()
         self._update_files_and_embeddings()
         self.remove_old_files()
+        if watching:
+            self.start_watcher()
+
+    def set_model(self, model: Optional[str]) -> bool:
+        """
+        Counts tokens for another model from now on.
+
+        Stored counts are not touched here, they are recomputed from the stored bodies the
+        next time they are read, see ``recount_tokens``. No file is re-indexed.
+
+        Args:
+            model (Optional[str]): The model name, e.g. ``CodingAgent.GPT_MODEL``.
+
+        Returns:
+            bool: True if the tokenizer changed.
+        """
+        tokenizer = get_tokenizer(model)
+        with self.lock:
+            if tokenizer.name == self.tokenizer.name:
+                return False
+            self.tokenizer = tokenizer
+            self._tree_tokens_version = -1
+        return True
+
+    def start_watcher(self, **kwargs) -> None:
+        """
+        Starts keeping the files table in sync with the directory on disk.
+
+        Keyword arguments are passed on to ``CodebaseWatcher``.
+        """
+        from database.watcher import CodebaseWatcher
+
+        if self.watcher is None:
+            self.watcher = CodebaseWatcher(self, **kwargs)
+            self.watcher.start()
+
+    def stop_watcher(self) -> None:
+        """Stops the file watcher if one is running."""
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def add_listener(self, callback: Callable[[Set[str]], None]) -> None:
+        """
+        Registers a callback invoked with the changed paths after incremental updates.
+
+        Args:
+            callback (Callable[[Set[str]], None]): Receives the set of created, modified or removed paths.
+        """
+        self.listeners.append(callback)
+
+    def apply_changes(self, changed: Set[str], removed: Set[str]) -> None:
+        """
+        Applies file events to the files table without rescanning the directory.
+
+        Args:
+            changed (Set[str]): Paths of files that were created or modified.
+            removed (Set[str]): Paths of files that were deleted or moved away.
+        """
+        with self.lock:
+            for file_path in changed:
+                try:
+                    self.update_file(file_path)
+                except FileNotFoundError:
+                    removed = removed | {file_path}
+                except Exception as e:
+                    print(f"Error updating file {file_path}: {e}")
+            self.flush()
+            with self.write_lock:
+                if removed:
+                    self._delete_files([(file_path,) for file_path in removed])
+                # Modified and removed files may have left their previous bodies behind
+                self._collect_blobs()
+                self.conn.commit()
+            if removed:
+                self._on_files_removed(removed)
+        for callback in self.listeners:
+            try:
+                callback(changed | removed)
+            except Exception as e:
+                print(f"Error notifying codebase listener: {e}")
 
     def get_directory(self) -> str:
-        self.cur.execute(
-            """
-            SELECT value FROM config WHERE field = 'directory';
-            """
-        )
-        result = self.cur.fetchone()
+        with read_cursor(self.conn, self.write_lock, self.cur) as cur:
+            cur.execute(
+                """
+                SELECT value FROM config WHERE field = 'directory';
+                """
+            )
+            result = cur.fetchone()
         return result[0] if result else None
 
     def update_file(self, file_path: str) -> None:
-        self.cur.execute(
-            """
-            SELECT last_updated FROM files WHERE file_path = ?
-            """,
-            (file_path,),
+        """
+        Re-indexes a single file if it changed since it was last stored.
+
+        The new row is queued for the next batch write, call ``flush`` to make sure it
+        has reached the database.
+
+        Args:
+            file_path (str): The path of the file to index.
+        """
+        with self.lock:
+            with read_cursor(self.conn, self.write_lock, self.cur) as cur:
+                # Rows of an older INDEX_VERSION come back without a hash, as in rescans
+                cur.execute(
+                    FILE_INDEX_QUERY + "WHERE file_path = ?",
+                    (self.INDEX_VERSION, file_path),
+                )
+                result = cur.fetchall()
+            known = tuple(result[0][1:]) if len(result) > 0 else None
+            stat_result = os.stat(file_path)
+            if self._is_current(stat_result, known):
+                return
+            self._queue_indexed_files([self._read_file(file_path, stat_result, known)])
+
+    def flush(self) -> int:
+        """
+        Writes every queued file to the files table in a single transaction.
+
+        Once this returns the files table is consistent with everything indexed so far.
+
+        Returns:
+            int: The number of files written.
+        """
+        with self.lock:
+            pending, self._pending_files = self._pending_files, []
+            self._last_flush = time.monotonic()
+            if not pending:
+                return 0
+            if any(
+                indexed.token_model not in (None, self.tokenizer.name)
+                for indexed in pending
+            ):
+                # Read before a model change, counted by the previous tokenizer
+                self._recounted.clear()
+            with self.write_lock:
+                try:
+                    self._write_indexed_files(pending)
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    raise
+            self._on_files_indexed(pending)
+        return len(pending)
+
+    def _queue_indexed_files(self, indexed_files: Iterable[IndexedFile]) -> None:
+        """
+        Queues indexed files and flushes once the batch size or flush interval is reached.
+
+        Args:
+            indexed_files (Iterable[IndexedFile]): The rows produced by ``_read_file``.
+        """
+        self._pending_files.extend(indexed_files)
+        elapsed_ms = (time.monotonic() - self._last_flush) * 1000
+        if (
+            len(self._pending_files) >= self.batch_size
+            or elapsed_ms >= self.flush_interval_ms  # noqa 503
+        ):
+            self.flush()
+
+    def _is_current(
+        self, stat_result: os.stat_result, known: Optional[Tuple[int, int, str]]
+    ) -> bool:
+        """
+        Checks whether the stored row of a file still matches its size and mtime_ns.
+
+        Args:
+            stat_result (os.stat_result): The result of ``os.stat`` for the file.
+            known (Optional[Tuple[int, int, str]]): The stored (size, mtime_ns, content_hash), if any.
+
+        Returns:
+            bool: True if the file can be skipped without being opened.
+        """
+        if not known or self.UPDATE_FULL:
+            return False
+        size, mtime_ns, content_hash = known
+        return (
+            content_hash is not None
+            and size == stat_result.st_size  # noqa 503
+            and mtime_ns == stat_result.st_mtime_ns  # noqa 503
+        )
+
+    def _read_file(
+        self,
+        file_path: str,
+        stat_result: os.stat_result,
+        known: Optional[Tuple[int, int, str]] = None,
+    ) -> IndexedFile:
+        """
+        Reads, hashes, token-counts, chunks, parses and compresses a file without touching the database.
+
+        This runs on the indexing pool. Embedding is left to ``search_similar``, the
+        embedder is pure Python and would hold the GIL the pool's threads share. The file
+        is only processed past hashing when its content hash differs from the stored one;
+        otherwise the returned text is None and the writer just refreshes the stat columns.
+
+        Args:
+            file_path (str): The path of the file to read.
+            stat_result (os.stat_result): The result of ``os.stat`` for the file.
+            known (Optional[Tuple[int, int, str]]): The stored (size, mtime_ns, content_hash), if any.
+
+        Returns:
+            IndexedFile: The row to write for this file.
+        """
+        with open(file_path, "rb") as file:
+            data = file.read()
+        content_hash = hashlib.sha256(data).hexdigest()
+        if known and known[2] == content_hash and not self.UPDATE_FULL:
+            return IndexedFile(file_path, stat_result, content_hash, None, None)
+        text = data.decode("utf-8")
+        tokenizer = self.tokenizer
+        token_count = tokenizer.count(text, key=content_hash)
+        # Parsed once for both the chunks and the symbols
+        tree = parse_python(file_path, text)
+        # Chunks an edit did not touch keep their cached counts
+        chunks = [
+            (chunk, tokenizer.count(chunk.text))
+            for chunk in chunk_file(file_path, text, tree=tree)
+        ]
+        dict_id, dictionary = self._dictionary or (None, None)
+        return IndexedFile(
+            file_path,
+            stat_result,
+            content_hash,
+            text,
+            token_count,
+            chunks,
+            extract_symbols(file_path, text, tree),
+            compress_text(text, self.compression, dictionary),
+            self.compression,
+            dict_id if self.compression else None,
+            tokenizer.name,
         )
-        result = self.cur.fetchall()
-        with open(file_path, "r") as file:
-            text = file.read()
+
+    def _write_indexed_files(self, indexed_files: Iterable[IndexedFile]) -> None:
+        """
+        Writes a batch of indexed files to the files table without committing.
+
+        Only ``flush`` should call this, so that every write goes through the batch queue.
+
+        Args:
+            indexed_files (Iterable[IndexedFile]): The rows produced by ``_read_file``.
+        """
+        touched, changed, blobs, chunks, symbols, fts_rows = [], [], [], [], [], []
+        for indexed in indexed_files:
+            stat_result = indexed.stat_result
             last_modified = datetime.datetime.fromtimestamp(
-                os.path.getmtime(file_path)
+                stat_result.st_mtime
             ).replace(microsecond=0)
+            if indexed.text is None:
+                # Touched but not changed, only the stat columns need refreshing
+                touched.append(
+                    (
+                        stat_result.st_size,
+                        stat_result.st_mtime_ns,
+                        last_modified,
+                        indexed.file_path,
+                    )
+                )
+                continue
+            print(f"Updating file {indexed.file_path}")
+            changed.append(
+                (
+                    indexed.file_path,
+                    indexed.token_count,
+                    stat_result.st_size,
+                    stat_result.st_mtime_ns,
+                    indexed.content_hash,
+                    self.INDEX_VERSION,
+                    indexed.token_model,
+                    last_modified,
+                )
+            )
+            blobs.append(
+                (
+                    indexed.content_hash,
+                    indexed.codec,
+                    indexed.dict_id,
+                    indexed.body,
+                )
+            )
+            fts_rows.append((indexed.text, indexed.file_path))
+            chunks.extend(
+                (
+                    indexed.file_path,
+                    chunk.start_line,
+                    chunk.end_line,
+                    chunk.kind,
+                    chunk.name,
+                    chunk_tokens,
+                    indexed.content_hash,
+                )
+                for chunk, chunk_tokens in indexed.chunks or []
+            )
+            symbols.extend(
+                (
+                    symbol.name,
+                    symbol.kind,
+                    indexed.file_path,
+                    symbol.start_line,
+                    symbol.end_line,
+                    symbol.parent,
+                )
+                for symbol in indexed.symbols or []
+            )
+        if touched:
+            self.cur.executemany(
+                """
+                UPDATE files SET size = ?, mtime_ns = ?, last_updated = ?
+                WHERE file_path = ?
+                """,
+                touched,
+            )
+        if changed:
+            if self.fts_enabled:
+                # The full-text rows follow the rowid of the files row, which the upsert keeps
+                self.cur.executemany(
+                    "DELETE FROM files_fts WHERE rowid = (SELECT rowid FROM files WHERE file_path = ?)",
+                    [(row[0],) for row in changed],
+                )
+            self.cur.executemany(
+                """
+                INSERT INTO files (file_path, token_count, size, mtime_ns, content_hash, index_version, token_model, last_updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(file_path)
+                DO UPDATE SET token_count = excluded.token_count, size = excluded.size,
+                    mtime_ns = excluded.mtime_ns, content_hash = excluded.content_hash, index_version = excluded.index_version,
+                    token_model = excluded.token_model, last_updated = excluded.last_updated;
+                """,
+                changed,
+            )
+            # Identical files share one body, replaced bodies are collected by _collect_blobs
+            self.cur.executemany(
+                """
+                INSERT INTO file_blobs (content_hash, codec, dict_id, text)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(content_hash) DO NOTHING;
+                """,
+                blobs,
+            )
+            # Chunks and symbols are only re-derived for files whose content hash changed
+            for table in self.DERIVED_TABLES:
+                self.cur.executemany(
+                    f"DELETE FROM {table} WHERE file_path = ?",
+                    [(row[0],) for row in changed],
+                )
+            self.cur.executemany(
+                """
+                INSERT INTO chunks (file_path, start_line, end_line, kind, name, token_count, content_hash)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                chunks,
+            )
+            self.cur.executemany(
+                """
+                INSERT INTO symbols (name, kind, file_path, start_line, end_line, parent)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                symbols,
+            )
+            if self.fts_enabled:
+                self.cur.executemany(
+                    """
+                    INSERT INTO files_fts (rowid, file_path, text)
+                    SELECT rowid, file_path, ? FROM files WHERE file_path = ?
+                    """,
+                    fts_rows,
+                )
+
+    def _delete_files(self, file_rows: List[Tuple[str]]) -> None:
+        """
+        Deletes files and everything derived from them without committing.
 
-            if len(result) > 0:
-                db_time = datetime.datetime.strptime(result[0][0], "%Y-%m-%d %H:%M:%S")
+        Args:
+            file_rows (List[Tuple[str]]): One (file_path,) tuple per file to delete.
+        """
+        if self.fts_enabled:
+            self.cur.executemany(
+                "DELETE FROM files_fts WHERE rowid = (SELECT rowid FROM files WHERE file_path = ?)",
+                file_rows,
+            )
+        for table in ("files",) + self.DERIVED_TABLES:
+            self.cur.executemany(f"DELETE FROM {table} WHERE file_path = ?", file_rows)
 
-                if db_time >= last_modified:
-                    return
-                else:
-                    print(f"Updating file {file_path}")
+    def _collect_blobs(self) -> None:
+        """
+        Deletes the file bodies no file refers to anymore, without committing.
 
-        token_count = len(ENCODER.encode(text))
-        # The dict's key is the file path, and value is a dict containing the text and embedding
+        Both sides of the difference are read from indexes on content_hash, so this
+        does not touch the bodies themselves.
+        """
         self.cur.execute(
             """
-            INSERT INTO files (file_path, text, token_count, last_updated)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(file_path)
-            DO UPDATE SET text = excluded.text, token_count = excluded.token_count, last_updated = excluded.last_updated;
-            """,
-            (file_path, text, token_count, last_modified),
+            DELETE FROM file_blobs WHERE content_hash IN (
+                SELECT content_hash FROM file_blobs
+                EXCEPT SELECT content_hash FROM files
+            )
+            """
         )
-        self.conn.commit()
+
+    def _load_file_index(self) -> Dict[str, Tuple[int, int, str]]:
+        """
+        Loads the stored (size, mtime_ns, content_hash) of every indexed file.
+
+        Rows indexed by an older INDEX_VERSION are returned without a content hash so the
+        next scan re-indexes them. Only the files table is read, never the file bodies.
+
+        Returns:
+            Dict[str, Tuple[int, int, str]]: The stored stat columns keyed by file path.
+        """
+        with read_cursor(self.conn, self.write_lock, self.cur) as cur:
+            cur.execute(FILE_INDEX_QUERY, (self.INDEX_VERSION,))
+            rows = cur.fetchall()
+        return {row[0]: (row[1], row[2], row[3]) for row in rows}
 
     def create_tables(self) -> None:
         """
         Creates the necessary tables in the database if they don't exist.
+
+        The schema is versioned under the "codebase" scope of ``run_migrations``, only the
+        full-text index depends on the SQLite build and is checked on every start.
+        """
+        try:
+            run_migrations(
+                self.conn,
+                "codebase",
+                [
+                    Migration(
+                        1,
+                        "files, bodies, chunks, symbols and config",
+                        [self._create_base_tables],
+                    ),
+                    Migration(
+                        2,
+                        "covering index for the stat columns read by rescans",
+                        [
+                            """
+                            CREATE INDEX IF NOT EXISTS files_stat
+                            ON files (file_path, size, mtime_ns, content_hash, index_version)
+                            """
+                        ],
+                    ),
+                    Migration(
+                        3,
+                        "tokenizer of the token counts",
+                        [
+                            "ALTER TABLE files ADD COLUMN token_model TEXT",
+                            # Existing counts were made with the default tokenizer
+                            lambda cur: cur.execute(
+                                "UPDATE files SET token_model = ?", (TOKENIZER.name,)
+                            ),
+                            # Rescans compare the tokenizer too, keep their read covered
+                            "DROP INDEX IF EXISTS files_stat",
+                            """
+                            CREATE INDEX files_stat
+                            ON files (file_path, size, mtime_ns, content_hash, index_version, token_model)
+                            """,
+                        ],
+                    ),
+                    Migration(
+                        4,
+                        "chunk text is sliced from the file body",
+                        ["UPDATE chunks SET text = NULL WHERE text IS NOT NULL"],
+                    ),
+                ],
+            )
+            with self.write_lock:
+                self._create_fts_table()
+        except Exception as e:
+            print(f"Failed to create tables: {e}")
+
+    def _create_base_tables(self, cur) -> None:
+        """
+        Creates the tables, bringing databases from before versioned migrations up to date.
+
+        Args:
+            cur: The cursor of the migration transaction.
+        """
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                file_path TEXT PRIMARY KEY,
+                token_count INT,
+                summary TEXT,
+                size INT,
+                mtime_ns INT,
+                content_hash TEXT,
+                index_version INT,
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+        # Bodies are kept apart so scans of the files table stay on a few small pages
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS file_blobs (
+                content_hash TEXT PRIMARY KEY,
+                embedding BLOB,
+                codec TEXT,
+                dict_id TEXT,
+                text
+            );
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                file_path TEXT NOT NULL,
+                start_line INT NOT NULL,
+                end_line INT NOT NULL,
+                kind TEXT,
+                name TEXT,
+                text TEXT,
+                token_count INT,
+                content_hash TEXT,
+                PRIMARY KEY (file_path, start_line, end_line)
+            );
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS symbols (
+                name TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                start_line INT,
+                end_line INT,
+                parent TEXT
+            );
+            """
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS symbols_name ON symbols (name, kind)")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS symbols_file_path ON symbols (file_path)"
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS compression_dicts (
+                dict_id TEXT PRIMARY KEY,
+                codec TEXT NOT NULL,
+                data BLOB NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS config (
+                field TEXT PRIMARY KEY,
+                value TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+
+        # Databases created before incremental indexing lack the stat columns
+        cur.execute("PRAGMA table_info(files)")
+        columns = {row[1] for row in cur.fetchall()}
+        for column, column_type in (
+            ("size", "INT"),
+            ("mtime_ns", "INT"),
+            ("content_hash", "TEXT"),
+            ("index_version", "INT"),
+        ):
+            if column not in columns:
+                cur.execute(f"ALTER TABLE files ADD COLUMN {column} {column_type}")
+        if "text" in columns:
+            self._move_bodies_to_blobs(cur, columns)
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS files_content_hash ON files (content_hash)"
+        )
+
+    def _move_bodies_to_blobs(self, cur, columns: Set[str]) -> None:
+        """
+        Moves the bodies and embeddings of a files table created before file_blobs existed.
+
+        Args:
+            cur: The cursor of the migration transaction.
+            columns (Set[str]): The columns of the files table.
         """
+        print("Moving file bodies to the file_blobs table")
+        moved = [
+            column if column in columns else "NULL"
+            for column in ("embedding", "codec", "dict_id")
+        ]
+        cur.execute(
+            f"""
+            INSERT OR IGNORE INTO file_blobs (content_hash, embedding, codec, dict_id, text)
+            SELECT content_hash, {", ".join(moved)}, text FROM files
+            WHERE content_hash IS NOT NULL AND text IS NOT NULL
+            """
+        )
+        # Rows without a body cannot be served anymore and get re-indexed
+        cur.execute("UPDATE files SET content_hash = NULL WHERE text IS NULL")
+        for column in ("text", "embedding", "codec", "dict_id"):
+            if column in columns:
+                try:
+                    cur.execute(f"ALTER TABLE files DROP COLUMN {column}")
+                except sqlite3.OperationalError:
+                    # SQLite before 3.35 cannot drop columns, empty them instead
+                    cur.execute(f"UPDATE files SET {column} = NULL")
+
+    def _create_fts_table(self) -> None:
+        """
+        Creates the files_fts full-text index over the text of the files table.
+
+        Each row shares its rowid with the files row it mirrors, and the indexing path
+        keeps it in sync. Databases indexed before the table existed are backfilled once.
+        """
+        self.cur.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'files_fts'"
+        )
+        exists = len(self.cur.fetchall()) > 0
         try:
             self.cur.execute(
                 """
-                CREATE TABLE IF NOT EXISTS files (
-                    file_path TEXT PRIMARY KEY,
-                    text TEXT,
-                    embedding BLOB,
-                    token_count INT,
-                    summary TEXT,
-                    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS files_fts
+                USING fts5(file_path UNINDEXED, text);
                 """
             )
-            self.conn.commit()
-
+        except Exception as e:
+            print(f"Full-text search disabled: {e}")
+            self.fts_enabled = False
+            return
+        if not exists:
             self.cur.execute(
                 """
-                CREATE TABLE IF NOT EXISTS config (
-                    field TEXT PRIMARY KEY,
-                    value TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
+                SELECT f.rowid, f.file_path, b.text, b.codec, d.data
+                FROM files f JOIN file_blobs b ON b.content_hash = f.content_hash
+                LEFT JOIN compression_dicts d ON d.dict_id = b.dict_id
                 """
             )
-            self.conn.commit()
-        except Exception as e:
-            print(f"Failed to create tables: {e}")
+            self.cur.executemany(
+                "INSERT INTO files_fts (rowid, file_path, text) VALUES (?, ?, ?)",
+                [
+                    (rowid, file_path, decompress_text(value, codec, dictionary))
+                    for rowid, file_path, value, codec, dictionary in self.cur.fetchall()
+                ],
+            )
+        self.conn.commit()
+        self.fts_enabled = True
 
-    def tree(self) -> str:
+    def tree(
+        self,
+        token_budget: Optional[int] = None,
+        focus_paths: Optional[List[str]] = None,
+    ) -> str:
         """
         Generates a visual representation of the project's directory structure.
 
-        This method fetches the file paths and summaries from the database, constructs a tree
-        structure representing the directory hierarchy, and then generates a string representation
-        of this tree. Each node in the tree represents a directory or file, with directories containing
-        nested dictionaries of their contents.
+        The tree is built from the file paths in the database the first time it is needed
+        and then kept up to date as files are indexed or removed. Rendering is memoized, so
+        calling this again without changes to the tree returns the cached string.
+
+        Args:
+            token_budget (Optional[int]): Collapse directories so the tree fits this many tokens. Defaults to ``self.tree_token_budget``.
+            focus_paths (Optional[List[str]]): Paths, relative to the directory, whose directories stay expanded. Defaults to ``self.focus_paths``.
 
         Returns:
             str: A string representation of the directory tree, with each node prefixed by "+--" and
                  indented to represent its depth in the hierarchy.
         """
-        tree = {}
+        if token_budget or self.tree_token_budget:
+            return self.render_tree(token_budget, focus_paths)[0]
+        with self.lock:
+            if self.file_tree is None:
+                self.file_tree = self._build_file_tree()
+            return self.file_tree.render()
+
+    def render_tree(
+        self,
+        token_budget: Optional[int] = None,
+        focus_paths: Optional[List[str]] = None,
+    ) -> Tuple[str, int]:
+        """
+        Renders the directory tree and reports how many tokens the rendering costs.
+
+        Without a token budget every file is listed. With one, directories that do not fit
+        are collapsed into lines such as "+--tests/ (412 files)", while the directories
+        holding the focus paths are always expanded.
+
+        Args:
+            token_budget (Optional[int]): Collapse directories so the tree fits this many tokens. Defaults to ``self.tree_token_budget``.
+            focus_paths (Optional[List[str]]): Paths, relative to the directory, whose directories stay expanded. Defaults to ``self.focus_paths``.
+
+        Returns:
+            Tuple[str, int]: The rendered tree and its token count.
+        """
+        token_budget = token_budget or self.tree_token_budget
+        focus_paths = self.focus_paths if focus_paths is None else focus_paths
+        with self.lock:
+            if self.file_tree is None:
+                self.file_tree = self._build_file_tree()
+            if not token_budget:
+                rendered = self.file_tree.render()
+                if self.file_tree.version != self._tree_tokens_version:
+                    self._tree_tokens = self.tokenizer.count(rendered)
+                    self._tree_tokens_version = self.file_tree.version
+                return rendered, self._tree_tokens
+            focus = [
+                self._tree_parts(os.path.join(self.directory, path))
+                for path in focus_paths
+            ]
+            return self.file_tree.render_budgeted(
+                token_budget, focus, self.tokenizer.count, self.tokenizer.name
+            )
+
+    def _build_file_tree(self) -> FileTree:
+        """
+        Builds the file tree of the current directory from the files table.
+
+        Returns:
+            FileTree: A tree containing every indexed file under the current directory.
+        """
+        file_tree = FileTree()
+        with read_cursor(self.conn, self.write_lock, self.cur) as cur:
+            cur.execute(DIRECTORY_FILES_QUERY, self._directory_range())
+            rows = cur.fetchall()
+        for (file_path,) in rows:
+            file_tree.add(self._tree_parts(file_path))
+        return file_tree
+
+    def _directory_range(self) -> Tuple[str, str]:
+        """
+        Returns the bounds of the file paths under the current directory.
+
+        Filtering with ``file_path >= ? AND file_path < ?`` lets SQLite answer directory
+        queries from the primary key index instead of scanning every row.
+        """
+        return prefix_range(os.path.join(self.directory, ""))
+
+    def _tree_parts(self, file_path: str) -> List[str]:
+        """
+        Splits a file path into the components shown in the tree.
+
+        Args:
+            file_path (str): The path of the file.
+
+        Returns:
+            List[str]: The path components, starting from the project directory's name.
+        """
         start_from = os.path.basename(self.directory)
+        parts = file_path.split(os.path.sep)
+        # Find the start_from directory in the path and trim up to it
+        if start_from in parts:
+            parts = parts[parts.index(start_from) :]
+        return parts
+
+    def search_similar(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """
+        Finds the files under the current directory whose contents are most similar to a query.
+
+        The stored embeddings are loaded into the vector index on the first search and the
+        index is kept up to date as files are indexed or removed. Bodies are embedded here,
+        on the first search after they were written, rather than while scanning.
+
+        Args:
+            query (str): Free text, e.g. the user's question.
+            k (int): The number of files to return.
+
+        Returns:
+            List[Tuple[str, float]]: (file path, cosine similarity) pairs, most similar first.
+        """
+        if self.embedder is None:
+            return []
+        query_vector = self.embedder.embed(query)
+        with self.lock:
+            if self.vector_index is None:
+                self._unembedded.clear()
+                self.vector_index = self._build_vector_index()
+            elif self._unembedded:
+                self._add_embeddings(self._unembedded)
+                self._unembedded.clear()
+            return self.vector_index.search(query_vector, k)
+
+    def search(self, query: str, k: int = 20) -> List[Dict[str, Any]]:
+        """
+        Ranks the files under the current directory against a lexical query with BM25.
+
+        Every whitespace separated term is matched as a phrase of its words, so
+        ``get_file_contents`` also finds "get file contents", and files matching more
+        terms rank higher.
+
+        Args:
+            query (str): Free text, e.g. identifiers or words from the user's question.
+            k (int): The maximum number of files to return.
+
+        Returns:
+            List[Dict[str, Any]]: One dict per file with its path, score (higher is better) and a snippet of the match.
+        """
+        terms = [term.replace('"', '""') for term in query.split()]
+        terms = [term for term in terms if re.search(r"\w", term)]
+        if not self.fts_enabled or not terms or k <= 0:
+            return []
+        with read_cursor(self.conn, self.write_lock, self.cur) as cur:
+            cur.execute(
+                """
+                SELECT file_path, bm25(files_fts) AS rank,
+                    snippet(files_fts, 1, '', '', '...', 16)
+                FROM files_fts
+                WHERE files_fts MATCH ? AND file_path >= ? AND file_path < ?
+                ORDER BY rank LIMIT ?
+                """,
+                (
+                    " OR ".join(f'"{term}"' for term in terms),
+                    *self._directory_range(),
+                    k,
+                ),
+            )
+            rows = cur.fetchall()
+        return [
+            {"file_path": file_path, "score": -rank, "snippet": snippet}
+            for file_path, rank, snippet in rows
+        ]
+
+    def get_file_text(self, file_path: str) -> Optional[str]:
+        """
+        Returns the stored contents of an indexed file, decompressing them if needed.
+
+        Args:
+            file_path (str): The path of the file as stored in the files table.
+
+        Returns:
+            Optional[str]: The contents of the file, or None if it is not indexed.
+        """
+        return self.get_file_texts([file_path]).get(file_path)
+
+    def get_file_texts(self, file_paths: Iterable[str]) -> Dict[str, str]:
+        """
+        Returns the stored contents of some indexed files, decompressing only those.
+
+        Args:
+            file_paths (Iterable[str]): The paths of the files as stored in the files table.
+
+        Returns:
+            Dict[str, str]: The contents of the indexed files among them, keyed by path.
+        """
+        with read_cursor(self.conn, self.write_lock, self.cur) as cur:
+            return read_file_texts(cur, file_paths)
+
+    def train_compression_dictionary(self) -> Optional[str]:
+        """
+        Trains a compression dictionary on a sample of the indexed files and recompresses every file with it.
+
+        Returns:
+            Optional[str]: The id of the new dictionary, or None if compression is off.
+        """
+        if not self.compression:
+            return None
+        with self.lock, self.write_lock:
+            self.cur.execute(
+                """
+                SELECT b.text, b.codec, d.data
+                FROM file_blobs b LEFT JOIN compression_dicts d ON d.dict_id = b.dict_id
+                WHERE b.text IS NOT NULL ORDER BY random() LIMIT ?
+                """,
+                (self.DICTIONARY_SAMPLES,),
+            )
+            samples = [
+                decompress_text(value, codec, dictionary)
+                for value, codec, dictionary in self.cur.fetchall()
+            ]
+            data = train_dictionary(samples, self.compression)
+            dict_id = hashlib.sha256(self.compression.encode() + data).hexdigest()[:16]
+            self.cur.execute(
+                """
+                INSERT OR IGNORE INTO compression_dicts (dict_id, codec, data)
+                VALUES (?, ?, ?)
+                """,
+                (dict_id, self.compression, data),
+            )
+            self.conn.commit()
+            self._dictionary = (dict_id, data)
+            self._recompress_files()
+        print(f"Trained a {len(data)} byte {self.compression} dictionary {dict_id}")
+        return dict_id
+
+    def _recompress_files(self, batch_size: int = 500) -> None:
+        """
+        Rewrites every stored file body not written with the current codec and dictionary.
+
+        Args:
+            batch_size (int): The number of files rewritten per transaction.
+        """
+        dict_id, dictionary = self._dictionary or (None, None)
+        last_hash = ""
+        while True:
+            self.cur.execute(
+                """
+                SELECT b.content_hash, b.text, b.codec, d.data
+                FROM file_blobs b LEFT JOIN compression_dicts d ON d.dict_id = b.dict_id
+                WHERE b.content_hash > ? AND b.text IS NOT NULL
+                    AND (b.codec IS NOT ? OR b.dict_id IS NOT ?)
+                ORDER BY b.content_hash LIMIT ?
+                """,
+                (last_hash, self.compression, dict_id, batch_size),
+            )
+            rows = self.cur.fetchall()
+            if not rows:
+                break
+            self.cur.executemany(
+                "UPDATE file_blobs SET text = ?, codec = ?, dict_id = ? WHERE content_hash = ?",
+                [
+                    (
+                        compress_text(
+                            decompress_text(value, codec, old_dictionary),
+                            self.compression,
+                            dictionary,
+                        ),
+                        self.compression,
+                        dict_id,
+                        content_hash,
+                    )
+                    for content_hash, value, codec, old_dictionary in rows
+                ],
+            )
+            self.conn.commit()
+            last_hash = rows[-1][0]
+
+    def recount_tokens(self) -> None:
+        """
+        Recomputes the token_count columns of files and chunks counted by another tokenizer.
+
+        Runs as UPDATEs with the tokenizer registered as SQL functions, counting the stored
+        bodies, so a model change neither reads the files on disk nor re-indexes them. Each
+        tokenizer is checked once; files indexed afterwards are counted by ``_read_file``.
+        """
+        tokenizer = self.tokenizer
+        if tokenizer.name in self._recounted:
+            return
+        # (content_hash, text, lines) of the last body, the chunks of a file are consecutive
+        last = [None, None, None]
+
+        def body(content_hash, value, codec, dictionary) -> str:
+            if last[0] != content_hash:
+                last[:] = [
+                    content_hash,
+                    decompress_text(value, codec, dictionary),
+                    None,
+                ]
+            return last[1]
+
+        def count_file(content_hash, value, codec, dictionary) -> Optional[int]:
+            if content_hash is None:
+                return None
+            text = body(content_hash, value, codec, dictionary)
+            return tokenizer.count(text, key=content_hash)
+
+        def count_chunk(
+            start_line, end_line, content_hash, value, codec, dictionary
+        ) -> Optional[int]:
+            if content_hash is None:
+                return None
+            body(content_hash, value, codec, dictionary)
+            if last[2] is None:
+                last[2] = split_lines(last[1])
+            return tokenizer.count("".join(last[2][start_line - 1 : end_line]))
+
+        with self.lock:
+            try:
+                # Queued files were counted by the tokenizer of their time, recount them too
+                self.flush()
+            except Exception as e:
+                print("Failed to recount tokens: ", str(e))
+                return
+            with self.write_lock:
+                try:
+                    # Bound to this tokenizer, the writer is only used under the lock
+                    self.conn.create_function("codebase_token_count", 4, count_file)
+                    self.conn.create_function(
+                        "codebase_chunk_token_count", 6, count_chunk
+                    )
+                    self.cur.execute(
+                        """
+                        UPDATE chunks SET token_count = (
+                            SELECT codebase_chunk_token_count(chunks.start_line, chunks.end_line,
+                                b.content_hash, b.text, b.codec, d.data)
+                            FROM file_blobs b LEFT JOIN compression_dicts d ON d.dict_id = b.dict_id
+                            WHERE b.content_hash = chunks.content_hash
+                        )
+                        WHERE file_path IN (SELECT file_path FROM files WHERE token_model IS NOT ?)
+                        """,
+                        (tokenizer.name,),
+                    )
+                    self.cur.execute(
+                        """
+                        UPDATE files SET token_count = (
+                            SELECT codebase_token_count(b.content_hash, b.text, b.codec, d.data)
+                            FROM file_blobs b LEFT JOIN compression_dicts d ON d.dict_id = b.dict_id
+                            WHERE b.content_hash = files.content_hash
+                        ), token_model = ?
+                        WHERE token_model IS NOT ?
+                        """,
+                        (tokenizer.name, tokenizer.name),
+                    )
+                    self.conn.commit()
+                except Exception as e:
+                    self.conn.rollback()
+                    print("Failed to recount tokens: ", str(e))
+                    return
+            self._recounted.add(tokenizer.name)
+
+    def _load_dictionary(self) -> Optional[Tuple[str, bytes]]:
+        """Loads the newest dictionary trained for the current codec, if any."""
+        if not self.compression:
+            return None
+        self.cur.execute(
+            """
+            SELECT dict_id, data FROM compression_dicts
+            WHERE codec = ? ORDER BY created_at DESC, rowid DESC LIMIT 1
+            """,
+            (self.compression,),
+        )
+        rows = self.cur.fetchall()
+        return tuple(rows[0]) if len(rows) > 0 else None
+
+    def get_chunks(self, file_path: str) -> List[Dict[str, Any]]:
+        """
+        Returns the chunks of an indexed file in file order.
+
+        Only the line spans of chunks are stored, their text is sliced from the file body.
+
+        Args:
+            file_path (str): The path of the file as stored in the files table.
+
+        Returns:
+            List[Dict[str, Any]]: One dict per chunk with its line span, kind, name, text and token count.
+        """
+        self.recount_tokens()
+        with read_cursor(self.conn, self.write_lock, self.cur) as cur:
+            cur.execute(
+                """
+                SELECT start_line, end_line, kind, name, token_count
+                FROM chunks WHERE file_path = ? ORDER BY start_line
+                """,
+                (file_path,),
+            )
+            rows = cur.fetchall()
+        if not rows:
+            return []
+        lines = split_lines(self.get_file_text(file_path) or "")
+        return [
+            {
+                "file_path": file_path,
+                "start_line": start_line,
+                "end_line": end_line,
+                "kind": kind,
+                "name": name,
+                "text": "".join(lines[start_line - 1 : end_line]),
+                "token_count": token_count,
+            }
+            for start_line, end_line, kind, name, token_count in rows
+        ]
+
+    def select_chunks(
+        self, query: str, file_paths: List[str], token_budget: int
+    ) -> List[Dict[str, Any]]:
+        """
+        Picks the chunks of some files that best match a query within a token budget.
+
+        Chunks are ranked by the embedder's similarity to the query and taken greedily
+        until the budget is spent, then returned in file and line order so they read
+        naturally in a prompt.
+
+        Args:
+            query (str): Free text, e.g. the user's question.
+            file_paths (List[str]): The files to pick chunks from.
+            token_budget (int): The maximum total token count of the selected chunks.
+
+        Returns:
+            List[Dict[str, Any]]: The selected chunks, as returned by ``get_chunks``.
+        """
+        chunks = [chunk for path in file_paths for chunk in self.get_chunks(path)]
+        return self._pick_chunks(query, chunks, token_budget)
+
+    def excerpt(
+        self,
+        file_path: str,
+        query: str,
+        token_budget: int,
+        include_line_numbers: bool = False,
+    ) -> Optional[str]:
+        """
+        Cuts a file that does not fit a token budget down to the chunks that best match a query.
+
+        Args:
+            file_path (str): The path of the file as stored in the files table.
+            query (str): Free text, e.g. the user's message. Without one the file's first
+                chunks are kept.
+            token_budget (int): The maximum total token count of the kept chunks.
+            include_line_numbers (bool): Prefix every line with its line number in the file.
+
+        Returns:
+            Optional[str]: The kept chunks in line order, each headed by its line span, or
+                None when the whole file fits the budget, no chunk does, or it is not indexed.
+        """
+        chunks = self.get_chunks(file_path)
+        if sum(chunk["token_count"] for chunk in chunks) <= token_budget:
+            return None
+        selected = self._pick_chunks(query, chunks, token_budget)
+        if not selected:
+            # Not even one chunk fits, a cut-down file would be empty
+            return None
+        parts = []
+        for chunk in selected:
+            text = chunk["text"]
+            if include_line_numbers:
+                text = "".join(
+                    f"{number} {line}"
+                    for number, line in enumerate(
+                        split_lines(text), chunk["start_line"]
+                    )
+                )
+            parts.append(f"[lines {chunk['start_line']}-{chunk['end_line']}]\n{text}")
+        return "\n".join(parts)
+
+    def _pick_chunks(
+        self, query: str, chunks: List[Dict[str, Any]], token_budget: int
+    ) -> List[Dict[str, Any]]:
+        if self.embedder is not None and chunks and query.strip():
+            query_vector = self.embedder.embed(query)
+            scores = self.embedder.embed_many(c["text"] for c in chunks) @ query_vector
+            # Stable, so chunks that score the same keep their file order
+            ranked = [chunks[i] for i in (-scores).argsort(kind="stable")]
+        else:
+            ranked = chunks
+        selected, used = [], 0
+        for chunk in ranked:
+            if used + chunk["token_count"] <= token_budget:
+                selected.append(chunk)
+                used += chunk["token_count"]
+        return sorted(selected, key=lambda c: (c["file_path"], c["start_line"]))
+
+    def find_symbol(
+        self,
+        name: str,
+        kind: Optional[str] = None,
+        parent: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Looks up where a function, class or method is defined.
+
+        The lookup goes through the index on the symbols name column, so it does not scan
+        the table. Symbols outside the current directory are left out.
+
+        Args:
+            name (str): The bare name of the symbol, e.g. "get_messages".
+            kind (Optional[str]): Restrict to "function", "class" or "method".
+            parent (Optional[str]): Restrict to methods or nested classes of this class.
+
+        Returns:
+            List[Dict[str, Any]]: One dict per definition with its kind, file path, line span and parent.
+        """
+        query = """
+            SELECT name, kind, file_path, start_line, end_line, parent
+            FROM symbols WHERE name = ?
+        """
+        params = [name]
+        if kind is not None:
+            query += " AND kind = ?"
+            params.append(kind)
+        if parent is not None:
+            query += " AND parent = ?"
+            params.append(parent)
+        with read_cursor(self.conn, self.write_lock, self.cur) as cur:
+            cur.execute(query + " ORDER BY file_path, start_line", params)
+            rows = cur.fetchall()
+        return [
+            {
+                "name": name,
+                "kind": kind,
+                "file_path": file_path,
+                "start_line": start_line,
+                "end_line": end_line,
+                "parent": parent,
+            }
+            for name, kind, file_path, start_line, end_line, parent in rows
+            if file_path.startswith(self.directory)
+        ]
+
+    async def aset_directory(self, directory: str) -> None:
+        """Awaitable ``set_directory``, the rescan runs off the event loop."""
+        await run_blocking(self.conn, self.set_directory, directory, kind=None)
+
+    async def arescan(self) -> None:
+        """Awaitable rescan of the current directory, see ``_update_files_and_embeddings``."""
+        await run_blocking(self.conn, self._update_files_and_embeddings, kind=None)
+
+    async def aget_directory(self) -> str:
+        """Awaitable ``get_directory``."""
+        return await run_blocking(self.conn, self.get_directory)
+
+    async def atree(
+        self,
+        token_budget: Optional[int] = None,
+        focus_paths: Optional[List[str]] = None,
+    ) -> str:
+        """Awaitable ``tree``."""
+        return await run_blocking(self.conn, self.tree, token_budget, focus_paths)
+
+    async def asearch(self, query: str, k: int = 20) -> List[Dict[str, Any]]:
+        """Awaitable ``search``."""
+        return await run_blocking(self.conn, self.search, query, k)
+
+    async def asearch_similar(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """Awaitable ``search_similar``."""
+        return await run_blocking(self.conn, self.search_similar, query, k)
+
+    async def aget_file_texts(self, file_paths: Iterable[str]) -> Dict[str, str]:
+        """Awaitable ``get_file_texts``."""
+        return await run_blocking(self.conn, self.get_file_texts, list(file_paths))
+
+    async def afind_symbol(
+        self,
+        name: str,
+        kind: Optional[str] = None,
+        parent: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Awaitable ``find_symbol``."""
+        return await run_blocking(self.conn, self.find_symbol, name, kind, parent)
+
+    def _build_vector_index(self):
+        """
+        Loads the stored embeddings of the current directory into a vector index.
+
+        Returns:
+            VectorIndex | HnswVectorIndex: The index of every embedded file under the directory.
+        """
+        vector_index = create_vector_index(
+            self.embedder.dimensions, self.embedding_backend
+        )
+        self._embed_missing_blobs()
+        with read_cursor(self.conn, self.write_lock, self.cur) as cur:
+            cur.execute(
+                """
+                SELECT f.file_path, b.embedding
+                FROM files f JOIN file_blobs b ON b.content_hash = f.content_hash
+                WHERE f.file_path >= ? AND f.file_path < ? AND b.embedding IS NOT NULL
+                """,
+                self._directory_range(),
+            )
+            rows = cur.fetchall()
+        self._add_vectors(vector_index, rows)
+        return vector_index
 
-        # Fetch file paths from the database
-        self.cur.execute("SELECT file_path, summary FROM files")
-        file_paths = [
-            result[0]
-            for result in self.cur.fetchall()
-            if result[0].startswith(self.directory)
+    def _add_embeddings(self, file_paths: Iterable[str]) -> None:
+        """Embeds some newly indexed files and adds them to the loaded vector index."""
+        file_paths = list(file_paths)
+        self._embed_missing_blobs()
+        rows = []
+        with read_cursor(self.conn, self.write_lock, self.cur) as cur:
+            for start in range(0, len(file_paths), QUERY_BATCH_SIZE):
+                batch = file_paths[start : start + QUERY_BATCH_SIZE]
+                cur.execute(
+                    f"""
+                    SELECT f.file_path, b.embedding
+                    FROM files f JOIN file_blobs b ON b.content_hash = f.content_hash
+                    WHERE f.file_path IN ({", ".join("?" for _ in batch)})
+                        AND b.embedding IS NOT NULL
+                    """,
+                    batch,
+                )
+                rows.extend(cur.fetchall())
+        self._add_vectors(self.vector_index, rows)
+
+    def _add_vectors(self, vector_index, rows: List[Tuple[str, bytes]]) -> None:
+        for file_path, embedding in rows:
+            vector = unpack_vector(embedding)
+            if len(vector) == self.embedder.dimensions:
+                vector_index.add(file_path, vector)
+
+    def _embed_missing_blobs(self) -> None:
+        """
+        Embeds the stored bodies that have no embedding yet.
+
+        The bodies are read and embedded outside the write lock, only the update holds it.
+        """
+        with read_cursor(self.conn, self.write_lock, self.cur) as cur:
+            cur.execute(
+                """
+                SELECT b.content_hash, b.text, b.codec, d.data
+                FROM file_blobs b LEFT JOIN compression_dicts d ON d.dict_id = b.dict_id
+                WHERE b.embedding IS NULL AND b.text IS NOT NULL
+                """
+            )
+            rows = cur.fetchall()
+        if len(rows) == 0:
+            return
+        embeddings = [
+            (
+                pack_vector(
+                    self.embedder.embed(decompress_text(value, codec, dictionary))
+                ),
+                content_hash,
+            )
+            for content_hash, value, codec, dictionary in rows
         ]
-        # Insert each file into the tree structure
-        for file_path in sorted(file_paths):
-            parts = file_path.split(os.path.sep)
-            # Find the start_from directory in the path and trim up to it
-            if start_from in parts:
-                parts = parts[parts.index(start_from) :]
-            current_level = tree
-            for part in parts:
-                if part not in current_level:
-                    current_level[part] = {}
-                current_level = current_level[part]
-
-        # Function to recursively build the tree string
-        def build_tree_string(current_level, indent=""):
-            tree_string = ""
-            for part in current_level:
-                tree_string += f"{indent}+--{part}\n"
-                tree_string += build_tree_string(current_level[part], indent + "    ")
-            return tree_string
-
-        # Build the tree string starting from the root
-        return build_tree_string(tree)
+        with self.write_lock:
+            self.cur.executemany(
+                "UPDATE file_blobs SET embedding = ? WHERE content_hash = ?",
+                embeddings,
+            )
+            self.conn.commit()
+
+    def _on_files_indexed(self, indexed_files: Iterable[IndexedFile]) -> None:
+        """Updates the in-memory tree and vector index after files were written."""
+        for indexed in indexed_files:
+            if indexed.text is None:
+                continue
+            self._tree_add(indexed.file_path)
+            if self.vector_index is not None and indexed.file_path.startswith(
+                self.directory
+            ):
+                self._unembedded.add(indexed.file_path)
+
+    def _on_files_removed(self, file_paths: Iterable[str]) -> None:
+        """Updates the in-memory tree and vector index after files were deleted."""
+        for file_path in file_paths:
+            self._tree_remove(file_path)
+            self._unembedded.discard(file_path)
+            if self.vector_index is not None:
+                self.vector_index.remove(file_path)
+
+    def _tree_add(self, file_path: str) -> None:
+        if self.file_tree is not None and file_path.startswith(self.directory):
+            self.file_tree.add(self._tree_parts(file_path))
+
+    def _tree_remove(self, file_path: str) -> None:
+        if self.file_tree is not None and file_path.startswith(self.directory):
+            self.file_tree.remove(self._tree_parts(file_path))
 
     def remove_old_files(self) -> None:
         """
         Remove files from the database that are no longer present in the codebase.
+
+        Rows under the current directory are reconciled by the directory walk itself, so
+        only rows left over from other directories are checked here.
         """
-        self.cur.execute("SELECT file_path FROM files")
-        file_paths = [result[0] for result in self.cur.fetchall()]
-        for file_path in file_paths:
-            if not os.path.exists(file_path) or not self._is_valid_file(file_path):
+        with self.lock, self.write_lock:
+            self.cur.execute(OTHER_FILES_QUERY, self._directory_range())
+            stale_paths = [
+                (file_path,)
+                for (file_path,) in self.cur.fetchall()
+                if not os.path.exists(file_path)
+                or not self._is_valid_file(os.path.basename(file_path))  # noqa 503
+            ]
+            if stale_paths:
+                self._delete_files(stale_paths)
+                self._collect_blobs()
+            self.conn.commit()
+            self._on_files_removed(file_path for (file_path,) in stale_paths)
+
+    def _remove_unseen_files(self, seen_paths: Set[str]) -> None:
+        """
+        Deletes every row under the current directory that the last walk did not visit.
+
+        The visited paths are loaded into a temporary table so the set difference is a
+        single DELETE committed in one transaction.
+
+        Args:
+            seen_paths (Set[str]): The file paths visited during the walk.
+        """
+        with self.write_lock:
+            self.cur.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS seen_files (file_path TEXT PRIMARY KEY)"
+            )
+            self.cur.execute("DELETE FROM seen_files")
+            self.cur.executemany(
+                "INSERT OR IGNORE INTO seen_files (file_path) VALUES (?)",
+                ((file_path,) for file_path in seen_paths),
+            )
+            unseen = """
+                file_path >= ? AND file_path < ?
+                AND file_path NOT IN (SELECT file_path FROM seen_files)
+            """
+            directory_range = self._directory_range()
+            if self.fts_enabled:
                 self.cur.execute(
-                    """
-                    DELETE FROM files WHERE file_path = ?
-                    """,
-                    (file_path,),
+                    f"DELETE FROM files_fts WHERE rowid IN (SELECT rowid FROM files WHERE {unseen})",
+                    directory_range,
                 )
-                self.conn.commit()
+            for table in ("files",) + self.DERIVED_TABLES:
+                self.cur.execute(f"DELETE FROM {table} WHERE {unseen}", directory_range)
+            self.cur.execute("DELETE FROM seen_files")
+            self._collect_blobs()
+            self.conn.commit()
 
-    def _update_files_and_embeddings(self) -> None:
-        for root, dirs, files in os.walk(self.directory):
+    def _walk_files(
+        self, directory: Optional[str] = None
+    ) -> Iterator[Tuple[str, os.stat_result]]:
+        """
+        Walks a directory and yields every indexable file with its stat result.
+
+        Args:
+            directory (Optional[str]): The directory to walk. Defaults to the current directory.
+
+        Yields:
+            Tuple[str, os.stat_result]: The file path and the result of ``os.stat``.
+        """
+        for root, dirs, files in os.walk(directory or self.directory):
             dirs[:] = [d for d in dirs if self._is_valid_directory(d)]
             for file_name in files:
                 if self._is_valid_file(file_name):
                     file_path = os.path.join(root, file_name)
                     try:
-                        self.update_file(file_path)
-                    except Exception as e:
+                        yield file_path, os.stat(file_path)
+                    except OSError as e:
                         print(f"Error updating file {file_path}: {e}")
-                    self.remove_old_files()
+
+    def _update_files_and_embeddings(self) -> None:
+        """
+        Scans the current directory and brings the files table up to date.
+
+        The scan is a three stage pipeline: this thread walks the tree and skips files
+        whose stat still matches, a pool of ``max_workers`` threads reads, hashes and
+        token-counts the rest (tiktoken releases the GIL), and the results are queued
+        for batched writes from this thread, which is the only one touching the database.
+        The files table is consistent once the scan returns.
+        """
+        with self.lock:
+            self._scan_directory()
+
+    def _scan_directory(self) -> None:
+        known_files = self._load_file_index()
+        seen_paths = set()
+        in_flight = {}
+        max_in_flight = self.max_workers * 4
+
+        def write_done(futures) -> None:
+            indexed_files = []
+            for future in futures:
+                file_path = in_flight.pop(future)
+                try:
+                    indexed_files.append(future.result())
+                except Exception as e:
+                    print(f"Error updating file {file_path}: {e}")
+            self._queue_indexed_files(indexed_files)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for file_path, stat_result in self._walk_files():
+                seen_paths.add(file_path)
+                known = known_files.get(file_path)
+                if self._is_current(stat_result, known):
+                    continue
+                future = pool.submit(self._read_file, file_path, stat_result, known)
+                in_flight[future] = file_path
+                if len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    write_done(done)
+            write_done(list(in_flight))
+        self.flush()
+        self._remove_unseen_files(seen_paths)
+        self._on_files_removed(known_files.keys() - seen_paths)
+        if (
+            self.compression
+            and self._dictionary is None  # noqa 503
+            and len(seen_paths) >= self.DICTIONARY_MIN_FILES  # noqa 503
+        ):
+            self.train_compression_dictionary()
 
     def _is_valid_file(self, file_name):
         return (
@@ -0,0 +1,62 @@
+"""
+This module extracts the symbols defined in Python source for the symbols table maintained by MyCodebase. Functions, classes and methods are taken from the ast module together with their line span and enclosing class, so agent operations that refer to a symbol by name can be resolved to the file that defines it.
+"""
+
+import ast
+from typing import List, NamedTuple, Optional
+
+from database.chunking import parse_python
+
+
+class Symbol(NamedTuple):
+    """A definition in a Python file. Line numbers are 1-based and inclusive."""
+
+    name: str
+    kind: str
+    start_line: int
+    end_line: int
+    parent: Optional[str]
+
+
+def extract_symbols(
+    file_path: str, text: str, tree: Optional[ast.Module] = None
+) -> List[Symbol]:
+    """
+    Lists the functions, classes and methods defined in a Python file.
+
+    Functions nested inside other functions are not listed. Nested classes use the dotted
+    name of their enclosing class as parent.
+
+    Args:
+        file_path (str): The path of the file, only ``.py`` files are parsed.
+        text (str): The contents of the file.
+        tree (Optional[ast.Module]): The file as returned by ``parse_python``, parsed here if not given.
+
+    Returns:
+        List[Symbol]: The symbols in file order, or an empty list if the file does not parse.
+    """
+    if not file_path.endswith(".py"):
+        return []
+    if tree is None:
+        tree = parse_python(file_path, text)
+    symbols = []
+    _collect(tree.body, None, symbols)
+    return symbols
+
+
+def _collect(
+    body: List[ast.stmt], parent: Optional[str], symbols: List[Symbol]
+) -> None:
+    for node in body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            kind = "method" if parent else "function"
+        elif isinstance(node, ast.ClassDef):
+            kind = "class"
+        else:
+            continue
+        decorators = [decorator.lineno for decorator in node.decorator_list]
+        start_line = min([node.lineno] + decorators)
+        symbols.append(Symbol(node.name, kind, start_line, node.end_lineno, parent))
+        if kind == "class":
+            qualified = f"{parent}.{node.name}" if parent else node.name
+            _collect(node.body, qualified, symbols)
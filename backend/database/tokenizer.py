@@ -0,0 +1,203 @@
+"""
+This module provides the token counting shared by MyCodebase, MemoryManager and the API. Loading a tiktoken encoding is slow, so each model's encoding is loaded once per process, and counts are kept in an LRU cache keyed by a hash of the text: messages re-counted while assembling prompts and chunks that did not change when their file was edited are not encoded again. ``count_many`` encodes every cache miss of a batch with tiktoken's threaded ``encode_batch``.
+
+``get_tokenizer`` picks the tokenizer from the model name the agent sends to (``CodingAgent.GPT_MODEL``). OpenAI models use their tiktoken encoding. Claude's tokenizer is not available offline, so Anthropic models get an estimate scaled from cl100k_base. Each tokenizer has a ``name`` that is stored next to token counts, so counts made with another tokenizer can be told apart and recomputed.
+"""
+
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Iterable, List, Optional
+
+import tiktoken
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+# Encoding used for models tiktoken does not know
+FALLBACK_ENCODING = "cl100k_base"
+CACHE_SIZE = 8192
+# Claude's counts run above cl100k_base on English and code, so the estimate is scaled
+# up to keep budgets on the safe side
+ANTHROPIC_ENCODING = "cl100k_base"
+ANTHROPIC_TOKEN_RATIO = 1.2
+# Model name prefixes counted with the Anthropic estimate, e.g. "anthropic" as used by
+# CodingAgent, "claude-3-sonnet-20240229" or "anthropic.claude-3-sonnet-20240229-v1:0"
+ANTHROPIC_PREFIXES = ("anthropic", "claude")
+
+
+class Tokenizer:
+    """
+    Counts tokens with one encoding and remembers the counts of recent texts.
+
+    Attributes:
+        encoding (tiktoken.Encoding): The encoding texts are counted with.
+        cache_size (int): The number of counts kept.
+        name (str): Identifies the counts this tokenizer makes, stored with them.
+    """
+
+    def __init__(
+        self,
+        encoding: tiktoken.Encoding,
+        cache_size: int = CACHE_SIZE,
+        name: Optional[str] = None,
+    ):
+        self.encoding = encoding
+        self.cache_size = cache_size
+        self.name = name or encoding.name
+        self._counts: "OrderedDict[bytes, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, text: str) -> List[int]:
+        return self.encoding.encode(text)
+
+    def count(self, text: str, key: Optional[str] = None) -> int:
+        """
+        Counts the tokens of a text, encoding it only if its count is not cached.
+
+        Args:
+            text (str): The text to count.
+            key (Optional[str]): A hash of the text the caller already has, e.g. a content hash.
+
+        Returns:
+            int: The number of tokens.
+        """
+        cache_key = self._key(text, key)
+        count = self._get(cache_key)
+        if count is None:
+            count = self._count_uncached(text)
+            self._put(cache_key, count)
+        return count
+
+    def count_many(self, texts: Iterable[str]) -> List[int]:
+        """
+        Counts the tokens of several texts, encoding the uncached ones in one batch.
+
+        Args:
+            texts (Iterable[str]): The texts to count.
+
+        Returns:
+            List[int]: The number of tokens of each text, in order.
+        """
+        texts = list(texts)
+        keys = [self._key(text) for text in texts]
+        counts = [self._get(key) for key in keys]
+        missing = [i for i, count in enumerate(counts) if count is None]
+        if missing:
+            uncached = self._count_batch_uncached([texts[i] for i in missing])
+            for i, count in zip(missing, uncached):
+                counts[i] = count
+                self._put(keys[i], count)
+        return counts
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counts.clear()
+
+    def _count_uncached(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    def _count_batch_uncached(self, texts: List[str]) -> List[int]:
+        # encode_batch spreads the texts over threads, tiktoken releases the GIL
+        return [len(tokens) for tokens in self.encoding.encode_batch(texts)]
+
+    def _key(self, text: str, key: Optional[str] = None) -> bytes:
+        if key is not None:
+            return key.encode("utf-8")
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def _get(self, key: bytes) -> Optional[int]:
+        with self._lock:
+            count = self._counts.get(key)
+            if count is None:
+                self.misses += 1
+                return None
+            self._counts.move_to_end(key)
+            self.hits += 1
+            return count
+
+    def _put(self, key: bytes, count: int) -> None:
+        with self._lock:
+            self._counts[key] = count
+            self._counts.move_to_end(key)
+            if len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+
+
+class ApproximateTokenizer(Tokenizer):
+    """
+    Estimates the token counts of a model whose tokenizer is not available offline.
+
+    Texts are counted with a related tiktoken encoding and scaled by ``ratio``.
+    """
+
+    def __init__(
+        self,
+        encoding: tiktoken.Encoding,
+        ratio: float,
+        name: str,
+        cache_size: int = CACHE_SIZE,
+    ):
+        super().__init__(encoding, cache_size, name)
+        self.ratio = ratio
+
+    def _count_uncached(self, text: str) -> int:
+        return math.ceil(super()._count_uncached(text) * self.ratio)
+
+    def _count_batch_uncached(self, texts: List[str]) -> List[int]:
+        return [
+            math.ceil(count * self.ratio)
+            for count in super()._count_batch_uncached(texts)
+        ]
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = DEFAULT_MODEL) -> tiktoken.Encoding:
+    """Loads the tiktoken encoding of a model once per process."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+
+
+def is_anthropic_model(model: Optional[str]) -> bool:
+    return bool(model) and model.lower().startswith(ANTHROPIC_PREFIXES)
+
+
+def get_tokenizer(model: Optional[str] = DEFAULT_MODEL) -> Tokenizer:
+    """
+    Returns the process-wide tokenizer for a model.
+
+    Models sharing an encoding share a tokenizer and its cache of counts.
+
+    Args:
+        model (Optional[str]): The model name, e.g. ``CodingAgent.GPT_MODEL``. Defaults to DEFAULT_MODEL.
+
+    Returns:
+        Tokenizer: The tokenizer, an ApproximateTokenizer for Anthropic models.
+    """
+    if is_anthropic_model(model):
+        return _anthropic_tokenizer()
+    return _encoding_tokenizer(get_encoding(model or DEFAULT_MODEL))
+
+
+@lru_cache(maxsize=None)
+def _encoding_tokenizer(encoding: tiktoken.Encoding) -> Tokenizer:
+    # tiktoken hands out one object per encoding, so models sharing one share this
+    return Tokenizer(encoding)
+
+
+@lru_cache(maxsize=None)
+def _anthropic_tokenizer() -> Tokenizer:
+    return ApproximateTokenizer(
+        tiktoken.get_encoding(ANTHROPIC_ENCODING),
+        ANTHROPIC_TOKEN_RATIO,
+        name=f"anthropic~{ANTHROPIC_ENCODING}",
+    )
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """Counts the tokens of a text for a model, see ``Tokenizer.count``."""
+    return get_tokenizer(model).count(text)
@@ -0,0 +1,182 @@
+"""
+This module defines the CodebaseWatcher class, which keeps the files table of a MyCodebase instance in sync with the directory on disk without full rescans. Filesystem events come from watchdog (inotify, FSEvents, ...) when it is installed, with a polling fallback otherwise. Events are debounced and applied to the codebase in batches through MyCodebase.apply_changes, which also notifies the codebase listeners so cached views of the project can be refreshed.
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Optional, Set, Tuple
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # watchdog is optional, fall back to polling
+    FileSystemEventHandler = object
+    Observer = None
+
+
+class _EventHandler(FileSystemEventHandler):
+    """Forwards watchdog events to the owning CodebaseWatcher."""
+
+    def __init__(self, watcher: "CodebaseWatcher"):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event) -> None:
+        if event.is_directory:
+            return
+        if event.event_type in ("created", "modified", "closed"):
+            self.watcher.record(event.src_path, removed=False)
+        elif event.event_type == "deleted":
+            self.watcher.record(event.src_path, removed=True)
+        elif event.event_type == "moved":
+            self.watcher.record(event.src_path, removed=True)
+            self.watcher.record(event.dest_path, removed=False)
+
+
+class CodebaseWatcher:
+    """
+    Watches a codebase directory and applies file changes to the files table incrementally.
+
+    Attributes:
+        codebase (MyCodebase): The codebase whose directory is watched.
+        debounce_ms (int): How long the directory must be quiet before pending events are applied.
+        max_delay_ms (int): Upper bound on how long an event can wait while events keep arriving.
+        poll_interval (float): Seconds between directory scans when watchdog is unavailable.
+        use_polling (bool): Whether the polling fallback is used instead of watchdog.
+    """
+
+    def __init__(
+        self,
+        codebase,
+        debounce_ms: int = 200,
+        max_delay_ms: int = 1000,
+        poll_interval: float = 1.0,
+        use_polling: Optional[bool] = None,
+    ):
+        self.codebase = codebase
+        self.directory = codebase.directory
+        self.debounce_ms = debounce_ms
+        self.max_delay_ms = max_delay_ms
+        self.poll_interval = poll_interval
+        self.use_polling = Observer is None if use_polling is None else use_polling
+        self._pending: Dict[str, bool] = {}
+        self._first_event = None
+        self._last_event = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._observer = None
+        self._thread = None
+        self._snapshot: Dict[str, Tuple[int, int]] = {}
+
+    def start(self) -> None:
+        """Starts watching the codebase directory in background threads."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        if self.use_polling:
+            self._snapshot = self._scan()
+            self._thread = threading.Thread(
+                target=self._poll_loop, name="codebase-poller", daemon=True
+            )
+        else:
+            self._observer = Observer()
+            self._observer.schedule(_EventHandler(self), self.directory, recursive=True)
+            self._observer.start()
+            self._thread = threading.Thread(
+                target=self._debounce_loop, name="codebase-watcher", daemon=True
+            )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops watching and applies any events that are still pending."""
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.apply_pending()
+
+    def record(self, path: str, removed: bool) -> None:
+        """
+        Records a file event to be applied once the directory has been quiet for a while.
+
+        Later events for the same path replace earlier ones, so a burst of writes to one
+        file results in a single re-index.
+
+        Args:
+            path (str): The path of the file that changed.
+            removed (bool): True if the file was deleted or moved away.
+        """
+        if not self._is_watched(path):
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._pending[path] = removed
+            self._last_event = now
+            if self._first_event is None:
+                self._first_event = now
+
+    def apply_pending(self) -> Set[str]:
+        """
+        Applies every pending event to the codebase.
+
+        Returns:
+            Set[str]: The paths that were applied.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._first_event = self._last_event = None
+        if not pending:
+            return set()
+        changed = {path for path, removed in pending.items() if not removed}
+        removed = {path for path, removed in pending.items() if removed}
+        try:
+            self.codebase.apply_changes(changed=changed, removed=removed)
+        except Exception as e:
+            print(f"Error applying file changes: {e}")
+        return set(pending)
+
+    def _is_watched(self, path: str) -> bool:
+        relative = os.path.relpath(path, self.directory)
+        parts = relative.split(os.path.sep)
+        if parts[0] == os.pardir:
+            return False
+        return all(
+            self.codebase._is_valid_directory(part) for part in parts[:-1]
+        ) and self.codebase._is_valid_file(parts[-1])
+
+    def _is_due(self) -> bool:
+        with self._lock:
+            if self._last_event is None:
+                return False
+            now = time.monotonic()
+            quiet_ms = (now - self._last_event) * 1000
+            waited_ms = (now - self._first_event) * 1000
+        return quiet_ms >= self.debounce_ms or waited_ms >= self.max_delay_ms
+
+    def _debounce_loop(self) -> None:
+        interval = self.debounce_ms / 4000
+        while not self._stop.wait(interval):
+            if self._is_due():
+                self.apply_pending()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        return {
+            file_path: (stat_result.st_size, stat_result.st_mtime_ns)
+            for file_path, stat_result in self.codebase._walk_files(self.directory)
+        }
+
+    def _poll_loop(self) -> None:
+        while not self._stop.wait(self.poll_interval):
+            snapshot = self._scan()
+            for file_path, signature in snapshot.items():
+                if self._snapshot.get(file_path) != signature:
+                    self.record(file_path, removed=False)
+            for file_path in self._snapshot.keys() - snapshot.keys():
+                self.record(file_path, removed=True)
+            self._snapshot = snapshot
+            self.apply_pending()
@@ -1,15 +1,14 @@
 import json
 import os
 from uuid import uuid4
-import tiktoken
 from fastapi import Request, BackgroundTasks
 from fastapi.responses import JSONResponse, StreamingResponse
 from app_setup import setup_app, app
 from agent.agent_functions.file_ops import _OP_LIST
+from database.connection import read_cursor, run_blocking
 import traceback
 import logging
 
-ENCODER = tiktoken.encoding_for_model("gpt-3.5-turbo")
 AGENT, CODEBASE = setup_app()
 
 logger = logging.getLogger("logger")
@@ -17,27 +16,30 @@ logger = logging.getLogger("logger")
 
 @app.on_event("startup")
 async def startup_event():
-    config = AGENT.memory_manager.cur.execute(
-        """
-        SELECT field, value FROM config
-        """
-    ).fetchall()
-    config = {field: value for field, value in config}
+    config = await AGENT.memory_manager.aget_config()
     if config.get("model"):
-        AGENT.GPT_MODEL = config["model"]
+        AGENT.set_model(config["model"])
     if config.get("max_message_tokens"):
         AGENT.memory_manager.max_tokens = int(config["max_message_tokens"])
     if config.get("directory"):
-        CODEBASE.set_directory(config["directory"])
-        AGENT.memory_manager.prompt_handler.tree = CODEBASE.tree()
-        AGENT.memory_manager.prompt_handler.set_system()
-        AGENT.memory_manager.set_directory(config["directory"])
+        await CODEBASE.aset_directory(config["directory"])
+        AGENT.memory_manager.prompt_handler.tree = await CODEBASE.atree()
+        await AGENT.memory_manager.prompt_handler.aset_system()
+        await AGENT.memory_manager.aset_directory(config["directory"])
     if config.get("files"):
         AGENT.memory_manager.prompt_handler.files_in_prompt = json.loads(
             config["files"]
         )
-        AGENT.memory_manager.prompt_handler.set_files_in_prompt()
-        AGENT.memory_manager.prompt_handler.set_system()
+        CODEBASE.focus_paths = AGENT.memory_manager.prompt_handler.files_in_prompt
+        AGENT.memory_manager.prompt_handler.tree = await CODEBASE.atree()
+        await AGENT.memory_manager.prompt_handler.aset_files_in_prompt()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    CODEBASE.stop_watcher()
+    AGENT.memory_manager.close()
+    CODEBASE.conn.close()
 
 
 @app.post("/message_streaming")
@@ -91,16 +93,23 @@ async def get_functions():
 
 @app.get("/get_messages")
 async def get_messages(chatbox: bool | None = None):
-    return {"messages": AGENT.memory_manager.get_messages(chat_box=chatbox)[1:]}
+    messages = await AGENT.memory_manager.aget_messages(chat_box=chatbox)
+    return {"messages": messages[1:]}
 
 
 @app.get("/get_summaries")
 async def get_summaries(reset: bool | None = None):
     if reset:
-        CODEBASE._update_files_and_embeddings()
-    cur = CODEBASE.conn.cursor()
-    cur.execute("SELECT DISTINCT file_path, summary, token_count FROM files")
-    results = cur.fetchall()
+        await CODEBASE.arescan()
+
+    def read_summaries():
+        CODEBASE.recount_tokens()
+        with read_cursor(CODEBASE.conn, CODEBASE.write_lock, CODEBASE.cur) as cur:
+            cur.execute("SELECT DISTINCT file_path, summary, token_count FROM files")
+            return cur.fetchall()
+
+    # Stale token counts are recomputed first, which writes
+    results = await run_blocking(CODEBASE.conn, read_summaries, kind="write")
     if len(results) == 0:
         return JSONResponse(status_code=400, content={"error": "No summaries found"})
     root_path = CODEBASE.directory
@@ -118,6 +127,35 @@ async def get_summaries(reset: bool | None = None):
     return result
 
 
+@app.get("/get_relevant_files")
+async def get_relevant_files(query: str, k: int = 10):
+    results = await CODEBASE.asearch_similar(query, k)
+    return {
+        "files": [
+            {
+                "file_path": os.path.relpath(file_path, CODEBASE.directory),
+                "score": score,
+            }
+            for file_path, score in results
+        ]
+    }
+
+
+@app.get("/search_files")
+async def search_files(query: str, k: int = 20):
+    results = await CODEBASE.asearch(query, k)
+    return {
+        "files": [
+            {
+                "file_path": os.path.relpath(result["file_path"], CODEBASE.directory),
+                "score": result["score"],
+                "snippet": result["snippet"],
+            }
+            for result in results
+        ]
+    }
+
+
 @app.post("/set_files_in_prompt")
 async def set_files_in_prompt(input: dict):
     """Sets the files to be included in the prompt.
@@ -133,18 +171,12 @@ async def set_files_in_prompt(input: dict):
         JSONResponse: A response with a 200 status code on success, or an error message on failure.
     """
     files = [file for file in input.get("files", None)]
-    AGENT.memory_manager.cur.execute(
-        """
-        INSERT INTO config (field, value, last_updated)
-        VALUES (?, ?, CURRENT_TIMESTAMP)
-        ON CONFLICT(field)
-        DO UPDATE SET value = excluded.value, last_updated = excluded.last_updated
-        WHERE field = 'files';
-        """,
-        ("files", json.dumps(files)),
-    )
+    await AGENT.memory_manager.aset_config("files", json.dumps(files))
     AGENT.memory_manager.prompt_handler.files_in_prompt = files
-    AGENT.memory_manager.prompt_handler.set_files_in_prompt()
+    # Keep the directories of the selected files expanded in the budgeted tree
+    CODEBASE.focus_paths = files
+    AGENT.memory_manager.prompt_handler.tree = await CODEBASE.atree()
+    await AGENT.memory_manager.prompt_handler.aset_files_in_prompt()
     return JSONResponse(status_code=200, content={})
 
 
@@ -157,17 +189,9 @@ async def get_files_in_prompt():
 async def set_model(input: dict):
     model = input.get("model")
     if model:
-        AGENT.memory_manager.cur.execute(
-            """
-            INSERT INTO config (field, value, last_updated)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(field)
-            DO UPDATE SET value = excluded.value, last_updated = excluded.last_updated
-            WHERE field = 'model';
-            """,
-            ("model", model),
-        )
-        AGENT.GPT_MODEL = model
+        await AGENT.memory_manager.aset_config("model", model)
+        # Stored token counts are recomputed for the new tokenizer when read next
+        AGENT.set_model(model)
         return JSONResponse(status_code=200, content={})
     else:
         return JSONResponse(status_code=400, content={"error": "No model was provided"})
@@ -180,24 +204,25 @@ async def get_model():
 
 @app.get("/get_max_message_tokens")
 async def get_max_message_tokens():
-    max_message_tokens = AGENT.memory_manager.cur.execute(
-        """
-        SELECT value FROM config
-        WHERE field = 'max_message_tokens';
-        """
-    ).fetchone()
-    return {"max_message_tokens": max_message_tokens}
+    config = await AGENT.memory_manager.aget_config()
+    max_message_tokens = config.get("max_message_tokens")
+    # Returned as a one-column row, the shape the frontend reads
+    return {
+        "max_message_tokens": (
+            None if max_message_tokens is None else [max_message_tokens]
+        )
+    }
 
 
 @app.post("/set_directory")
 async def set_directory(input: dict):
     directory = input.get("directory")
     try:
-        CODEBASE.set_directory(directory)
+        await CODEBASE.aset_directory(directory)
         AGENT.memory_manager.project_directory = directory
-        AGENT.memory_manager.prompt_handler.tree = CODEBASE.tree()
+        AGENT.memory_manager.prompt_handler.tree = await CODEBASE.atree()
         AGENT.memory_manager.prompt_handler.directory = directory
-        AGENT.memory_manager.prompt_handler.set_system()
+        await AGENT.memory_manager.prompt_handler.aset_system()
         return JSONResponse(status_code=200, content={"message": "Success"})
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -206,7 +231,7 @@ async def set_directory(input: dict):
 
 @app.get("/get_directory")
 async def get_directory():
-    return {"directory": CODEBASE.get_directory()}
+    return {"directory": await CODEBASE.aget_directory()}
 
 
 @app.get("/get_home")
@@ -220,17 +245,7 @@ async def get_home():
 async def set_max_message_tokens(input: dict):
     max_message_tokens = input.get("max_message_tokens")
     try:
-        AGENT.memory_manager.cur.execute(
-            """
-            INSERT INTO config (field, value, last_updated)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(field)
-            DO UPDATE SET value = excluded.value, last_updated = excluded.last_updated
-            WHERE field = 'max_message_tokens';
-            """,
-            ("max_message_tokens", max_message_tokens),
-        )
-        AGENT.memory_manager.conn.commit()
+        await AGENT.memory_manager.aset_config("max_message_tokens", max_message_tokens)
         AGENT.memory_manager.max_tokens = max_message_tokens
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -254,7 +269,10 @@ async def execute_ops(input: dict):
     ops_to_execute = [op for op in AGENT.ops_to_execute if op.id in op_id]
     if len(ops_to_execute) > 0:
         try:
-            AGENT.execute_ops(ops_to_execute)
+            # Edits files and resolves symbols through the codebase, off the event loop
+            await run_blocking(
+                CODEBASE.conn, AGENT.execute_ops, ops_to_execute, kind=None
+            )
             print("Ops to execute: ", AGENT.ops_to_execute[0].to_json())
         except Exception as e:
             print(f"An error occurred: {e}")
@@ -319,11 +337,12 @@ async def save_prompt(input: dict):
     logger.warn(input)
     prompt = input.get("prompt")
     prompt_name = input.get("prompt_name")
-    if AGENT.memory_manager.prompt_handler.get_prompt(prompt_name):
-        AGENT.memory_manager.prompt_handler.update_prompt(prompt_name, prompt)
+    prompt_handler = AGENT.memory_manager.prompt_handler
+    if await prompt_handler.aget_prompt(prompt_name):
+        await prompt_handler.aupdate_prompt(prompt_name, prompt)
     else:
-        AGENT.memory_manager.prompt_handler.create_prompt(prompt_name, prompt)
-    AGENT.memory_manager.prompt_handler.set_system({"system_prompt": prompt})
+        await prompt_handler.acreate_prompt(prompt_name, prompt)
+    await prompt_handler.aset_system({"system_prompt": prompt})
     AGENT.memory_manager.prompt_handler.name = prompt_name
     return JSONResponse(status_code=200, content={})
 
@@ -344,7 +363,7 @@ async def system_prompt():
 
 @app.get("/list_prompts")
 async def list_prompts():
-    prompts = AGENT.memory_manager.prompt_handler.list_prompts()
+    prompts = await AGENT.memory_manager.prompt_handler.alist_prompts()
     return {"prompts": prompts}
 
 
@@ -354,7 +373,7 @@ async def delete_prompt(input: dict):
     prompt_id = input.get("prompt_id", None)
     prompt_name = input.get("prompt_name", None)
     try:
-        AGENT.memory_manager.prompt_handler.delete_prompt(prompt_id)
+        await AGENT.memory_manager.prompt_handler.adelete_prompt(prompt_id)
     except Exception as e:
         return JSONResponse(status_code=400, content={"error": str(e)})
     return JSONResponse(status_code=200, content={})
@@ -0,0 +1,329 @@
+"""
+This module defines the ConversationCompactor, which folds the turns that fall out of MemoryManager's message window into tiered digests instead of dropping them. Turns are folded, oldest first, into a digest of the current session; a session that ends (a gap of more than ``session_gap_minutes`` between turns) is folded into the digest of its day, and a day that ends into the digest of the project. The digests are stored in the ``{table}_digests`` table created by the memory migrations and placed at the head of the context, each kept under ``digest_tokens`` by the summarizer, so the prompt stays bounded however long the conversation runs. Folding runs in a background thread, requested by MemoryManager.get_messages only when the oldest turn of the window moved past the turns already folded, and every round folds at most ``fold_limit`` turns past a stored cursor, so a new turn costs a constant amount of work and none of it on the request path.
+"""
+
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional
+
+from database.connection import read_cursor
+
+# Head of the context, broadest first
+TIERS = ("project", "day", "session")
+DIGEST_TITLES = {
+    "project": "Earlier in this project",
+    "day": "Earlier sessions",
+    "session": "Earlier in this session",
+}
+
+
+class Digest(NamedTuple):
+    """The digest of one period of a tier."""
+
+    tier: str
+    period: str
+    text: str
+    message_count: int
+    # interaction_index of the newest turn folded in
+    through_index: str
+
+
+class ConversationCompactor:
+    """
+    Folds old turns of a MemoryManager into session, day and project digests.
+
+    Attributes:
+        memory_manager (MemoryManager): Owns the messages, its connection and lock are used.
+        summarizer: Any object with a ``summarize(text) -> str`` method, shortens digests over budget.
+        digest_tokens (int): The token budget of each digest.
+        fold_limit (int): The maximum number of turns folded per call to ``compact``.
+        session_gap (timedelta): A pause longer than this between turns starts a new session.
+    """
+
+    def __init__(
+        self,
+        memory_manager,
+        summarizer,
+        digest_tokens: int = 150,
+        fold_limit: int = 4,
+        session_gap_minutes: int = 30,
+    ):
+        self.memory_manager = memory_manager
+        self.summarizer = summarizer
+        self.digest_tokens = digest_tokens
+        self.fold_limit = fold_limit
+        self.session_gap = timedelta(minutes=session_gap_minutes)
+        self.table = f"{memory_manager.memory_table_name}_digests"
+        # The current digest of each tier, per project, loaded from the table once
+        self._digests: Dict[str, Dict[str, Digest]] = {}
+        self._lock = threading.RLock()
+        # Per project, the window start up to which every older turn has been folded
+        self._caught_up: Dict[str, str] = {}
+        # Per project, the newest (project_directory, before) waiting for the worker
+        self._requests: Dict[str, tuple] = {}
+        self._busy = False
+        self._idle = threading.Condition(self._lock)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def digests(self, project_directory: Optional[str]) -> List[Digest]:
+        """
+        Returns the current digests of a project, broadest tier first.
+
+        Args:
+            project_directory (Optional[str]): The project.
+
+        Returns:
+            List[Digest]: The project, day and session digests that exist.
+        """
+        current = self._current(project_directory or "")
+        return [current[tier] for tier in TIERS if tier in current]
+
+    def render(self, project_directory: Optional[str], max_tokens: int) -> str:
+        """
+        Renders the digests for the head of the context within a token budget.
+
+        Broader tiers are left out first when the digests do not fit.
+
+        Args:
+            project_directory (Optional[str]): The project.
+            max_tokens (int): The token budget of the rendered digests.
+
+        Returns:
+            str: The rendered digests, empty when there are none.
+        """
+        tokenizer = self.memory_manager.tokenizer
+        digests = self.digests(project_directory)
+        while digests:
+            rendered = "\n\n".join(
+                f"{DIGEST_TITLES[digest.tier]}:\n{digest.text}" for digest in digests
+            )
+            if tokenizer.count(rendered) <= max_tokens:
+                return rendered
+            digests = digests[1:]
+        return ""
+
+    def request(self, project_directory: Optional[str], before: str) -> bool:
+        """
+        Asks the background worker to fold the turns that left the message window.
+
+        Nothing is scheduled while the window starts where it did when the project was last
+        caught up, so a turn that pushed nothing out of the window costs no query.
+
+        Args:
+            project_directory (Optional[str]): The project.
+            before (str): The interaction_index of the oldest turn in the window.
+
+        Returns:
+            bool: True if folding was scheduled.
+        """
+        project = project_directory or ""
+        with self._lock:
+            if before <= self._caught_up.get(project, ""):
+                return False
+            self._requests[project] = (project_directory, before)
+            self._start()
+        self._wake.set()
+        return True
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until the requested folding is done.
+
+        Args:
+            timeout (Optional[float]): The maximum number of seconds to wait.
+
+        Returns:
+            bool: False if the timeout expired first.
+        """
+        with self._idle:
+            return self._idle.wait_for(
+                lambda: not self._requests and not self._busy, timeout
+            )
+
+    def stop(self) -> None:
+        """Stops the background worker, a round in progress is finished first."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def compact(self, project_directory: Optional[str], before: str) -> int:
+        """
+        Folds up to ``fold_limit`` turns older than the message window into the digests.
+
+        Turns still queued by the write-behind writer are left for a later round rather
+        than flushed, they are the newest ones and rarely older than the window.
+
+        Args:
+            project_directory (Optional[str]): The project.
+            before (str): The interaction_index of the oldest turn in the window, turns
+                before it are no longer sent to the model.
+
+        Returns:
+            int: The number of turns folded.
+        """
+        project = project_directory or ""
+        manager = self.memory_manager
+        pending = manager.oldest_pending_index()
+        if pending is not None:
+            before = min(before, pending)
+        with self._lock:
+            current = dict(self._current(project))
+            cursor = max(
+                (digest.through_index for digest in current.values()), default=""
+            )
+            with read_cursor(manager.conn, manager.lock, manager.cur) as cur:
+                cur.execute(
+                    f"""
+                    SELECT interaction_index, role, COALESCE(summarized_message, content)
+                    FROM {manager.memory_table_name}
+                    WHERE project_directory IS ? AND interaction_index > ? AND interaction_index < ?
+                    ORDER BY interaction_index
+                    LIMIT ?
+                    """,
+                    (project_directory, cursor, before, self.fold_limit),
+                )
+                turns = cur.fetchall()
+            if len(turns) < self.fold_limit:
+                # Every turn before the window has been folded once these are
+                self._caught_up[project] = max(before, self._caught_up.get(project, ""))
+            if not turns:
+                return 0
+            changed = {}
+            for interaction_index, role, content in turns:
+                session = current.get("session")
+                if session is not None and self._new_session(
+                    session.through_index, interaction_index
+                ):
+                    changed.update(self._close_session(current, session))
+                    session = None
+                addition = f"{role}: {content}"
+                session = Digest(
+                    "session",
+                    session.period if session else interaction_index,
+                    self._merge(session.text if session else "", addition),
+                    (session.message_count if session else 0) + 1,
+                    interaction_index,
+                )
+                current["session"] = session
+                changed[("session", session.period)] = session
+            self._save(project, changed.values())
+            self._digests[project] = current
+        return len(turns)
+
+    def clear(self) -> None:
+        """Forgets the loaded digests, they are read from the table again when needed."""
+        with self._lock:
+            self._digests.clear()
+            self._caught_up.clear()
+
+    def _start(self) -> None:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._loop, name="memory-compactor", daemon=True
+            )
+            self._thread.start()
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait()
+            self._wake.clear()
+            while not self._stop.is_set():
+                with self._lock:
+                    if not self._requests:
+                        break
+                    _, (project_directory, before) = self._requests.popitem()
+                    self._busy = True
+                try:
+                    self.compact(project_directory, before)
+                except Exception as e:
+                    print("Failed to compact messages: ", str(e))
+                finally:
+                    with self._idle:
+                        self._busy = False
+                        self._idle.notify_all()
+
+    def _close_session(self, current: Dict[str, Digest], session: Digest) -> dict:
+        # Folds a finished session into its day, and a finished day into the project
+        changed = {}
+        day_period = session.period[:10]
+        day = current.get("day")
+        if day is not None and day.period != day_period:
+            project = current.get("project")
+            project = Digest(
+                "project",
+                "",
+                self._merge(project.text if project else "", day.text),
+                (project.message_count if project else 0) + day.message_count,
+                day.through_index,
+            )
+            current["project"] = changed[("project", "")] = project
+            day = None
+        day = Digest(
+            "day",
+            day_period,
+            self._merge(day.text if day else "", session.text),
+            (day.message_count if day else 0) + session.message_count,
+            session.through_index,
+        )
+        current["day"] = changed[("day", day_period)] = day
+        del current["session"]
+        return changed
+
+    def _merge(self, digest: str, addition: str) -> str:
+        merged = f"{digest}\n{addition}" if digest else addition
+        if self.memory_manager.tokenizer.count(merged) > self.digest_tokens:
+            merged = self.summarizer.summarize(merged)
+        return merged
+
+    def _new_session(self, previous_index: str, interaction_index: str) -> bool:
+        try:
+            gap = datetime.fromisoformat(interaction_index) - datetime.fromisoformat(
+                previous_index
+            )
+        except (TypeError, ValueError):
+            return False
+        return gap > self.session_gap
+
+    def _current(self, project: str) -> Dict[str, Digest]:
+        with self._lock:
+            if project not in self._digests:
+                manager = self.memory_manager
+                with read_cursor(manager.conn, manager.lock, manager.cur) as cur:
+                    # SQLite takes the bare columns from the row holding the MAX
+                    cur.execute(
+                        f"""
+                        SELECT tier, MAX(period), digest, message_count, through_index
+                        FROM {self.table}
+                        WHERE project_directory = ?
+                        GROUP BY tier
+                        """,
+                        (project,),
+                    )
+                    rows = cur.fetchall()
+                self._digests[project] = {row[0]: Digest(*row) for row in rows}
+            return self._digests[project]
+
+    def _save(self, project: str, digests) -> None:
+        manager = self.memory_manager
+        with manager.lock:
+            try:
+                manager.cur.executemany(
+                    f"""
+                    INSERT INTO {self.table}
+                    (project_directory, tier, period, digest, message_count, through_index, last_updated)
+                    VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(project_directory, tier, period)
+                    DO UPDATE SET digest = excluded.digest, message_count = excluded.message_count,
+                        through_index = excluded.through_index, last_updated = excluded.last_updated
+                    """,
+                    [(project, *digest) for digest in digests],
+                )
+                manager.conn.commit()
+            except Exception:
+                manager.conn.rollback()
+                raise
@@ -0,0 +1,98 @@
+"""
+This module defines the ConversationCache class, which keeps the recent messages of one project in memory so MemoryManager can assemble the message window without querying the memory table on every turn. The cache holds the newest messages with their token counts and knows whether it reaches back to the start of the conversation; a window it cannot answer on its own is read from the database and loaded back into it.
+"""
+
+import threading
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+# (role, full_content, content, tokens, interaction_index), as read from the memory table
+CachedMessage = Tuple[str, str, str, Optional[int], str]
+
+MAX_CACHED_MESSAGES = 2000
+
+
+class ConversationCache:
+    """
+    The newest messages of a project, oldest first.
+
+    Attributes:
+        max_messages (int): The number of messages kept, older ones are dropped.
+        complete (bool): True when no message older than the cached ones exists.
+    """
+
+    def __init__(self, max_messages: int = MAX_CACHED_MESSAGES):
+        self.max_messages = max_messages
+        self.complete = False
+        self._messages: Deque[CachedMessage] = deque()
+        self._lock = threading.Lock()
+
+    def window(self, max_tokens: int) -> Optional[List[CachedMessage]]:
+        """
+        Returns the newest messages whose running token total fits a budget.
+
+        Args:
+            max_tokens (int): The token budget of the window.
+
+        Returns:
+            Optional[List[CachedMessage]]: The messages newest first, or None when older
+                messages that are not cached could still fit.
+        """
+        window = []
+        total = 0
+        with self._lock:
+            for message in reversed(self._messages):
+                total += message[3] or 0
+                if total > max_tokens:
+                    return window
+                window.append(message)
+            return window if self.complete else None
+
+    def append(self, message: CachedMessage) -> None:
+        with self._lock:
+            self._messages.append(message)
+            if len(self._messages) > self.max_messages:
+                self._messages.popleft()
+                self.complete = False
+
+    def discard(self, interaction_index: str) -> None:
+        """Removes a cached message, e.g. one that could not be stored."""
+        with self._lock:
+            self._messages = deque(
+                message for message in self._messages if message[4] != interaction_index
+            )
+
+    def load(self, newest_first: Iterable[CachedMessage], complete: bool) -> None:
+        """
+        Replaces the cached messages with ones read from the database.
+
+        Args:
+            newest_first (Iterable[CachedMessage]): The newest messages of the project, newest first.
+            complete (bool): Whether they reach back to the first message.
+        """
+        messages = list(newest_first)
+        with self._lock:
+            self._messages = deque(reversed(messages[: self.max_messages]))
+            self.complete = complete and len(messages) <= self.max_messages
+
+    def update_summaries(self, summaries: Dict[str, Tuple[str, int]]) -> None:
+        """
+        Replaces the content of cached messages with their summaries.
+
+        Args:
+            summaries (Dict[str, Tuple[str, int]]): (summary, tokens) keyed by interaction_index.
+        """
+        with self._lock:
+            self._messages = deque(
+                (
+                    message[:2] + summaries[message[4]] + message[4:]
+                    if message[4] in summaries
+                    else message
+                )
+                for message in self._messages
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._messages.clear()
+            self.complete = False
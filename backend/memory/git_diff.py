@@ -0,0 +1,322 @@
+"""
+This module defines the GitDiffCache, which keeps the ``git diff main`` output SystemPromptHandler attaches to the system prompt, so the prompt can be rebuilt without spawning git every time. An entry is keyed on the state of the worktree: the commit HEAD points to, the commit of the base branch, the modification time of the index, and the state of the worktree files: a version bumped by the file watcher's change notifications together with the stats of the files ``git ls-files`` reports as modified or untracked, so files the watcher does not follow are covered too without walking the whole worktree. The stats are read on the caller's thread only for the first diff of a directory; afterwards they are re-read in a background thread at most once every ``stat_interval_ms``. While the key is unchanged the cached diff is served as is; once it changes the diff is recomputed in a background thread and the previous one is served until the new one is ready. Writes the app makes itself are announced with ``notify_changed(directory, wait=True)``, which recomputes the diff before returning so the next prompt shows them.
+"""
+
+import os
+import subprocess
+import threading
+import time
+from typing import Dict, Iterable, NamedTuple, Optional, Set
+
+# Directories left out of the untracked files whose stats are read
+DEFAULT_IGNORE_DIRS = (".git", "node_modules", ".next", ".venv", "__pycache__")
+# Recomputations in a row before a worktree that keeps changing is left to the next get
+MAX_REFRESH_ROUNDS = 3
+# How often the worktree is checked for changes the watcher does not report
+STAT_INTERVAL_MS = 2000
+
+
+def git_diff(directory: str, base: str = "main") -> subprocess.CompletedProcess:
+    """
+    Runs ``git diff`` of a worktree against a base branch.
+
+    Args:
+        directory (str): A directory inside the worktree.
+        base (str): The branch or commit to compare with.
+
+    Returns:
+        subprocess.CompletedProcess: The finished git process, the diff is its stdout.
+    """
+    command = ["git", "-C", directory, "diff", base]
+    return subprocess.run(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+
+
+def find_git_dir(directory: str) -> Optional[str]:
+    """
+    Finds the git directory of the worktree a directory belongs to.
+
+    Args:
+        directory (str): A directory inside the worktree.
+
+    Returns:
+        Optional[str]: The git directory, None when the directory is not in a repository.
+    """
+    current = os.path.abspath(directory)
+    while True:
+        dot_git = os.path.join(current, ".git")
+        if os.path.isdir(dot_git):
+            return dot_git
+        if os.path.isfile(dot_git):
+            # Linked worktrees and submodules point to their git directory
+            with open(dot_git) as f:
+                content = f.read().strip()
+            if content.startswith("gitdir:"):
+                return os.path.join(current, content[len("gitdir:") :].strip())
+        parent = os.path.dirname(current)
+        if parent == current:
+            return None
+        current = parent
+
+
+def read_ref(git_dir: str, ref: str) -> Optional[str]:
+    """
+    Reads the commit a ref points to without running git.
+
+    Args:
+        git_dir (str): The git directory.
+        ref (str): "HEAD", a full ref such as "refs/heads/main", or a branch name.
+
+    Returns:
+        Optional[str]: The commit, None when the ref does not exist.
+    """
+    candidates = [ref] if ref == "HEAD" or ref.startswith("refs/") else []
+    candidates += [f"refs/heads/{ref}", f"refs/tags/{ref}"]
+    for name in candidates:
+        for root in _ref_roots(git_dir):
+            try:
+                with open(os.path.join(root, name)) as f:
+                    value = f.read().strip()
+            except OSError:
+                continue
+            if value.startswith("ref:"):
+                return read_ref(git_dir, value[len("ref:") :].strip())
+            return value
+        packed = _packed_ref(git_dir, name)
+        if packed:
+            return packed
+    return None
+
+
+def _ref_roots(git_dir: str):
+    # A linked worktree keeps HEAD itself and shares the branches of the main repository
+    yield git_dir
+    try:
+        with open(os.path.join(git_dir, "commondir")) as f:
+            yield os.path.join(git_dir, f.read().strip())
+    except OSError:
+        pass
+
+
+def _packed_ref(git_dir: str, name: str) -> Optional[str]:
+    for root in _ref_roots(git_dir):
+        try:
+            with open(os.path.join(root, "packed-refs")) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] == name:
+                        return parts[0]
+        except OSError:
+            continue
+    return None
+
+
+class DiffKey(NamedTuple):
+    """The worktree state a diff was computed for."""
+
+    head: Optional[str]
+    base: Optional[str]
+    index_mtime: Optional[int]
+    worktree: object
+
+
+class GitDiffCache:
+    """
+    Caches the diff of worktrees against a base branch.
+
+    Attributes:
+        base (str): The branch the worktree is compared with.
+        ignore_dirs (Set[str]): Directories whose untracked files are not checked.
+        stat_interval_ms (int): The least time between two checks of a worktree's files.
+    """
+
+    def __init__(
+        self,
+        base: str = "main",
+        ignore_dirs: Iterable[str] = DEFAULT_IGNORE_DIRS,
+        stat_interval_ms: int = STAT_INTERVAL_MS,
+    ):
+        self.base = base
+        self.ignore_dirs: Set[str] = set(ignore_dirs)
+        self.stat_interval_ms = stat_interval_ms
+        # directory -> (key, diff)
+        self._entries: Dict[str, tuple] = {}
+        # Worktree versions of the directories whose changes are reported by a watcher
+        self._versions: Dict[str, int] = {}
+        # directory -> (stats of the changed files, monotonic time they were read)
+        self._stats: Dict[str, tuple] = {}
+        self._refreshing: Dict[str, threading.Thread] = {}
+        # The directory of the last get, the watcher follows the same project
+        self._directory: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def get(self, directory: Optional[str], wait: bool = False) -> str:
+        """
+        Returns the diff of a worktree against the base branch.
+
+        The first diff of a directory is computed right away. Later ones are served from
+        the cache, and when the worktree changed since, recomputed in the background while
+        the previous diff is returned. Changes the watcher does not report are noticed once
+        the background check of the worktree's files has run.
+
+        Args:
+            directory (Optional[str]): A directory inside the worktree.
+            wait (bool): Check the worktree's files and recompute a changed diff before
+                returning instead of in the background.
+
+        Returns:
+            str: The diff, empty when there is none or the directory is not a repository.
+        """
+        if not directory:
+            return ""
+        directory = os.path.abspath(directory)
+        with self._lock:
+            if directory != self._directory:
+                # The watcher moved with the project, changes elsewhere go unreported
+                self._versions.clear()
+                self._directory = directory
+        key = self.key(directory, restat=wait)
+        with self._lock:
+            entry = self._entries.get(directory)
+        if entry is not None and entry[0] == key:
+            if self._stat_expired(directory):
+                self._refresh(directory)
+            return entry[1]
+        if entry is None or wait:
+            return self._compute(directory, key)
+        self._refresh(directory)
+        return entry[1]
+
+    def notify_changed(self, directory: str, wait: bool = False) -> None:
+        """
+        Records that files of a worktree changed and recomputes its diff.
+
+        The notification is picked up right away, changes to files the watcher does not
+        follow are left to the next check of the worktree's files.
+
+        Args:
+            directory (str): The directory the file watcher runs on, or the app wrote to.
+            wait (bool): Recompute the diff before returning instead of in the background,
+                for writes whose diff the next prompt must show.
+        """
+        directory = os.path.abspath(directory)
+        with self._lock:
+            self._versions[directory] = self._versions.get(directory, 0) + 1
+            cached = directory in self._entries
+            thread = self._refreshing.get(directory)
+        if wait:
+            # A refresh started before the write would store its older diff over ours
+            if thread is not None:
+                thread.join()
+            self._compute(directory, self.key(directory, restat=True))
+        elif cached:
+            self._refresh(directory)
+
+    def key(self, directory: str, restat: bool = False) -> DiffKey:
+        """
+        Reads the state of a worktree that its diff depends on, without running git.
+
+        Args:
+            directory (str): An absolute directory inside the worktree.
+            restat (bool): Re-read the stats of the worktree's files even if they were read before.
+
+        Returns:
+            DiffKey: The state.
+        """
+        git_dir = find_git_dir(directory)
+        if git_dir is None:
+            return DiffKey(None, None, None, None)
+        try:
+            index_mtime = os.stat(os.path.join(git_dir, "index")).st_mtime_ns
+        except OSError:
+            index_mtime = None
+        with self._lock:
+            version = self._versions.get(directory, 0)
+            stats = self._stats.get(directory)
+        if stats is None or restat:
+            stats = (self._stat_worktree(directory), time.monotonic())
+            with self._lock:
+                self._stats[directory] = stats
+        return DiffKey(
+            read_ref(git_dir, "HEAD"),
+            read_ref(git_dir, self.base),
+            index_mtime,
+            (version, stats[0]),
+        )
+
+    def clear(self) -> None:
+        """Drops every cached diff."""
+        with self._lock:
+            self._entries.clear()
+            self._stats.clear()
+
+    def _compute(self, directory: str, key: DiffKey) -> str:
+        try:
+            diff = git_diff(directory, self.base).stdout or ""
+        except Exception as e:
+            print(f"Failed to diff {directory} against {self.base}: {e}")
+            diff = ""
+        with self._lock:
+            self._entries[directory] = (key, diff)
+        return diff
+
+    def _refresh(self, directory: str) -> None:
+        with self._lock:
+            thread = self._refreshing.get(directory)
+            if thread is not None and thread.is_alive():
+                return
+            thread = threading.Thread(
+                target=self._refresh_loop,
+                args=(directory,),
+                name="git-diff-refresh",
+                daemon=True,
+            )
+            self._refreshing[directory] = thread
+        thread.start()
+
+    def _refresh_loop(self, directory: str) -> None:
+        # Changes made while git ran are picked up by another round
+        for _ in range(MAX_REFRESH_ROUNDS):
+            key = self.key(directory, restat=True)
+            with self._lock:
+                entry = self._entries.get(directory)
+            if entry is not None and entry[0] == key:
+                return
+            self._compute(directory, key)
+
+    def _stat_expired(self, directory: str) -> bool:
+        with self._lock:
+            stats = self._stats.get(directory)
+        return (
+            stats is None
+            or (time.monotonic() - stats[1]) * 1000 >= self.stat_interval_ms
+        )
+
+    def _stat_worktree(self, directory: str) -> Optional[tuple]:
+        # Only files git reports as modified or untracked can make the diff differ, the
+        # rest of the worktree is checked by git against the stats kept in its index
+        command = ["git", "-C", directory, "ls-files", "-z", "-m", "-o"]
+        command += ["--exclude-standard"]
+        command += [f"--exclude={name}" for name in sorted(self.ignore_dirs)]
+        # The whole worktree, not only the part under the directory
+        command += ["--", ":/"]
+        try:
+            result = subprocess.run(
+                command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+            )
+        except OSError as e:
+            print(f"Failed to list the changed files of {directory}: {e}")
+            return None
+        if result.returncode != 0:
+            return None
+        stats = []
+        # Files with merge conflicts are listed once per stage
+        for path in sorted(set(result.stdout.split("\0")) - {""}):
+            try:
+                stat = os.stat(os.path.join(directory, path))
+            except OSError:
+                stats.append((path, None, None))
+                continue
+            stats.append((path, stat.st_size, stat.st_mtime_ns))
+        return tuple(stats)
@@ -2,18 +2,52 @@
 This module contains the implementation of the memory management system for the backend. It includes the `WorkingContext` class, which is responsible for managing the working context of the user, including the database connection, project directory, and interaction with the OpenAI API client. The module also handles the creation of necessary database tables and provides methods for managing the working context data within the database. Additionally, it integrates with other components such as the system prompt handler and the OpenAI API client to facilitate the generation and management of system prompts and responses.
 """
 
-import tiktoken
-from typing import Optional, List
-from datetime import datetime
+import sqlite3
+import threading
+from typing import Dict, Optional, List, Tuple
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from memory.system_prompt_handler import SystemPromptHandler
 import instructor
 from openai import AsyncOpenAI
 
 from memory.working_context import WorkingContext
+from memory.conversation_cache import ConversationCache
+from memory.prompt_snapshots import PromptSnapshotStore, prompt_hash
+from database.connection import read_cursor, run_blocking, write_lock
+from database.migrations import Migration, run_migrations
+from database.tokenizer import DEFAULT_MODEL, get_tokenizer
 
 CLIENT = instructor.patch(AsyncOpenAI())
 
+# One page of a project's messages older than a given interaction_index, newest first.
+# The (project_directory, interaction_index) index created in the memory migrations serves
+# it as a range walk, so reading the window costs the window, not the whole history
+MESSAGE_PAGE_QUERY = """
+    SELECT role,
+        content as full_content,
+        COALESCE(summarized_message, content) as content,
+        COALESCE(summarized_message_tokens, content_tokens) as tokens,
+        interaction_index
+    FROM {table}
+    WHERE project_directory = ? AND interaction_index < ?
+    ORDER BY interaction_index DESC
+    LIMIT ?;
+"""
+INSERT_MESSAGE_QUERY = """
+    INSERT INTO {table}
+    (interaction_index, role, content, content_tokens, summarized_message, summarized_message_tokens, project_directory, is_function_call, system_prompt_hash, token_model)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+"""
+# Used by the migration that moved the prompts out of the message rows, as full copies
+INSERT_PROMPT_QUERY = """
+    INSERT OR IGNORE INTO {table}_prompt_snapshots (prompt_hash, prompt) VALUES (?, ?);
+"""
+# Rows read by the first page of the window, later pages double in size
+MESSAGE_PAGE_SIZE = 32
+# Sorts after every ISO timestamp stored in interaction_index
+NEWEST_INTERACTION = "~"
+
 
 class MemoryManager:
     def __init__(
@@ -24,10 +58,17 @@ class MemoryManager:
         max_tokens: int = 1000,
         table_name: str = "default",
         db_connection=None,
+        write_behind: bool = False,
+        batch_size: int = 100,
+        flush_interval_ms: int = 250,
     ) -> None:
         load_dotenv()
         self.project_directory = None
         self.model = model
+        # Counts content_tokens, rows counted by another tokenizer are recounted lazily
+        self.tokenizer = get_tokenizer(model)
+        # (project_directory, tokenizer name) pairs whose rows are known to be up to date
+        self._recounted = set()
         self.max_tokens = max_tokens
         self.system = None
         self.identity = (
@@ -43,6 +84,31 @@ class MemoryManager:
             raise ValueError("db_connection cannot be None")
         self.cur = self.conn.cursor()
         self.cur = self.conn.cursor()
+        # Shared with the other components when the connection is a ConnectionManager
+        self.lock = write_lock(self.conn)
+        # Recent messages per project, the message window is served from here when it can be
+        self._conversations: Dict[Optional[str], ConversationCache] = {}
+        # With write_behind, add_message only queues its row and a background thread inserts
+        # the queue every flush_interval_ms, or sooner once batch_size rows are waiting
+        self.write_behind = write_behind
+        self.batch_size = batch_size
+        self.flush_interval_ms = flush_interval_ms
+        self._pending_messages: List[tuple] = []
+        # System prompt snapshots of the queued messages, keyed by hash
+        self._pending_prompts: Dict[str, str] = {}
+        # Guards the caches and the queue, taken before ``lock`` when both are needed
+        self._messages_lock = threading.RLock()
+        self._flush_wanted = threading.Event()
+        self._closed = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        # interaction_index is the primary key, turns get strictly increasing timestamps
+        self._last_interaction: Optional[datetime] = None
+        # Set by start_summarizer, fills summarized_message for long messages in the background
+        self.summarizer = None
+        # Set by enable_compaction, folds turns that leave the window into digests
+        self.compactor = None
+        # Set by start_retention, archives the messages the retention policy no longer keeps
+        self.retention = None
         self.working_context = WorkingContext()
         self.prompt_handler = SystemPromptHandler(
             db_connection=db_connection,
@@ -51,6 +117,10 @@ class MemoryManager:
             working_context=self.working_context,
         )
         self.memory_table_name = f"{table_name}_memory"
+        # System prompts stored once per content hash, as deltas against the previous one
+        self.prompt_snapshots = PromptSnapshotStore(
+            f"{self.memory_table_name}_prompt_snapshots"
+        )
         self.prompt_handler.system_table_name = f"{table_name}_system_prompt"
         self.system_table_name = f"{table_name}_system_prompt"
         self.create_tables()
@@ -69,54 +139,20 @@ class MemoryManager:
         Returns:
             List[dict]: A list of dictionaries, each containing the role and content of a message.
         """
-        messages = [{"role": "system", "content": self.prompt_handler.system}]
-
+        system = self.prompt_handler.system
         max_tokens = 30000 if chat_box else self.max_tokens
-        if chat_box:
-            self.cur.execute(
-                f"""
-                with t1 as (
-                    SELECT role,
-                        content as full_content,
-                        COALESCE(summarized_message, content) as content,
-                        COALESCE(summarized_message_tokens, content_tokens) as tokens,
-                        sum(COALESCE(summarized_message_tokens, content_tokens)) OVER (ORDER BY interaction_index DESC) as token_cum_sum
-                    FROM {self.memory_table_name}
-                    WHERE project_directory = ?
-                    ORDER BY interaction_index desc
-                )
-                select role, full_content, content, tokens
-                from t1
-                WHERE token_cum_sum <= ?;
-                """,
-                (
-                    self.project_directory,
-                    max_tokens,
-                ),
-            )
-        else:
-            self.cur.execute(
-                f"""
-                with t1 as (
-                    SELECT role,
-                        content as full_content,
-                        COALESCE(summarized_message, content) as content,
-                        COALESCE(summarized_message_tokens, content_tokens) as tokens,
-                        sum(COALESCE(summarized_message_tokens, content_tokens)) OVER (ORDER BY interaction_index DESC) as token_cum_sum
-                    FROM {self.memory_table_name}
-                    WHERE project_directory = ?
-                    ORDER BY interaction_index desc
-                )
-                select role, full_content, content, tokens
-                from t1
-                WHERE token_cum_sum <= ?;
-                """,
-                (
-                    self.project_directory,
-                    max_tokens,
-                ),
-            )
-        results = self.cur.fetchall()
+        self.recount_tokens()
+        # The chat box shows the stored turns, only the model's context gets the digests
+        compacting = self.compactor is not None and not chat_box
+        if compacting:
+            digests = self.compactor.render(self.project_directory, max_tokens // 2)
+            if digests:
+                system = f"{system}\n\n{digests}"
+                max_tokens -= self.tokenizer.count(digests)
+        messages = [{"role": "system", "content": system}]
+        results = self.get_message_window(max_tokens)
+        if compacting:
+            self.compact(results)
         prev_role = "assistant"
         for result in results[::-1]:
             if prev_role == result[0] or result[2] == "":
@@ -127,6 +163,98 @@ class MemoryManager:
             prev_role = result[0]
         return messages
 
+    def enable_compaction(self, summarizer=None, **kwargs) -> None:
+        """
+        Folds the turns that leave the message window into digests at the head of the context.
+
+        Keyword arguments are passed on to ``ConversationCompactor``.
+
+        Args:
+            summarizer: Shortens digests over budget, any object with a ``summarize(text) -> str`` method. Defaults to a ``TruncatingSummarizer``.
+        """
+        from memory.compaction import ConversationCompactor
+        from memory.summarizer import TruncatingSummarizer
+
+        if summarizer is None:
+            summarizer = TruncatingSummarizer(
+                kwargs.get("digest_tokens", 150), self.tokenizer
+            )
+        self.compactor = ConversationCompactor(self, summarizer, **kwargs)
+
+    def compact(self, window: List[tuple]) -> bool:
+        """
+        Schedules folding of the turns older than the message window into the digests.
+
+        Args:
+            window (List[tuple]): The message window, newest first, as returned by ``get_message_window``.
+
+        Returns:
+            bool: True if turns left the window since the last folding and folding was scheduled.
+        """
+        before = window[-1][4] if window else NEWEST_INTERACTION
+        return self.compactor.request(self.project_directory, before)
+
+    def oldest_pending_index(self) -> Optional[str]:
+        """Returns the interaction_index of the oldest message queued by write-behind, if any."""
+        with self._messages_lock:
+            return self._pending_messages[0][0] if self._pending_messages else None
+
+    def get_message_window(self, max_tokens: int) -> List[tuple]:
+        """
+        Returns the newest messages of the project whose running token total fits a budget.
+
+        The window is served from the project's conversation cache. When the cache does not
+        reach back far enough, queued messages are flushed and the window is read from the
+        database and loaded into the cache.
+
+        Args:
+            max_tokens (int): The token budget of the window.
+
+        Returns:
+            List[tuple]: (role, full_content, content, tokens, interaction_index) rows, newest first.
+        """
+        cache = self._conversation(self.project_directory)
+        window = cache.window(max_tokens)
+        if window is not None:
+            return window
+        with self._messages_lock:
+            self.flush()
+            window, complete = self._read_message_window(max_tokens)
+            cache.load(window, complete)
+        return window
+
+    def _read_message_window(self, max_tokens: int) -> Tuple[List[tuple], bool]:
+        """
+        Reads the message window from the database.
+
+        Walks the messages backwards from the newest in pages and stops at the first one
+        that does not fit, so only the window and at most one page past it are read.
+
+        Args:
+            max_tokens (int): The token budget of the window.
+
+        Returns:
+            Tuple[List[tuple], bool]: The rows newest first, and whether they reach back to the first message.
+        """
+        window = []
+        total = 0
+        before = NEWEST_INTERACTION
+        page_size = MESSAGE_PAGE_SIZE
+        query = MESSAGE_PAGE_QUERY.format(table=self.memory_table_name)
+        with read_cursor(self.conn, self.lock, self.cur) as cur:
+            while True:
+                cur.execute(query, (self.project_directory, before, page_size))
+                rows = cur.fetchall()
+                for row in rows:
+                    total += row[3] or 0
+                    if total > max_tokens:
+                        return window, False
+                    window.append(tuple(row))
+                if len(rows) < page_size:
+                    return window, True
+                before = rows[-1][4]
+                page_size *= 2
+
     def add_message(
         self,
         role: str,
@@ -138,49 +266,328 @@ class MemoryManager:
         """
         Adds a message to the memory database.
 
-        This method inserts a new message into the memory database with the provided role, content, and optional command and function response. It also calculates the timestamp, the total number of tokens in the message, and optionally summarizes the message if the number of tokens exceeds a certain threshold.
+        This method inserts a new message into the memory database with the provided role, content, and optional command and function response. It also calculates the timestamp, the total number of tokens in the message, and optionally summarizes the message if the number of tokens exceeds a certain threshold. The message is added to the project's conversation cache; with write_behind it is queued for the background writer instead of inserted right away.
 
         Args:
             role (str): The role of the message sender (e.g., "user" or "assistant").
             content (str): The content of the message.
             command (Optional[str]): An optional command associated with the message.
             function_response (Optional[str]): An optional function response associated with the message.
+            system_prompt (Optional[str]): The system prompt of the turn, stored once per content hash.
 
         Returns:
             None
         """
-        timestamp = datetime.now().isoformat()
+        timestamp = self._next_interaction_index()
         message_tokens = self.get_total_tokens_in_message(content)
         summary, summary_tokens = (None, None)
         is_function_call = command is not None
+        system_prompt_hash = prompt_hash(system_prompt) if system_prompt else None
+        row = (
+            timestamp,
+            role,
+            content,
+            message_tokens,
+            summary,
+            summary_tokens,
+            self.project_directory,
+            is_function_call,
+            system_prompt_hash,
+            self.tokenizer.name,
+        )
+        cached = (role, content, content, message_tokens, timestamp)
 
-        try:
-            self.cur.execute(
+        with self._messages_lock:
+            if self.write_behind and not self._closed.is_set():
+                self._pending_messages.append(row)
+                if system_prompt_hash:
+                    self._pending_prompts[system_prompt_hash] = system_prompt
+                self._conversation(self.project_directory).append(cached)
+                if len(self._pending_messages) >= self.batch_size:
+                    self._flush_wanted.set()
+                self._start_flusher()
+                return
+            try:
+                with self.lock:
+                    try:
+                        if system_prompt_hash:
+                            self.prompt_snapshots.store(
+                                self.cur, {system_prompt_hash: system_prompt}
+                            )
+                        self.cur.execute(
+                            INSERT_MESSAGE_QUERY.format(table=self.memory_table_name),
+                            row,
+                        )
+                        self.conn.commit()
+                    except Exception:
+                        # The snapshots it remembers as stored were rolled back too
+                        self.prompt_snapshots.forget()
+                        raise
+                self._conversation(self.project_directory).append(cached)
+            except Exception as e:
+                print("Failed to insert data: ", str(e))
+                return
+        self._notify_summarizer([row])
+        return
+
+    def flush(self) -> int:
+        """
+        Inserts every queued message in a single transaction.
+
+        When the batch fails its messages are inserted one at a time. A message the table
+        rejects is dropped from the cache as well, messages that failed for any other reason
+        are queued again for the next flush.
+
+        Returns:
+            int: The number of messages written.
+        """
+        with self._messages_lock:
+            pending, self._pending_messages = self._pending_messages, []
+            prompts, self._pending_prompts = self._pending_prompts, {}
+            if not pending:
+                return 0
+            try:
+                self._insert_messages(pending, prompts)
+                written = pending
+            except Exception as e:
+                print("Failed to insert data: ", str(e))
+                written, requeued = self._insert_one_by_one(pending, prompts)
+                if requeued:
+                    self._pending_messages[:0] = requeued
+                    self._pending_prompts = {**prompts, **self._pending_prompts}
+        self._notify_summarizer(written)
+        return len(written)
+
+    def _insert_messages(self, rows: List[tuple], prompts: Dict[str, str]) -> None:
+        with self.lock:
+            try:
+                self.prompt_snapshots.store(self.cur, prompts)
+                self.cur.executemany(
+                    INSERT_MESSAGE_QUERY.format(table=self.memory_table_name), rows
+                )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                # The snapshots it remembers as stored were rolled back too
+                self.prompt_snapshots.forget()
+                raise
+
+    def _insert_one_by_one(
+        self, rows: List[tuple], prompts: Dict[str, str]
+    ) -> Tuple[List[tuple], List[tuple]]:
+        # Returns the rows written and the rows to queue again
+        written = []
+        for position, row in enumerate(rows):
+            system_prompt_hash = row[8]
+            try:
+                self._insert_messages(
+                    [row],
+                    (
+                        {system_prompt_hash: prompts[system_prompt_hash]}
+                        if system_prompt_hash in prompts
+                        else {}
+                    ),
+                )
+                written.append(row)
+            except sqlite3.IntegrityError as e:
+                print(f"Dropped message {row[0]}: ", str(e))
+                self._conversation(row[6]).discard(row[0])
+            except Exception as e:
+                # The database is unavailable, the rest would fail the same way
+                print("Failed to insert data: ", str(e))
+                return written, rows[position:]
+        return written, []
+
+    def _next_interaction_index(self) -> str:
+        # Turns added within the same microsecond would otherwise share the primary key
+        with self._messages_lock:
+            now = datetime.now()
+            if self._last_interaction is not None and now <= self._last_interaction:
+                now = self._last_interaction + timedelta(microseconds=1)
+            self._last_interaction = now
+            return now.isoformat()
+
+    def get_system_prompt(self, system_prompt_hash: str) -> Optional[str]:
+        """
+        Reads a stored system prompt snapshot.
+
+        Args:
+            system_prompt_hash (str): The hash stored in a message's system_prompt_hash.
+
+        Returns:
+            Optional[str]: The system prompt, None if it is not stored.
+        """
+        with self._messages_lock:
+            if system_prompt_hash in self._pending_prompts:
+                return self._pending_prompts[system_prompt_hash]
+        with read_cursor(self.conn, self.lock, self.cur) as cur:
+            return self.prompt_snapshots.read(cur, system_prompt_hash)
+
+    def close(self) -> None:
+        """Stops the background workers and the writer and inserts the messages still queued."""
+        self.stop_retention()
+        self.stop_summarizer()
+        if self.compactor is not None:
+            self.compactor.stop()
+        self._closed.set()
+        self._flush_wanted.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def start_summarizer(self, summarizer, **kwargs) -> None:
+        """
+        Starts summarizing long messages in the background.
+
+        Keyword arguments are passed on to ``SummarizationWorker``.
+
+        Args:
+            summarizer: Any object with a ``summarize(text) -> str`` method, e.g. ``TruncatingSummarizer``.
+        """
+        from memory.summarizer import SummarizationWorker
+
+        if self.summarizer is None:
+            self.summarizer = SummarizationWorker(self, summarizer, **kwargs)
+            self.summarizer.start()
+            self.summarizer.notify()
+
+    def stop_summarizer(self) -> None:
+        """Stops the background summarizer if one is running."""
+        if self.summarizer is not None:
+            self.summarizer.stop()
+            self.summarizer = None
+
+    def start_retention(self, policy, archive_dir: str, **kwargs) -> None:
+        """
+        Starts archiving the messages a retention policy no longer keeps, in the background.
+
+        Keyword arguments are passed on to ``RetentionWorker``.
+
+        Args:
+            policy (RetentionPolicy): The age and size limits of the memory table.
+            archive_dir (str): Where the archived segments are written.
+        """
+        from memory.retention import RetentionWorker
+
+        if self.retention is None:
+            self.retention = RetentionWorker(self, policy, archive_dir, **kwargs)
+            self.retention.start()
+
+    def stop_retention(self) -> None:
+        """Stops the background retention if it is running."""
+        if self.retention is not None:
+            self.retention.stop()
+            self.retention = None
+
+    def clear_conversations(self, project_directories) -> None:
+        """
+        Drops the cached messages of projects whose messages changed in the table.
+
+        Args:
+            project_directories (Iterable[Optional[str]]): The projects.
+        """
+        with self._messages_lock:
+            for project_directory in project_directories:
+                if project_directory in self._conversations:
+                    self._conversations[project_directory].clear()
+
+    def get_unsummarized_messages(
+        self, min_tokens: int, limit: int
+    ) -> List[Tuple[str, str, int]]:
+        """
+        Reads the newest messages that are longer than a threshold and have no summary yet.
+
+        Args:
+            min_tokens (int): Only messages with more tokens than this are returned.
+            limit (int): The maximum number of messages returned.
+
+        Returns:
+            List[Tuple[str, str, int]]: (interaction_index, content, content_tokens) rows, newest first.
+        """
+        with read_cursor(self.conn, self.lock, self.cur) as cur:
+            cur.execute(
                 f"""
-                INSERT INTO {self.memory_table_name}
-                (interaction_index, role, content, content_tokens, summarized_message, summarized_message_tokens, project_directory, is_function_call, system_prompt)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+                SELECT interaction_index, content, content_tokens
+                FROM {self.memory_table_name}
+                WHERE summarized_message IS NULL AND content_tokens > ?
+                ORDER BY interaction_index DESC
+                LIMIT ?
                 """,
-                (
-                    timestamp,
-                    role,
-                    content,
-                    message_tokens,
-                    summary,
-                    summary_tokens,
-                    self.project_directory,
-                    is_function_call,
-                    system_prompt,
-                ),
+                (min_tokens, limit),
             )
-            self.conn.commit()
-        except Exception as e:
-            print("Failed to insert data: ", str(e))
-        return
+            return cur.fetchall()
+
+    def save_summaries(self, summaries: List[Tuple[str, str, int]]) -> int:
+        """
+        Writes message summaries in one transaction and updates the cached messages.
+
+        Args:
+            summaries (List[Tuple[str, str, int]]): (interaction_index, summary, summary_tokens) rows.
+
+        Returns:
+            int: The number of summaries written.
+        """
+        if not summaries:
+            return 0
+        with self._messages_lock:
+            try:
+                with self.lock:
+                    self.cur.executemany(
+                        f"""
+                        UPDATE {self.memory_table_name}
+                        SET summarized_message = ?, summarized_message_tokens = ?
+                        WHERE interaction_index = ?
+                        """,
+                        [
+                            (summary, tokens, interaction_index)
+                            for interaction_index, summary, tokens in summaries
+                        ],
+                    )
+                    self.conn.commit()
+            except Exception as e:
+                print("Failed to save summaries: ", str(e))
+                return 0
+            by_index = {
+                interaction_index: (summary, tokens)
+                for interaction_index, summary, tokens in summaries
+            }
+            for conversation in self._conversations.values():
+                conversation.update_summaries(by_index)
+        return len(summaries)
+
+    def _notify_summarizer(self, rows: List[tuple]) -> None:
+        # rows are in INSERT_MESSAGE_QUERY order, content_tokens is the fourth column
+        summarizer = self.summarizer
+        if summarizer is not None and any(
+            (row[3] or 0) > summarizer.threshold_tokens for row in rows
+        ):
+            summarizer.notify()
+
+    def _start_flusher(self) -> None:
+        if self._flusher is None and not self._closed.is_set():
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name="memory-writer", daemon=True
+            )
+            self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while not self._closed.is_set():
+            self._flush_wanted.wait(self.flush_interval_ms / 1000)
+            self._flush_wanted.clear()
+            self.flush()
+
+    def _conversation(self, project_directory: Optional[str]) -> ConversationCache:
+        with self._messages_lock:
+            if project_directory not in self._conversations:
+                self._conversations[project_directory] = ConversationCache()
+            return self._conversations[project_directory]
 
     def get_total_tokens_in_message(self, message: str) -> int:
         """
-        Calculates the total number of tokens in a given message using the tiktoken library.
+        Calculates the total number of tokens in a given message with the tokenizer of the model.
+
+        The tokenizer is shared per model and the counts of recent messages are cached.
 
         Args:
             message (str): The message for which to calculate the total number of tokens.
@@ -188,34 +595,264 @@ class MemoryManager:
         Returns:
             int: The total number of tokens in the message.
         """
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        num_tokens = len(encoding.encode(message))
-        return num_tokens
+        return self.tokenizer.count(message)
+
+    def set_model(self, model: str) -> None:
+        """
+        Counts tokens for another model from now on.
+
+        The stored counts of a project are recomputed by the next ``get_messages``, and
+        the summarizers of the compactor and the background worker count with it too.
+
+        Args:
+            model (str): The model name, e.g. ``CodingAgent.GPT_MODEL``.
+        """
+        self.model = model
+        self.tokenizer = get_tokenizer(model)
+        for worker in (self.compactor, self.summarizer):
+            summarizer = getattr(worker, "summarizer", None)
+            if getattr(summarizer, "tokenizer", None) is not None:
+                summarizer.tokenizer = self.tokenizer
+
+    def recount_tokens(self) -> None:
+        """
+        Recomputes the token columns of the project's messages counted by another tokenizer.
+
+        Runs as one UPDATE with the tokenizer registered as an SQL function, so the rows are
+        not read into Python. Each project is checked once per tokenizer, messages added
+        afterwards are counted by ``add_message``.
+        """
+        tokenizer = self.tokenizer
+        key = (self.project_directory, tokenizer.name)
+        if key in self._recounted:
+            return
+
+        def count(text: Optional[str]) -> Optional[int]:
+            return None if text is None else tokenizer.count(text)
 
-    def create_tables(self) -> None:
         try:
+            # Queued rows were counted by the tokenizer of their time, recount them too
+            self.flush()
+            with self._messages_lock, self.lock:
+                # Bound to this tokenizer, the writer is only used under the lock
+                self.conn.create_function("memory_token_count", 1, count)
+                self.cur.execute(
+                    f"""
+                    UPDATE {self.memory_table_name}
+                    SET content_tokens = memory_token_count(content),
+                        summarized_message_tokens = memory_token_count(summarized_message),
+                        token_model = ?
+                    WHERE project_directory IS ? AND token_model IS NOT ?
+                    """,
+                    (tokenizer.name, self.project_directory, tokenizer.name),
+                )
+                self.conn.commit()
+                self._conversation(self.project_directory).clear()
+            self._recounted.add(key)
+        except Exception as e:
+            print("Failed to recount tokens: ", str(e))
+
+    def get_config(self) -> Dict[str, str]:
+        """
+        Reads the settings saved in the config table.
+
+        Returns:
+            Dict[str, str]: The saved values keyed by field.
+        """
+        with read_cursor(self.conn, self.lock, self.cur) as cur:
+            cur.execute("SELECT field, value FROM config")
+            return {field: value for field, value in cur.fetchall()}
+
+    def set_config(self, field: str, value: str) -> None:
+        """
+        Saves a setting in the config table.
+
+        Args:
+            field (str): The name of the setting, e.g. "model".
+            value (str): The value to save.
+        """
+        with self.lock:
             self.cur.execute(
-                f"""
-                CREATE TABLE IF NOT EXISTS {self.memory_table_name}
-                (
-                    interaction_index TIMESTAMP PRIMARY KEY,
-                    role VARCHAR(100),
-                    content TEXT,
-                    content_tokens INT,
-                    summarized_message TEXT,
-                    summarized_message_tokens INT,
-                    project_directory TEXT,
-                    is_function_call BOOLEAN DEFAULT FALSE,
-                    function_response BOOLEAN DEFAULT FALSE,
-                    system_prompt TEXT DEFAULT NULL
-                );
                 """
+                INSERT INTO config (field, value, last_updated)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(field)
+                DO UPDATE SET value = excluded.value, last_updated = excluded.last_updated;
+                """,
+                (field, value),
             )
             self.conn.commit()
+
+    async def aget_messages(self, chat_box: Optional[bool] = None) -> List[dict]:
+        """Awaitable ``get_messages``, on the writer since it flushes queued turns and recounts tokens."""
+        return await run_blocking(self.conn, self.get_messages, chat_box, kind="write")
+
+    async def aadd_message(
+        self,
+        role: str,
+        content: str,
+        command: Optional[str] = None,
+        function_response: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> None:
+        """Awaitable ``add_message``."""
+        await run_blocking(
+            self.conn,
+            self.add_message,
+            role,
+            content,
+            command,
+            function_response,
+            system_prompt,
+            kind="write",
+        )
+
+    async def aget_config(self) -> Dict[str, str]:
+        """Awaitable ``get_config``."""
+        return await run_blocking(self.conn, self.get_config)
+
+    async def aset_config(self, field: str, value: str) -> None:
+        """Awaitable ``set_config``."""
+        await run_blocking(self.conn, self.set_config, field, value, kind="write")
+
+    async def aset_directory(self, directory: str) -> None:
+        """Awaitable ``set_directory``, which rebuilds the system prompt."""
+        await run_blocking(self.conn, self.set_directory, directory, kind=None)
+
+    def create_tables(self) -> None:
+        table = self.memory_table_name
+        try:
+            run_migrations(
+                self.conn,
+                f"memory:{table}",
+                [
+                    Migration(
+                        1,
+                        "message table",
+                        [
+                            f"""
+                            CREATE TABLE IF NOT EXISTS {table}
+                            (
+                                interaction_index TIMESTAMP PRIMARY KEY,
+                                role VARCHAR(100),
+                                content TEXT,
+                                content_tokens INT,
+                                summarized_message TEXT,
+                                summarized_message_tokens INT,
+                                project_directory TEXT,
+                                is_function_call BOOLEAN DEFAULT FALSE,
+                                function_response BOOLEAN DEFAULT FALSE,
+                                system_prompt TEXT DEFAULT NULL
+                            );
+                            """
+                        ],
+                    ),
+                    Migration(
+                        2,
+                        "index for the per-project message window",
+                        [
+                            f"""
+                            CREATE INDEX IF NOT EXISTS {table}_project_interaction
+                            ON {table} (project_directory, interaction_index)
+                            """
+                        ],
+                    ),
+                    Migration(
+                        3,
+                        "tokenizer of the token counts",
+                        [
+                            f"ALTER TABLE {table} ADD COLUMN token_model TEXT",
+                            # Existing counts were made with the default tokenizer
+                            lambda cur: cur.execute(
+                                f"UPDATE {table} SET token_model = ?",
+                                (get_tokenizer(DEFAULT_MODEL).name,),
+                            ),
+                        ],
+                    ),
+                    Migration(
+                        4,
+                        "index for the messages waiting for a summary",
+                        [
+                            f"""
+                            CREATE INDEX IF NOT EXISTS {table}_unsummarized
+                            ON {table} (interaction_index, content_tokens)
+                            WHERE summarized_message IS NULL
+                            """
+                        ],
+                    ),
+                    Migration(
+                        5,
+                        "tiered digests of compacted turns",
+                        [
+                            f"""
+                            CREATE TABLE IF NOT EXISTS {table}_digests (
+                                project_directory TEXT NOT NULL,
+                                tier TEXT NOT NULL,
+                                period TEXT NOT NULL,
+                                digest TEXT,
+                                message_count INT,
+                                through_index TEXT,
+                                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                                PRIMARY KEY (project_directory, tier, period)
+                            )
+                            """
+                        ],
+                    ),
+                    Migration(
+                        6,
+                        "system prompt snapshots stored once per content hash",
+                        [
+                            f"""
+                            CREATE TABLE IF NOT EXISTS {table}_prompt_snapshots (
+                                prompt_hash TEXT PRIMARY KEY,
+                                prompt TEXT,
+                                created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                            )
+                            """,
+                            f"ALTER TABLE {table} ADD COLUMN system_prompt_hash TEXT",
+                            self._move_system_prompts,
+                            f"""
+                            CREATE INDEX IF NOT EXISTS {table}_system_prompt_hash
+                            ON {table} (system_prompt_hash) WHERE system_prompt_hash IS NOT NULL
+                            """,
+                        ],
+                    ),
+                    Migration(
+                        7,
+                        "system prompt snapshots stored as deltas",
+                        [
+                            f"ALTER TABLE {table}_prompt_snapshots ADD COLUMN base_hash TEXT",
+                            f"ALTER TABLE {table}_prompt_snapshots ADD COLUMN delta BLOB",
+                            f"ALTER TABLE {table}_prompt_snapshots ADD COLUMN depth INT DEFAULT 0",
+                        ],
+                    ),
+                ],
+            )
         except Exception as e:
             print("Failed to create tables: ", str(e))
         return
 
+    def _move_system_prompts(self, cur) -> None:
+        # Replaces the prompts copied into every message with references to snapshots
+        table = self.memory_table_name
+        cur.execute(
+            f"SELECT DISTINCT system_prompt FROM {table} WHERE system_prompt IS NOT NULL"
+        )
+        for row in cur.fetchall():
+            system_prompt = row[0]
+            system_prompt_hash = prompt_hash(system_prompt)
+            cur.execute(
+                INSERT_PROMPT_QUERY.format(table=table),
+                (system_prompt_hash, system_prompt),
+            )
+            cur.execute(
+                f"""
+                UPDATE {table} SET system_prompt_hash = ?, system_prompt = NULL
+                WHERE system_prompt = ?
+                """,
+                (system_prompt_hash, system_prompt),
+            )
+
     def set_directory(self, directory: str) -> None:
         self.project_directory = directory
         self.working_context.project_directory = directory
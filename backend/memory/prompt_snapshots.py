@@ -0,0 +1,202 @@
+"""
+This module defines the content-addressed storage of the system prompts MemoryManager records with each turn. A prompt is stored once under its sha256 hash in the ``{table}_prompt_snapshots`` table, and message rows only reference that hash. Consecutive prompts differ in a few lines of the tree, the open files or the git diff, so a new snapshot is stored as a compressed line delta against the previous one whenever that is smaller than the prompt itself. Delta chains are capped at ``max_chain`` snapshots, after which a full copy is stored, so reading a prompt back applies a bounded number of deltas.
+"""
+
+import difflib
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
+
+from database.compression import compress_text, decompress_text
+
+DELTA_CODEC = "zlib"
+# Snapshots written and confirmed stored, remembered so repeated prompts skip the insert
+KNOWN_PROMPTS = 1024
+# Deltas applied at most to read a snapshot back
+MAX_CHAIN = 16
+
+INSERT_SNAPSHOT_QUERY = """
+    INSERT OR IGNORE INTO {table} (prompt_hash, prompt, base_hash, delta, depth)
+    VALUES (?, ?, ?, ?, ?);
+"""
+# The snapshot and the chain of bases it is a delta against, the full copy last
+READ_CHAIN_QUERY = """
+    WITH RECURSIVE chain (prompt_hash, prompt, base_hash, delta, depth) AS (
+        SELECT prompt_hash, prompt, base_hash, delta, depth FROM {table} WHERE prompt_hash = ?
+        UNION ALL
+        SELECT s.prompt_hash, s.prompt, s.base_hash, s.delta, s.depth
+        FROM {table} s JOIN chain c ON s.prompt_hash = c.base_hash
+        WHERE c.delta IS NOT NULL
+    )
+    SELECT prompt, delta FROM chain ORDER BY depth DESC;
+"""
+# Snapshots referenced by a message, or a base of one that is
+DELETE_UNREFERENCED_QUERY = """
+    DELETE FROM {table} WHERE prompt_hash NOT IN (
+        WITH RECURSIVE live (prompt_hash) AS (
+            SELECT system_prompt_hash FROM {messages} WHERE system_prompt_hash IS NOT NULL
+            UNION
+            SELECT s.base_hash FROM {table} s JOIN live l ON s.prompt_hash = l.prompt_hash
+            WHERE s.base_hash IS NOT NULL
+        )
+        SELECT prompt_hash FROM live
+    );
+"""
+
+
+def prompt_hash(prompt: str) -> str:
+    """Returns the content hash a system prompt snapshot is stored under."""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+def make_delta(base: str, text: str) -> bytes:
+    """
+    Encodes a text as the line changes against a base.
+
+    Args:
+        base (str): The text the delta is applied to.
+        text (str): The text the delta produces.
+
+    Returns:
+        bytes: The compressed delta, read by ``apply_delta``.
+    """
+    base_lines = base.splitlines(keepends=True)
+    lines = text.splitlines(keepends=True)
+    # [start, end] copies base lines, a string is inserted as is
+    ops: List[Union[List[int], str]] = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append("".join(lines[j1:j2]))
+    return compress_text(json.dumps(ops, separators=(",", ":")), DELTA_CODEC)
+
+
+def apply_delta(base: str, delta: bytes) -> str:
+    """
+    Rebuilds the text a delta from ``make_delta`` was made of.
+
+    Args:
+        base (str): The base the delta was made against.
+        delta (bytes): The delta.
+
+    Returns:
+        str: The text.
+    """
+    base_lines = base.splitlines(keepends=True)
+    parts = []
+    for op in json.loads(decompress_text(delta, DELTA_CODEC)):
+        parts.append(op if isinstance(op, str) else "".join(base_lines[op[0] : op[1]]))
+    return "".join(parts)
+
+
+class PromptSnapshotStore:
+    """
+    Writes and reads the system prompt snapshots of a memory table.
+
+    Writes go through the caller's cursor and must be made under the database write lock,
+    the same lock that guards ``forget`` and ``collect_garbage``.
+
+    Attributes:
+        table (str): The snapshot table.
+        max_known (int): The number of stored hashes remembered.
+        max_chain (int): The longest chain of deltas written before a full copy.
+    """
+
+    def __init__(
+        self, table: str, max_known: int = KNOWN_PROMPTS, max_chain: int = MAX_CHAIN
+    ):
+        self.table = table
+        self.max_known = max_known
+        self.max_chain = max_chain
+        self._known: "OrderedDict[str, None]" = OrderedDict()
+        # (hash, prompt, depth) of the last snapshot written, the base of the next delta
+        self._base: Optional[tuple] = None
+
+    def store(self, cur, prompts: Dict[str, str]) -> int:
+        """
+        Inserts the snapshots of prompts that are not stored yet.
+
+        Args:
+            cur: A cursor of the writer, inside the caller's transaction.
+            prompts (Dict[str, str]): Prompts keyed by ``prompt_hash``, oldest first.
+
+        Returns:
+            int: The number of snapshots inserted.
+        """
+        inserted = 0
+        query = INSERT_SNAPSHOT_QUERY.format(table=self.table)
+        for hash_, prompt in prompts.items():
+            if hash_ in self._known:
+                self._known.move_to_end(hash_)
+                continue
+            row = self._snapshot(hash_, prompt)
+            cur.execute(query, row)
+            if cur.rowcount == 1:
+                inserted += 1
+                self._base = (hash_, prompt, row[4])
+            else:
+                # Stored before this store was created, its depth is not known
+                self._base = None
+            self._remember(hash_)
+        return inserted
+
+    def read(self, cur, hash_: str) -> Optional[str]:
+        """
+        Reads a snapshot back, applying its deltas.
+
+        Args:
+            cur: A cursor to read with.
+            hash_ (str): The ``prompt_hash`` of the snapshot.
+
+        Returns:
+            Optional[str]: The prompt, None if it is not stored.
+        """
+        cur.execute(READ_CHAIN_QUERY.format(table=self.table), (hash_,))
+        chain = cur.fetchall()
+        if not chain or chain[-1][1] is not None:
+            # Missing, or a base of the chain is missing
+            return None
+        prompt = chain[-1][0]
+        for _, delta in reversed(chain[:-1]):
+            prompt = apply_delta(prompt, delta)
+        return prompt
+
+    def collect_garbage(self, cur, message_table: str) -> int:
+        """
+        Deletes the snapshots no message references and no kept snapshot is based on.
+
+        Args:
+            cur: A cursor of the writer, inside the caller's transaction.
+            message_table (str): The memory table referencing the snapshots.
+
+        Returns:
+            int: The number of snapshots deleted.
+        """
+        cur.execute(
+            DELETE_UNREFERENCED_QUERY.format(table=self.table, messages=message_table)
+        )
+        deleted = cur.rowcount
+        if deleted:
+            self.forget()
+        return deleted
+
+    def forget(self) -> None:
+        """Forgets which snapshots are stored, they are checked against the table again."""
+        self._known.clear()
+        self._base = None
+
+    def _snapshot(self, hash_: str, prompt: str) -> tuple:
+        if self._base is not None and self._base[2] < self.max_chain:
+            base_hash, base, depth = self._base
+            delta = make_delta(base, prompt)
+            if len(delta) < len(prompt.encode("utf-8")) // 2:
+                return (hash_, None, base_hash, delta, depth + 1)
+        return (hash_, prompt, None, None, 0)
+
+    def _remember(self, hash_: str) -> None:
+        self._known[hash_] = None
+        if len(self._known) > self.max_known:
+            self._known.popitem(last=False)
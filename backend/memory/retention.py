@@ -0,0 +1,298 @@
+"""
+This module defines the retention of the memory tables. A RetentionWorker moves the oldest messages of a MemoryManager out of the database once they are older than the policy's age limit or the table has grown past its size budget. Archived messages are written, together with the system prompt snapshots they reference, to compressed JSON Lines segment files before they are deleted, so nothing is lost, and the freed pages are handed back to the file system a few at a time with incremental vacuum instead of a full VACUUM that would block every writer. A database created before incremental vacuum is switched over once by ``enable_incremental_vacuum``, a startup step that runs before the app serves requests.
+"""
+
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional
+
+from database.compression import check_codec, compress_text, decompress_text
+from database.connection import read_cursor, write_lock
+
+# Stored bytes of a message row, the columns that grow with the conversation
+ROW_BYTES = """
+    COALESCE(length(CAST(content AS BLOB)), 0)
+    + COALESCE(length(CAST(summarized_message AS BLOB)), 0)
+    + COALESCE(length(CAST(system_prompt AS BLOB)), 0)
+"""
+# PRAGMA auto_vacuum values
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class RetentionPolicy(NamedTuple):
+    """How long messages are kept and how large the memory table may grow."""
+
+    # Messages older than this are archived, None keeps them regardless of age
+    max_age_days: Optional[float] = None
+    # The oldest messages are archived while the table holds more than this, None for no limit
+    max_bytes: Optional[int] = None
+
+
+def enable_incremental_vacuum(db_connection) -> bool:
+    """
+    Switches a database to incremental vacuum, which ``RetentionWorker.vacuum`` relies on.
+
+    A database created without it is rebuilt once with a full VACUUM, which blocks every
+    other connection, so this is run at startup before the app serves requests.
+
+    Args:
+        db_connection: A ConnectionManager or a plain connection.
+
+    Returns:
+        bool: True if the database was rebuilt.
+    """
+    with write_lock(db_connection):
+        cur = db_connection.cursor()
+        cur.execute("PRAGMA auto_vacuum")
+        if cur.fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            return False
+        # VACUUM cannot run inside a transaction
+        db_connection.commit()
+        cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cur.execute("VACUUM")
+        return True
+
+
+def read_segment(path: str) -> List[dict]:
+    """
+    Reads the records of an archived segment.
+
+    Args:
+        path (str): A segment file written by ``RetentionWorker``.
+
+    Returns:
+        List[dict]: The prompt snapshot records followed by the message records.
+    """
+    codec = os.path.splitext(path)[1].lstrip(".")
+    with open(path, "rb") as f:
+        data = f.read()
+    text = decompress_text(data, None if codec == "jsonl" else codec)
+    return [json.loads(line) for line in text.splitlines() if line]
+
+
+class RetentionWorker:
+    """
+    Archives old messages of a MemoryManager and vacuums the database in a background thread.
+
+    Attributes:
+        memory_manager (MemoryManager): Owns the messages, its connection and lock are used.
+        policy (RetentionPolicy): Which messages are archived.
+        archive_dir (str): Where the segment files are written.
+        codec (Optional[str]): "zlib", "zstd" or None for plain JSON Lines segments.
+        batch_size (int): The maximum number of messages per segment.
+        vacuum_pages (int): The number of free pages returned per incremental vacuum.
+        interval_ms (int): How often the policy is applied.
+    """
+
+    def __init__(
+        self,
+        memory_manager,
+        policy: RetentionPolicy,
+        archive_dir: str,
+        codec: Optional[str] = "zlib",
+        batch_size: int = 500,
+        vacuum_pages: int = 256,
+        interval_ms: int = 3600 * 1000,
+    ):
+        check_codec(codec)
+        self.memory_manager = memory_manager
+        self.policy = policy
+        self.archive_dir = archive_dir
+        self.codec = codec
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.interval_ms = interval_ms
+        self.table = memory_manager.memory_table_name
+        # Stored bytes of the rows up to _counted_through, kept up to date across batches
+        self._table_bytes = 0
+        self._counted_through: Optional[str] = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """Starts applying the policy in a background thread."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, name="memory-retention", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the background thread, a segment in progress is finished first."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self) -> int:
+        """
+        Archives every message the policy no longer keeps, then vacuums.
+
+        Returns:
+            int: The number of messages archived.
+        """
+        manager = self.memory_manager
+        # Queued messages count towards the size budget
+        manager.flush()
+        if self.policy.max_bytes is not None:
+            self._count_table_bytes()
+        archived = 0
+        projects = set()
+        while not self._stop.is_set():
+            rows = self.archive_batch()
+            if not rows:
+                break
+            archived += len(rows)
+            projects.update(row["project_directory"] for row in rows)
+            if len(rows) < self.batch_size:
+                break
+        if archived:
+            manager.clear_conversations(projects)
+        self.vacuum()
+        return archived
+
+    def archive_batch(self) -> List[dict]:
+        """
+        Archives the oldest messages the policy no longer keeps, at most ``batch_size``.
+
+        The segment file is written before the messages are deleted, the deletion and the
+        removal of snapshots no message references any more are one transaction.
+
+        Returns:
+            List[dict]: The archived messages.
+        """
+        manager = self.memory_manager
+        with manager.lock:
+            cur = manager.cur
+            excess = self._excess_bytes(cur)
+            cutoff = self._cutoff()
+            if excess <= 0 and cutoff is None:
+                return []
+            cur.execute(
+                f"SELECT *, {ROW_BYTES} AS row_bytes FROM {self.table} ORDER BY interaction_index LIMIT ?",
+                (self.batch_size,),
+            )
+            columns = [column[0] for column in cur.description]
+            rows = []
+            archived_bytes = 0
+            for values in cur.fetchall():
+                row = dict(zip(columns, values))
+                if excess <= 0 and (
+                    cutoff is None or row["interaction_index"] >= cutoff
+                ):
+                    break
+                row_bytes = row.pop("row_bytes")
+                excess -= row_bytes
+                archived_bytes += row_bytes
+                rows.append(row)
+            if not rows:
+                return []
+            snapshots = self._snapshots(cur, rows)
+            self._write_segment(snapshots, rows)
+            try:
+                cur.executemany(
+                    f"DELETE FROM {self.table} WHERE interaction_index = ?",
+                    [(row["interaction_index"],) for row in rows],
+                )
+                manager.prompt_snapshots.collect_garbage(cur, self.table)
+                manager.conn.commit()
+            except Exception:
+                manager.conn.rollback()
+                manager.prompt_snapshots.forget()
+                raise
+            self._table_bytes -= archived_bytes
+        return rows
+
+    def vacuum(self) -> None:
+        """
+        Returns up to ``vacuum_pages`` free pages of the database to the file system.
+
+        Does nothing until ``enable_incremental_vacuum`` has switched the database over.
+        """
+        manager = self.memory_manager
+        with manager.lock:
+            cur = manager.cur
+            cur.execute(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)})")
+            cur.fetchall()
+            manager.conn.commit()
+
+    def _count_table_bytes(self) -> None:
+        # Summaries written since the last run grow rows already counted, so every run
+        # starts from a full count, read without holding the write lock when possible
+        manager = self.memory_manager
+        with read_cursor(manager.conn, manager.lock, manager.cur) as cur:
+            cur.execute(
+                f"SELECT COALESCE(SUM({ROW_BYTES}), 0), MAX(interaction_index) FROM {self.table}"
+            )
+            self._table_bytes, self._counted_through = cur.fetchone()
+
+    def _excess_bytes(self, cur) -> int:
+        if self.policy.max_bytes is None:
+            return 0
+        # Only the rows added since the last count are read, a range of the primary key
+        cur.execute(
+            f"""
+            SELECT COALESCE(SUM({ROW_BYTES}), 0), MAX(interaction_index) FROM {self.table}
+            WHERE interaction_index > ?
+            """,
+            (self._counted_through or "",),
+        )
+        added, newest = cur.fetchone()
+        if newest is not None:
+            self._table_bytes += added
+            self._counted_through = newest
+        return self._table_bytes - self.policy.max_bytes
+
+    def _cutoff(self) -> Optional[str]:
+        if self.policy.max_age_days is None:
+            return None
+        cutoff = datetime.now() - timedelta(days=self.policy.max_age_days)
+        return cutoff.isoformat()
+
+    def _snapshots(self, cur, rows: List[dict]) -> List[dict]:
+        hashes = sorted(
+            {row["system_prompt_hash"] for row in rows if row["system_prompt_hash"]}
+        )
+        snapshots = self.memory_manager.prompt_snapshots
+        # Written in full, a segment can be read without the deltas' bases
+        return [
+            {"prompt_hash": hash_, "prompt": snapshots.read(cur, hash_)}
+            for hash_ in hashes
+        ]
+
+    def _write_segment(self, snapshots: List[dict], rows: List[dict]) -> str:
+        os.makedirs(self.archive_dir, exist_ok=True)
+        # Timestamps hold colons, which not every file system allows
+        first, last = (rows[i]["interaction_index"].replace(":", "") for i in (0, -1))
+        path = os.path.join(
+            self.archive_dir,
+            f"{self.table}-{first}-{last}.jsonl"
+            + (f".{self.codec}" if self.codec else ""),
+        )
+        lines = [
+            json.dumps({"type": "prompt_snapshot", **snapshot})
+            for snapshot in snapshots
+        ] + [json.dumps({"type": "message", **row}) for row in rows]
+        data = compress_text("\n".join(lines) + "\n", self.codec)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        # The segment is complete on disk before the messages are deleted
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        return path
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print("Failed to apply the memory retention policy: ", str(e))
+            self._stop.wait(self.interval_ms / 1000)
@@ -0,0 +1,160 @@
+"""
+This module defines the background summarization of long messages. A SummarizationWorker picks up the messages of a MemoryManager whose content runs above a token threshold, summarizes them off the request path, and writes the summaries back to the summarized_message columns in batches, so the message window fits more turns into the same token budget. Summarizers are plain objects with a ``summarize(text) -> str`` method: TruncatingSummarizer is a local, deterministic stand-in that keeps the head and tail of a message, and OpenAISummarizer asks a chat model for a summary.
+"""
+
+import threading
+from typing import Optional, Set
+
+from database.tokenizer import Tokenizer, get_tokenizer
+
+OMISSION_MARKER = "\n[...]\n"
+
+
+class TruncatingSummarizer:
+    """
+    Shortens a message to its head and tail, without calling a model.
+
+    Attributes:
+        max_tokens (int): The token budget of a summary.
+        tokenizer (Tokenizer): Counts the tokens of messages and summaries.
+    """
+
+    def __init__(self, max_tokens: int = 200, tokenizer: Optional[Tokenizer] = None):
+        self.max_tokens = max_tokens
+        self.tokenizer = tokenizer or get_tokenizer()
+
+    def summarize(self, text: str) -> str:
+        tokens = self.tokenizer.count(text)
+        if tokens <= self.max_tokens:
+            return text
+        # Keep the share of characters the budget allows, split between head and tail
+        keep = max(int(len(text) * self.max_tokens / tokens) // 2, 1)
+        summary = text[:keep].rstrip() + OMISSION_MARKER + text[-keep:].lstrip()
+        while self.tokenizer.count(summary) > self.max_tokens and keep > 1:
+            keep //= 2
+            summary = text[:keep].rstrip() + OMISSION_MARKER + text[-keep:].lstrip()
+        return summary
+
+
+class OpenAISummarizer:
+    """
+    Summarizes a message with an OpenAI chat model.
+
+    Attributes:
+        model (str): The chat model.
+        max_tokens (int): The token budget of a summary.
+    """
+
+    def __init__(self, model: str = "gpt-3.5-turbo", max_tokens: int = 200):
+        from openai import OpenAI
+
+        self.client = OpenAI()
+        self.model = model
+        self.max_tokens = max_tokens
+
+    def summarize(self, text: str) -> str:
+        response = self.client.chat.completions.create(
+            model=self.model,
+            max_tokens=self.max_tokens,
+            temperature=0,
+            messages=[
+                {
+                    "role": "system",
+                    "content": "Summarize the message of a coding conversation. Keep file names, identifiers, decisions and open questions.",
+                },
+                {"role": "user", "content": text},
+            ],
+        )
+        return response.choices[0].message.content
+
+
+class SummarizationWorker:
+    """
+    Summarizes the long messages of a MemoryManager in a background thread.
+
+    Attributes:
+        memory_manager (MemoryManager): Owns the messages and stores the summaries.
+        summarizer: Any object with a ``summarize(text) -> str`` method.
+        threshold_tokens (int): Messages with more tokens than this are summarized.
+        batch_size (int): The number of summaries written per transaction.
+        interval_ms (int): How often the table is checked when no message asked for a summary.
+    """
+
+    def __init__(
+        self,
+        memory_manager,
+        summarizer,
+        threshold_tokens: int = 500,
+        batch_size: int = 16,
+        interval_ms: int = 5000,
+    ):
+        self.memory_manager = memory_manager
+        self.summarizer = summarizer
+        self.threshold_tokens = threshold_tokens
+        self.batch_size = batch_size
+        self.interval_ms = interval_ms
+        # Messages the summarizer failed on, not retried until the worker restarts
+        self._failed: Set[str] = set()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """Starts summarizing in a background thread."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, name="memory-summarizer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the background thread, summaries in progress are finished first."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def notify(self) -> None:
+        """Wakes the worker, called when a long message is added."""
+        self._wake.set()
+
+    def run_once(self) -> int:
+        """
+        Summarizes one batch of long messages and writes the summaries in one transaction.
+
+        Returns:
+            int: The number of summaries written.
+        """
+        rows = self.memory_manager.get_unsummarized_messages(
+            self.threshold_tokens, self.batch_size + len(self._failed)
+        )
+        tokenizer = self.memory_manager.tokenizer
+        summaries = []
+        for interaction_index, content, content_tokens in rows:
+            if interaction_index in self._failed:
+                continue
+            try:
+                summary = self.summarizer.summarize(content)
+            except Exception as e:
+                print(f"Failed to summarize message {interaction_index}: {e}")
+                self._failed.add(interaction_index)
+                continue
+            summary_tokens = tokenizer.count(summary)
+            if summary_tokens >= content_tokens:
+                # Nothing gained, the message stands for itself and is not picked up again
+                summary, summary_tokens = content, content_tokens
+            summaries.append((interaction_index, summary, summary_tokens))
+            if len(summaries) >= self.batch_size:
+                break
+        return self.memory_manager.save_summaries(summaries)
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.interval_ms / 1000)
+            self._wake.clear()
+            # Work through the backlog a batch at a time, checking for stop in between
+            while not self._stop.is_set() and self.run_once():
+                pass
@@ -1,9 +1,14 @@
-from typing import Optional, Dict, List, Any, Tuple
+from typing import Optional, Dict, List, Any, Tuple, Callable
 import os
 import logging
 import subprocess
 import sqlite3
 
+from database.compression import read_file_texts
+from database.connection import read_cursor, run_blocking, write_lock
+from database.migrations import Migration, run_migrations
+from memory.git_diff import GitDiffCache, git_diff
+
 logger = logging.getLogger(__name__)
 
 
@@ -26,12 +31,21 @@ class SystemPromptHandler:
         """
         self.conn = db_connection
         self.cur = self.conn.cursor()
+        self.lock = write_lock(self.conn)
         self.system_file_summaries = None
         self.system_file_contents = None
         self.identity = identity
         self.files_in_prompt = []
+        # Files over file_token_budget are cut down by excerpt to the chunks matching query,
+        # excerpt(file_path, query, token_budget, include_line_numbers) returns None for
+        # files that fit. Unset, files are sent whole.
+        self.excerpt: Optional[Callable[..., Optional[str]]] = None
+        self.file_token_budget: Optional[int] = None
+        self.query = ""
         self.system = self.identity
         self.tree = tree
+        # The diff from main, recomputed only when HEAD, the index or the worktree changed
+        self.diff_cache = GitDiffCache()
         self.create_tables()
         self.directory = self.get_directory()
         self.name = "Default"
@@ -42,8 +56,9 @@ class SystemPromptHandler:
         Returns:
             str: The project directory.
         """
-        self.cur.execute("SELECT value FROM config WHERE field = 'directory';")
-        result = self.cur.fetchone()
+        with read_cursor(self.conn, self.lock, self.cur) as cur:
+            cur.execute("SELECT value FROM config WHERE field = 'directory';")
+            result = cur.fetchone()
         return result[0] if result else None
 
     def set_system(self, input: Dict[str, Any] = {}) -> bool:
@@ -73,17 +88,18 @@ class SystemPromptHandler:
                 )
 
         # Attach a diff from the main branch to the system prompt if applicable.
-        diff = self.generate_diff_from_main()
+        diff = self.diff_cache.get(self.directory)
         # logging.warning("****\n\nDiff from main branch:\n\n", diff)
-        if diff.stdout:
-            self.system += "\n\nDiff from main branch:\n" + str(diff.stdout) + "\n\n"
+        if diff:
+            self.system += "\n\nDiff from main branch:\n" + diff + "\n\n"
 
-        self.cur.execute("DELETE FROM system_prompt")
-        self.cur.execute(
-            "INSERT INTO system_prompt (role, content) VALUES (?, ?)",
-            ("system", self.system),
-        )
-        self.conn.commit()
+        with self.lock:
+            self.cur.execute("DELETE FROM system_prompt")
+            self.cur.execute(
+                "INSERT INTO system_prompt (role, content) VALUES (?, ?)",
+                ("system", self.system),
+            )
+            self.conn.commit()
         return True
 
     def gen_rewrite_prompt(self) -> str:
@@ -107,20 +123,35 @@ class SystemPromptHandler:
             system += "Related File Contents:\n" + self.system_file_contents + "\n\n"
 
         # Attach a diff from the main branch to the system prompt if applicable.
-        diff = self.generate_diff_from_main()
+        diff = self.diff_cache.get(self.directory)
         # logging.warning("****\n\nDiff from main branch:\n\n", diff)
-        if diff.stdout:
-            system += "\n\nDiff from main branch:\n" + str(diff.stdout) + "\n\n"
+        if diff:
+            system += "\n\nDiff from main branch:\n" + diff + "\n\n"
 
         return system
 
     def get_file_contents(self) -> Dict[str, str]:
-        self.cur.execute("SELECT file_path, text FROM files")
-        results = self.cur.fetchall()
-        out = {}
-        for file_name, text in results:
-            out.update({os.path.relpath(file_name, self.directory): text})
-        return out
+        """
+        Read the contents of the files in the prompt.
+
+        Only the rows of these files are read and decompressed, not the whole files table.
+
+        Returns:
+            Dict[str, str]: The file contents keyed by path relative to the project directory, in prompt order.
+        """
+        if not self.files_in_prompt:
+            return {}
+        file_paths = {
+            os.path.join(self.directory, file_name): file_name
+            for file_name in self.files_in_prompt
+        }
+        with read_cursor(self.conn, self.lock, self.cur) as cur:
+            texts = read_file_texts(cur, file_paths)
+        return {
+            file_paths[file_path]: texts[file_path]
+            for file_path in file_paths
+            if file_path in texts
+        }
 
     def set_files_in_prompt(
         self, anth: Optional[bool] = False, include_line_numbers: Optional[bool] = None
@@ -128,6 +159,9 @@ class SystemPromptHandler:
         """s
         Sets the files in the prompt.
 
+        Files larger than ``file_token_budget`` are replaced by their chunks that best match
+        ``query`` when an ``excerpt`` function is set.
+
         Args:
             files (List[File]): A list of files to be set in the prompt.
             include_line_numbers (Optional[bool]): Whether to include line numbers in the prompt.
@@ -135,7 +169,12 @@ class SystemPromptHandler:
         file_contents = self.get_file_contents()
         content = ""
         for k, v in file_contents.items():
-            if k in self.files_in_prompt and include_line_numbers:
+            excerpt = self._excerpt(k, include_line_numbers)
+            if k in self.files_in_prompt and excerpt is not None:
+                content += (
+                    f"<{k}>\n{excerpt}\n</{k}>\n\n" if anth else f"{k}:\n{excerpt}\n\n"
+                )
+            elif k in self.files_in_prompt and include_line_numbers:
                 v = self._add_line_numbers_to_content(v)
                 content += f"<{k}>\n{v}\n</{k}>\n\n" if anth else f"{k}:\n{v}\n\n"
             elif k in self.files_in_prompt:
@@ -146,6 +185,32 @@ class SystemPromptHandler:
         self.set_system()
         return
 
+    def _excerpt(
+        self, file_name: str, include_line_numbers: Optional[bool]
+    ) -> Optional[str]:
+        """
+        Cut a file in the prompt down to the chunks matching the query, if it is over budget.
+
+        Args:
+            file_name (str): The path of the file relative to the project directory.
+            include_line_numbers (Optional[bool]): Whether to include line numbers.
+
+        Returns:
+            Optional[str]: The excerpt, or None to send the whole file.
+        """
+        if self.excerpt is None or not self.file_token_budget:
+            return None
+        try:
+            return self.excerpt(
+                os.path.join(self.directory, file_name),
+                self.query,
+                self.file_token_budget,
+                include_line_numbers=bool(include_line_numbers),
+            )
+        except Exception as e:
+            print(f"Failed to excerpt {file_name}: {e}")
+            return None
+
     def _add_line_numbers_to_content(self, content: str) -> str:
         """
         Add line numbers to the content of a file.
@@ -163,27 +228,32 @@ class SystemPromptHandler:
     def create_tables(self) -> None:
         """Create tables for system prompts if they don't exist."""
         try:
-            self.cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS system_prompts (
-                    id TEXT PRIMARY KEY,
-                    prompt TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """
+            run_migrations(
+                self.conn,
+                "system_prompt",
+                [
+                    Migration(
+                        1,
+                        "saved and current system prompts",
+                        [
+                            """
+                            CREATE TABLE IF NOT EXISTS system_prompts (
+                                id TEXT PRIMARY KEY,
+                                prompt TEXT NOT NULL,
+                                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                            )
+                            """,
+                            """
+                            CREATE TABLE IF NOT EXISTS system_prompt (
+                                role TEXT PRIMARY KEY,
+                                content TEXT NOT NULL
+                            );
+                            """,
+                        ],
+                    )
+                ],
             )
-            self.conn.commit()
-
-            self.cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS system_prompt (
-                    role TEXT PRIMARY KEY,
-                    content TEXT NOT NULL
-                );
-            """
-            )
-            self.conn.commit()
         except Exception as e:
             logger.error(f"Failed to create table: {e}")
             logger.error(f"{e.traceback}")
@@ -197,10 +267,7 @@ class SystemPromptHandler:
             subprocess.CompletedProcess: The result of the git diff command comparing the working state with the main branch.
         """
         repo_path = self.directory  # Assuming the directory is the repo path
-        command = ["git", "-C", repo_path, "diff", "main"]
-        return subprocess.run(
-            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-        )
+        return git_diff(repo_path, "main")
 
     def list_prompts(self) -> List[Dict[str, Any]]:
         """
@@ -209,7 +276,9 @@ class SystemPromptHandler:
         Returns:
             List[Dict[str, Any]]: A list of dictionaries, each containing the details of a system prompt.
         """
-        self.cur.execute("SELECT * FROM system_prompts")
+        with read_cursor(self.conn, self.lock, self.cur) as cur:
+            cur.execute("SELECT * FROM system_prompts")
+            rows = cur.fetchall()
         return [
             {
                 "id": prompt[0],
@@ -218,7 +287,7 @@ class SystemPromptHandler:
                 "created_at": prompt[2],
                 "updated_at": prompt[3],
             }
-            for prompt in self.cur.fetchall()
+            for prompt in rows
         ]
 
     def update_prompt(self, prompt_name: str, new_prompt: str) -> bool:
@@ -233,11 +302,12 @@ class SystemPromptHandler:
             bool: True if the update was successful, False otherwise.
         """
         try:
-            self.cur.execute(
-                "UPDATE system_prompts SET prompt = ? WHERE id = ?",
-                (new_prompt, prompt_name),
-            )
-            self.conn.commit()
+            with self.lock:
+                self.cur.execute(
+                    "UPDATE system_prompts SET prompt = ? WHERE id = ?",
+                    (new_prompt, prompt_name),
+                )
+                self.conn.commit()
             return True
         except Exception as e:
             logger.error(f"Failed to update prompt: {e}")
@@ -254,11 +324,12 @@ class SystemPromptHandler:
             bool: True if the deletion was successful, False otherwise.
         """
         try:
-            self.cur.execute(
-                "DELETE FROM system_prompts WHERE id = ?",
-                (prompt_id,),
-            )
-            self.conn.commit()
+            with self.lock:
+                self.cur.execute(
+                    "DELETE FROM system_prompts WHERE id = ?",
+                    (prompt_id,),
+                )
+                self.conn.commit()
             return True
         except Exception as e:
             logger.error(f"Failed to delete prompt: {e}")
@@ -275,8 +346,9 @@ class SystemPromptHandler:
             Optional[str]: The prompt text if it exists, None otherwise.
         """
         try:
-            self.cur.execute("SELECT prompt FROM system_prompts WHERE id = ?", (name,))
-            result = self.cur.fetchone()
+            with read_cursor(self.conn, self.lock, self.cur) as cur:
+                cur.execute("SELECT prompt FROM system_prompts WHERE id = ?", (name,))
+                result = cur.fetchone()
             return result[0] if result else None
         except Exception as e:
             logger.error(f"Failed to read prompt: {e}")
@@ -295,16 +367,55 @@ class SystemPromptHandler:
         if not name or not prompt:
             raise ValueError("Prompt name and prompt text are required.")
         try:
-            self.cur.execute(
-                "INSERT INTO system_prompts (id, prompt) VALUES (?, ?)",
-                (name, prompt),
-            )
-            self.conn.commit()
+            with self.lock:
+                self.cur.execute(
+                    "INSERT INTO system_prompts (id, prompt) VALUES (?, ?)",
+                    (name, prompt),
+                )
+                self.conn.commit()
             return True
         except Exception as e:
             logger.error(f"Failed to create prompt: {e}")
             return False
 
+    async def aset_system(self, input: Dict[str, Any] = {}) -> bool:
+        """Awaitable ``set_system``, run off the event loop with the git diff it takes."""
+        return await run_blocking(self.conn, self.set_system, input, kind=None)
+
+    async def aset_files_in_prompt(
+        self, anth: Optional[bool] = False, include_line_numbers: Optional[bool] = None
+    ) -> None:
+        """Awaitable ``set_files_in_prompt``."""
+        await run_blocking(
+            self.conn, self.set_files_in_prompt, anth, include_line_numbers, kind=None
+        )
+
+    async def alist_prompts(self) -> List[Dict[str, Any]]:
+        """Awaitable ``list_prompts``."""
+        return await run_blocking(self.conn, self.list_prompts)
+
+    async def aget_prompt(self, name: str) -> Optional[str]:
+        """Awaitable ``get_prompt``."""
+        return await run_blocking(self.conn, self.get_prompt, name)
+
+    async def acreate_prompt(self, name: str, prompt: str) -> bool:
+        """Awaitable ``create_prompt``."""
+        return await run_blocking(
+            self.conn, self.create_prompt, name, prompt, kind="write"
+        )
+
+    async def aupdate_prompt(self, prompt_name: str, new_prompt: str) -> bool:
+        """Awaitable ``update_prompt``."""
+        return await run_blocking(
+            self.conn, self.update_prompt, prompt_name, new_prompt, kind="write"
+        )
+
+    async def adelete_prompt(self, prompt_id: str) -> bool:
+        """Awaitable ``delete_prompt``."""
+        return await run_blocking(
+            self.conn, self.delete_prompt, prompt_id, kind="write"
+        )
+
 
 # Example usage:
 # handler = SystemPromptHandler(db_connection)
@@ -0,0 +1,34 @@
+"""
+Fixtures shared by the tests of the memory package.
+"""
+
+import sqlite3
+from typing import Tuple
+from unittest.mock import MagicMock
+from database.tokenizer import Tokenizer
+from memory.memory_manager import MemoryManager
+
+
+def word_tokenizer() -> Tokenizer:
+    """Returns a tokenizer that counts whitespace separated words."""
+    encoding = MagicMock()
+    encoding.encode.side_effect = lambda text: text.split()
+    return Tokenizer(encoding, name="words")
+
+
+def sqlite_memory_manager(**kwargs) -> Tuple[sqlite3.Connection, MemoryManager]:
+    """
+    Creates a MemoryManager on an in-memory database, for the project "project".
+
+    Keyword arguments are passed on to ``MemoryManager``.
+    """
+    # The write-behind queue and the background workers use the connection from their threads
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    # Owned by MyCodebase, read by the prompt handler
+    conn.execute(
+        "CREATE TABLE config (field TEXT PRIMARY KEY, value TEXT, last_updated TIMESTAMP)"
+    )
+    conn.execute("INSERT INTO config (field, value) VALUES ('directory', '.')")
+    memory_manager = MemoryManager(db_connection=conn, **kwargs)
+    memory_manager.project_directory = "project"
+    return conn, memory_manager
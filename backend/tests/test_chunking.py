@@ -0,0 +1,99 @@
+import unittest
+from unittest.mock import patch
+from database.chunking import chunk_file, parse_python, split_lines
+from database.symbols import Symbol, extract_symbols
+
+PYTHON_SOURCE = '''import os
+
+
+@decorator
+def top(a):
+    return a
+
+
+class Big:
+    """Doc."""
+
+    def one(self):
+        return 1
+
+    def two(self):
+        return 2
+'''
+
+
+class ChunkFileTests(unittest.TestCase):
+    def test_python_definitions_include_decorators(self):
+        chunks = chunk_file("m.py", PYTHON_SOURCE)
+        spans = [(c.start_line, c.end_line, c.kind, c.name) for c in chunks]
+        self.assertEqual(
+            spans,
+            [(1, 3, "lines", None), (4, 6, "function", "top"), (9, 16, "class", "Big")],
+        )
+        self.assertTrue(chunks[1].text.startswith("@decorator\ndef top"))
+
+    def test_large_classes_are_split_into_methods(self):
+        chunks = chunk_file("m.py", PYTHON_SOURCE, window_lines=3)
+        names = [(c.kind, c.name) for c in chunks if c.name]
+        self.assertEqual(
+            names, [("function", "top"), ("method", "Big.one"), ("method", "Big.two")]
+        )
+        covered = "".join(c.text for c in chunks)
+        self.assertEqual(
+            [line for line in covered.splitlines() if line.strip()],
+            [line for line in PYTHON_SOURCE.splitlines() if line.strip()],
+        )
+
+    def test_other_files_use_line_windows(self):
+        text = "".join(f"line {i}\n" for i in range(1, 11))
+        chunks = chunk_file("notes.md", text, window_lines=4)
+        self.assertEqual(
+            [(c.start_line, c.end_line) for c in chunks], [(1, 4), (5, 8), (9, 10)]
+        )
+        self.assertEqual("".join(c.text for c in chunks), text)
+
+    def test_unparsable_python_falls_back_to_windows(self):
+        chunks = chunk_file("broken.py", "def f(:\n    pass\n")
+        self.assertEqual([c.kind for c in chunks], ["lines"])
+
+    def test_only_real_line_endings_split_lines(self):
+        # str.splitlines would also split at the form feed and the line separator
+        text = (
+            'import os\n# page\x0cbreak\ns = "a\u2028b"\n\n\ndef f():\n    return s\n'
+        )
+        chunks = chunk_file("m.py", text)
+        self.assertEqual(
+            [(c.start_line, c.end_line, c.name) for c in chunks],
+            [(1, 5, None), (6, 7, "f")],
+        )
+        self.assertEqual(chunks[1].text, "def f():\n    return s\n")
+        self.assertEqual(split_lines("a\r\nb\rc\x0cd"), ["a\r\n", "b\r", "c\x0cd"])
+
+    def test_empty_file(self):
+        self.assertEqual(chunk_file("empty.py", ""), [])
+
+
+class ExtractSymbolsTests(unittest.TestCase):
+    def test_functions_classes_and_methods(self):
+        self.assertEqual(
+            extract_symbols("m.py", PYTHON_SOURCE),
+            [
+                Symbol("top", "function", 4, 6, None),
+                Symbol("Big", "class", 9, 16, None),
+                Symbol("one", "method", 12, 13, "Big"),
+                Symbol("two", "method", 15, 16, "Big"),
+            ],
+        )
+
+    def test_non_python_and_unparsable_files(self):
+        self.assertEqual(extract_symbols("m.md", PYTHON_SOURCE), [])
+        self.assertEqual(extract_symbols("m.py", "def broken(:\n"), [])
+
+    def test_parsed_tree_is_shared(self):
+        tree = parse_python("m.py", PYTHON_SOURCE)
+        with patch("ast.parse", side_effect=AssertionError):
+            chunks = chunk_file("m.py", PYTHON_SOURCE, tree=tree)
+            symbols = extract_symbols("m.py", PYTHON_SOURCE, tree)
+        self.assertEqual(chunks, chunk_file("m.py", PYTHON_SOURCE))
+        self.assertEqual(symbols, extract_symbols("m.py", PYTHON_SOURCE))
+        self.assertIsNone(parse_python("m.md", PYTHON_SOURCE))
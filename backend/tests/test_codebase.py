@@ -1,7 +1,13 @@
 import unittest
 import os
+import sqlite3
+import tempfile
 from unittest.mock import Mock
 from database.my_codebase import MyCodebase
+from database.tokenizer import get_tokenizer
+from memory.system_prompt_handler import SystemPromptHandler
+from database.file_tree import FileTree
+from database.watcher import CodebaseWatcher
 from unittest.mock import patch
 
 IGNORE_DIRS = ["node_modules", ".next", ".venv", "__pycache__", ".git"]
@@ -56,3 +62,557 @@ class MyCodebaseTests(unittest.TestCase):
     def test_tree(self, mock_encode):
         tree = self.codebase.tree()
         self.assertIsInstance(tree, str)
+
+
+class MyCodebaseIncrementalTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+        for name, body in (("a.py", "print('a')\n"), ("b.md", "# b\n")):
+            with open(os.path.join(self.directory, name), "w") as f:
+                f.write(body)
+        self.conn = sqlite3.connect(":memory:")
+        with patch("database.my_codebase.ENCODER.encode", return_value=[1, 2, 3]):
+            self.codebase = MyCodebase(
+                self.directory,
+                db_connection=self.conn,
+                ignore_dirs=IGNORE_DIRS,
+                file_extensions=FILE_EXTENSIONS,
+            )
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp.cleanup()
+
+    def test_stores_stat_and_hash(self):
+        rows = self.conn.execute(
+            "SELECT file_path, size, mtime_ns, content_hash FROM files"
+        ).fetchall()
+        self.assertEqual(len(rows), 2)
+        for file_path, size, mtime_ns, content_hash in rows:
+            st = os.stat(file_path)
+            self.assertEqual(size, st.st_size)
+            self.assertEqual(mtime_ns, st.st_mtime_ns)
+            self.assertEqual(len(content_hash), 64)
+
+    def test_unchanged_tree_is_not_read(self):
+        with patch("database.my_codebase.open", side_effect=AssertionError) as m:
+            self.codebase._update_files_and_embeddings()
+        m.assert_not_called()
+
+    @patch("database.my_codebase.ENCODER.encode", return_value=[1])
+    def test_touched_file_is_not_retokenized(self, mock_encode):
+        path = os.path.join(self.directory, "a.py")
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.codebase._update_files_and_embeddings()
+        mock_encode.assert_not_called()
+        mtime_ns = self.conn.execute(
+            "SELECT mtime_ns FROM files WHERE file_path = ?", (path,)
+        ).fetchone()[0]
+        self.assertEqual(mtime_ns, os.stat(path).st_mtime_ns)
+
+    @patch("database.my_codebase.ENCODER.encode", return_value=[1])
+    def test_changed_file_is_retokenized(self, mock_encode):
+        path = os.path.join(self.directory, "a.py")
+        with open(path, "w") as f:
+            f.write("print('changed')\n")
+        self.codebase._update_files_and_embeddings()
+        mock_encode.assert_any_call("print('changed')\n")
+        token_count = self.conn.execute(
+            "SELECT token_count FROM files WHERE file_path = ?", (path,)
+        ).fetchone()[0]
+        self.assertEqual(self.codebase.get_file_text(path), "print('changed')\n")
+        self.assertEqual(token_count, 1)
+
+    def test_deleted_files_are_removed_in_one_pass(self):
+        os.remove(os.path.join(self.directory, "b.md"))
+        self.conn.execute(
+            "INSERT INTO files (file_path, content_hash) VALUES (?, ?)",
+            ("/elsewhere/keep.py", "x"),
+        )
+        with patch.object(
+            self.codebase, "remove_old_files", side_effect=AssertionError
+        ):
+            self.codebase._update_files_and_embeddings()
+        paths = {row[0] for row in self.conn.execute("SELECT file_path FROM files")}
+        self.assertEqual(
+            paths, {os.path.join(self.directory, "a.py"), "/elsewhere/keep.py"}
+        )
+
+    @patch("database.my_codebase.ENCODER.encode", return_value=[1])
+    def test_parallel_scan_matches_serial_scan(self, mock_encode):
+        for i in range(20):
+            with open(os.path.join(self.directory, f"m{i}.py"), "w") as f:
+                f.write(f"x = {i}\n")
+        serial_conn = sqlite3.connect(":memory:")
+        MyCodebase(
+            self.directory,
+            db_connection=serial_conn,
+            ignore_dirs=IGNORE_DIRS,
+            file_extensions=FILE_EXTENSIONS,
+            max_workers=1,
+        )
+        parallel = MyCodebase(
+            self.directory,
+            db_connection=self.conn,
+            ignore_dirs=IGNORE_DIRS,
+            file_extensions=FILE_EXTENSIONS,
+            max_workers=4,
+        )
+        query = """
+            SELECT f.file_path, b.text, f.content_hash
+            FROM files f JOIN file_blobs b ON b.content_hash = f.content_hash
+            ORDER BY f.file_path
+        """
+        self.assertEqual(parallel.max_workers, 4)
+        self.assertEqual(
+            self.conn.execute(query).fetchall(), serial_conn.execute(query).fetchall()
+        )
+        serial_conn.close()
+
+    @patch("database.my_codebase.ENCODER.encode", return_value=[1])
+    def test_update_file_is_batched_until_flush(self, mock_encode):
+        self.codebase.batch_size = 2
+        self.codebase.flush_interval_ms = 60_000
+        self.codebase.flush()
+        paths = []
+        for name in ("c.py", "d.py"):
+            paths.append(os.path.join(self.directory, name))
+            with open(paths[-1], "w") as f:
+                f.write("pass\n")
+
+        count = "SELECT COUNT(*) FROM files WHERE file_path = ?"
+        self.codebase.update_file(paths[0])
+        self.assertEqual(self.conn.execute(count, (paths[0],)).fetchone()[0], 0)
+        self.codebase.update_file(paths[1])
+        self.assertEqual(self.conn.execute(count, (paths[0],)).fetchone()[0], 1)
+
+        with open(paths[0], "w") as f:
+            f.write("pass\npass\n")
+        self.codebase.update_file(paths[0])
+        self.assertEqual(self.codebase.flush(), 1)
+        self.assertEqual(self.codebase.flush(), 0)
+        self.assertEqual(self.codebase.get_file_text(paths[0]), "pass\npass\n")
+
+        # A row written by an older index version is re-indexed even though its stat matches
+        self.conn.execute(
+            "UPDATE files SET index_version = 0 WHERE file_path = ?", (paths[1],)
+        )
+        self.conn.execute("DELETE FROM chunks WHERE file_path = ?", (paths[1],))
+        self.conn.commit()
+        self.codebase.update_file(paths[1])
+        self.assertEqual(self.codebase.flush(), 1)
+        self.assertEqual(len(self.codebase.get_chunks(paths[1])), 1)
+
+    @patch("database.my_codebase.ENCODER.encode", return_value=[1])
+    def test_apply_changes_updates_rows_and_notifies(self, mock_encode):
+        notified = []
+        self.codebase.add_listener(notified.append)
+        created = os.path.join(self.directory, "c.py")
+        removed = os.path.join(self.directory, "b.md")
+        with open(created, "w") as f:
+            f.write("pass\n")
+        os.remove(removed)
+        self.codebase.apply_changes(changed={created}, removed={removed})
+        paths = {row[0] for row in self.conn.execute("SELECT file_path FROM files")}
+        self.assertEqual(paths, {os.path.join(self.directory, "a.py"), created})
+        self.assertEqual(notified, [{created, removed}])
+
+    @patch("database.my_codebase.ENCODER.encode", return_value=[1])
+    def test_tree_follows_incremental_changes(self, mock_encode):
+        self.assertEqual(self.codebase.tree().count("+--"), 3)
+        created = os.path.join(self.directory, "pkg", "c.py")
+        os.makedirs(os.path.dirname(created))
+        with open(created, "w") as f:
+            f.write("pass\n")
+        self.codebase.apply_changes(changed={created}, removed=set())
+        self.assertIn("+--pkg\n", self.codebase.tree())
+        os.remove(created)
+        self.codebase._update_files_and_embeddings()
+        self.assertNotIn("pkg", self.codebase.tree())
+
+    def test_search_similar_uses_stored_embeddings(self):
+        # Files are embedded by the first search, not by the scan
+        query = """
+            SELECT COUNT(*) FROM file_blobs WHERE embedding IS NOT NULL
+        """
+        self.assertEqual(self.conn.execute(query).fetchone()[0], 0)
+        results = self.codebase.search_similar("print a", k=1)
+        self.assertEqual(results[0][0], os.path.join(self.directory, "a.py"))
+        embedding = self.conn.execute(
+            """
+            SELECT b.embedding FROM files f
+            JOIN file_blobs b ON b.content_hash = f.content_hash
+            WHERE f.file_path LIKE '%a.py'
+            """
+        ).fetchone()[0]
+        self.assertEqual(len(embedding), self.codebase.embedder.dimensions * 4)
+
+        created = os.path.join(self.directory, "c.md")
+        with open(created, "w") as f:
+            f.write("print print print a a a\n")
+        with patch(
+            "database.my_codebase.ENCODER.encode", return_value=[1]
+        ), patch.object(self.codebase.embedder, "embed", side_effect=AssertionError):
+            self.codebase.apply_changes(changed={created}, removed=set())
+        paths = [path for path, _ in self.codebase.search_similar("print a", k=3)]
+        self.assertIn(created, paths)
+
+    @patch("database.my_codebase.ENCODER.encode", return_value=[1, 2])
+    def test_chunks_follow_file_hash(self, mock_encode):
+        path = os.path.join(self.directory, "a.py")
+        with open(path, "w") as f:
+            f.write("import os\n\n\ndef f():\n    return 1\n\n\nclass C:\n    x = 1\n")
+        self.codebase._update_files_and_embeddings()
+        chunks = self.codebase.get_chunks(path)
+        self.assertEqual(
+            [(c["start_line"], c["end_line"], c["kind"], c["name"]) for c in chunks],
+            [(1, 3, "lines", None), (4, 5, "function", "f"), (8, 9, "class", "C")],
+        )
+        self.assertEqual(chunks[0]["token_count"], 2)
+        self.assertEqual(chunks[1]["text"], "def f():\n    return 1\n")
+        # Only the line spans are stored, the text is sliced from the file body
+        self.assertEqual(
+            self.conn.execute(
+                "SELECT COUNT(*) FROM chunks WHERE text IS NOT NULL"
+            ).fetchone(),
+            (0,),
+        )
+
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        mock_encode.reset_mock()
+        self.codebase._update_files_and_embeddings()
+        mock_encode.assert_not_called()
+        self.assertEqual(self.codebase.get_chunks(path), chunks)
+
+        selected = self.codebase.select_chunks("class C", [path], token_budget=2)
+        self.assertEqual([c["name"] for c in selected], ["C"])
+
+        os.remove(path)
+        self.codebase._update_files_and_embeddings()
+        self.assertEqual(self.codebase.get_chunks(path), [])
+
+    @patch("database.my_codebase.ENCODER.encode", return_value=[1])
+    def test_large_files_in_prompt_are_excerpted(self, mock_encode):
+        path = os.path.join(self.directory, "big.py")
+        with open(path, "w") as f:
+            for name in ("alpha", "beta", "gamma"):
+                f.write(f"def {name}():\n    return '{name}'\n\n\n")
+        self.codebase._update_files_and_embeddings()
+        beta = [c for c in self.codebase.get_chunks(path) if c["name"] == "beta"][0]
+
+        handler = SystemPromptHandler(self.conn, identity="identity")
+        handler.directory = self.directory
+        handler.files_in_prompt = ["big.py", "a.py"]
+        handler.excerpt = self.codebase.excerpt
+        handler.file_token_budget = beta["token_count"]
+        handler.query = "what does beta return?"
+        handler.set_files_in_prompt(include_line_numbers=True)
+        self.assertIn(
+            "big.py:\n[lines 5-6]\n5 def beta():\n6     return 'beta'\n",
+            handler.system_file_contents,
+        )
+        self.assertNotIn("alpha", handler.system_file_contents)
+        # A file none of whose chunks fits the budget is sent whole
+        self.assertIn("a.py:\n1 print('a')", handler.system_file_contents)
+
+        handler.directory = self.directory
+        handler.file_token_budget = None
+        handler.set_files_in_prompt()
+        self.assertIn("def alpha():", handler.system_file_contents)
+
+    @patch("database.my_codebase.ENCODER.encode", return_value=[1])
+    def test_compressed_storage_reads_back_lazily(self, mock_encode):
+        a_path = os.path.join(self.directory, "a.py")
+        with patch.object(MyCodebase, "DICTIONARY_MIN_FILES", 2):
+            codebase = MyCodebase(
+                self.directory,
+                db_connection=self.conn,
+                ignore_dirs=IGNORE_DIRS,
+                file_extensions=FILE_EXTENSIONS,
+                compression="zlib",
+            )
+        rows = self.conn.execute(
+            "SELECT text, codec, dict_id FROM file_blobs"
+        ).fetchall()
+        self.assertTrue(all(isinstance(text, bytes) for text, _, _ in rows))
+        self.assertEqual({codec for _, codec, _ in rows}, {"zlib"})
+        self.assertEqual({dict_id for _, _, dict_id in rows}, {codebase._dictionary[0]})
+        self.assertEqual(codebase.get_file_text(a_path), "print('a')\n")
+        self.assertEqual(codebase.get_chunks(a_path)[0]["text"], "print('a')\n")
+        self.assertEqual(codebase.search("print")[0]["file_path"], a_path)
+
+        with open(a_path, "w") as f:
+            f.write("print('changed')\n")
+        codebase.apply_changes(changed={a_path}, removed=set())
+        self.assertEqual(codebase.get_file_text(a_path), "print('changed')\n")
+
+        handler = SystemPromptHandler(self.conn)
+        handler.directory = self.directory
+        handler.files_in_prompt = ["a.py"]
+        self.assertEqual(handler.get_file_contents(), {"a.py": "print('changed')\n"})
+
+    @patch("database.my_codebase.ENCODER.encode", return_value=[1])
+    def test_identical_files_share_one_blob(self, mock_encode):
+        a_path = os.path.join(self.directory, "a.py")
+        copy_path = os.path.join(self.directory, "copy.py")
+        with open(copy_path, "w") as f:
+            f.write("print('a')\n")
+        self.codebase._update_files_and_embeddings()
+        blobs = "SELECT COUNT(*) FROM file_blobs"
+        self.assertEqual(self.conn.execute(blobs).fetchone()[0], 2)
+
+        os.remove(copy_path)
+        self.codebase.apply_changes(changed=set(), removed={copy_path})
+        self.assertEqual(self.codebase.get_file_text(a_path), "print('a')\n")
+        with open(a_path, "w") as f:
+            f.write("print('b')\n")
+        self.codebase.apply_changes(changed={a_path}, removed=set())
+        self.assertEqual(self.conn.execute(blobs).fetchone()[0], 2)
+
+        plan = self.conn.execute(
+            "EXPLAIN QUERY PLAN SELECT file_path, token_count FROM files"
+        ).fetchall()
+        self.assertNotIn("file_blobs", " ".join(row[-1] for row in plan))
+
+    @patch("database.my_codebase.ENCODER.encode", return_value=[1])
+    def test_bodies_move_out_of_legacy_files_table(self, mock_encode):
+        conn = sqlite3.connect(":memory:")
+        conn.execute(
+            """
+            CREATE TABLE files (
+                file_path TEXT PRIMARY KEY, text TEXT, embedding BLOB, token_count INT,
+                summary TEXT, size INT, mtime_ns INT, content_hash TEXT,
+                index_version INT, last_updated TIMESTAMP
+            )
+            """
+        )
+        a_path = os.path.join(self.directory, "a.py")
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, content_hash FROM files WHERE file_path = ?",
+            (a_path,),
+        ).fetchone()
+        conn.execute(
+            """
+            INSERT INTO files (file_path, text, token_count, size, mtime_ns, content_hash, index_version)
+            VALUES (?, ?, 1, ?, ?, ?, ?)
+            """,
+            (a_path, "print('a')\n") + row + (MyCodebase.INDEX_VERSION,),
+        )
+        conn.commit()
+        with patch("database.my_codebase.open", side_effect=AssertionError):
+            codebase = MyCodebase(
+                self.directory,
+                db_connection=conn,
+                ignore_dirs=IGNORE_DIRS,
+                file_extensions=[".py"],
+            )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(files)")}
+        self.assertNotIn("text", columns)
+        self.assertEqual(codebase.get_file_text(a_path), "print('a')\n")
+        self.assertEqual(codebase.search("print")[0]["file_path"], a_path)
+        conn.close()
+
+    def test_search_ranks_files_and_follows_changes(self):
+        a_path = os.path.join(self.directory, "a.py")
+        b_path = os.path.join(self.directory, "b.md")
+        with open(b_path, "w") as f:
+            f.write("# get file contents\nget_file_contents is used here\n")
+        self.codebase.apply_changes(changed={b_path}, removed=set())
+        results = self.codebase.search("get_file_contents contents print")
+        self.assertEqual([r["file_path"] for r in results], [b_path, a_path])
+        self.assertGreater(results[0]["score"], results[1]["score"])
+        self.assertIn("get_file_contents", results[0]["snippet"])
+        self.assertEqual(self.codebase.search('" OR'), [])
+
+        os.remove(b_path)
+        self.codebase._update_files_and_embeddings()
+        self.assertEqual(
+            [r["file_path"] for r in self.codebase.search("contents print")],
+            [a_path],
+        )
+        self.assertEqual(
+            self.conn.execute("SELECT COUNT(*) FROM files_fts").fetchone()[0], 1
+        )
+
+    @patch("database.my_codebase.ENCODER.encode", return_value=[1])
+    def test_symbols_follow_file_changes(self, mock_encode):
+        path = os.path.join(self.directory, "a.py")
+        with open(path, "w") as f:
+            f.write("class C:\n    def run(self):\n        pass\n")
+        self.codebase.apply_changes(changed={path}, removed=set())
+        self.assertEqual(
+            self.codebase.find_symbol("run", "method", "C"),
+            [
+                {
+                    "name": "run",
+                    "kind": "method",
+                    "file_path": path,
+                    "start_line": 2,
+                    "end_line": 3,
+                    "parent": "C",
+                }
+            ],
+        )
+        self.assertEqual(self.codebase.find_symbol("run", "function"), [])
+        plan = self.conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM symbols WHERE name = ?", ("run",)
+        ).fetchall()
+        self.assertIn("USING INDEX symbols_name", " ".join(row[-1] for row in plan))
+
+        with open(path, "w") as f:
+            f.write("def run():\n    pass\n")
+        self.codebase.apply_changes(changed={path}, removed=set())
+        self.assertEqual(self.codebase.find_symbol("C"), [])
+        self.assertEqual(self.codebase.find_symbol("run")[0]["kind"], "function")
+
+        self.codebase.apply_changes(changed=set(), removed={path})
+        self.assertEqual(self.codebase.find_symbol("run"), [])
+
+    def test_model_change_recounts_stored_files(self):
+        path = os.path.join(self.directory, "a.py")
+        tokenizer = get_tokenizer("anthropic")
+        tokenizer.clear()
+        self.assertFalse(self.codebase.set_model("gpt-3.5-turbo"))
+        self.assertTrue(self.codebase.set_model("anthropic"))
+        # Counted from the stored bodies, nothing is read from disk or re-indexed
+        with patch("database.my_codebase.open", side_effect=AssertionError) as m:
+            self.codebase._update_files_and_embeddings()
+            with patch.object(tokenizer.encoding, "encode", return_value=[1] * 10):
+                chunks = self.codebase.get_chunks(path)
+        m.assert_not_called()
+        self.assertEqual([chunk["token_count"] for chunk in chunks], [12])
+        rows = self.conn.execute(
+            "SELECT token_count, token_model FROM files"
+        ).fetchall()
+        self.assertEqual(rows, [(12, tokenizer.name)] * 2)
+        # Recounted once per tokenizer
+        with patch.object(tokenizer.encoding, "encode") as mock_encode:
+            self.codebase.get_chunks(path)
+        mock_encode.assert_not_called()
+        # The budgeted tree is rendered again for the new tokenizer
+        self.codebase.tree_token_budget = 1000
+        _, tokens = self.codebase.render_tree()
+        self.codebase.set_model("gpt-3.5-turbo")
+        with patch.object(self.codebase.tokenizer.encoding, "encode", return_value=[1]):
+            self.assertEqual(self.codebase.render_tree()[1], 1)
+
+
+class CodebaseWatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+        os.makedirs(os.path.join(self.directory, "node_modules"))
+        self.codebase = Mock()
+        self.codebase.directory = self.directory
+        real = MyCodebase.__new__(MyCodebase)
+        real.ignore_dirs = IGNORE_DIRS
+        real.file_extensions = FILE_EXTENSIONS
+        self.codebase._is_valid_file = real._is_valid_file
+        self.codebase._is_valid_directory = real._is_valid_directory
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_events_are_debounced_and_filtered(self):
+        watcher = CodebaseWatcher(self.codebase, debounce_ms=0, use_polling=True)
+        path = os.path.join(self.directory, "a.py")
+        watcher.record(path, removed=False)
+        watcher.record(path, removed=True)
+        watcher.record(os.path.join(self.directory, "node_modules", "x.js"), False)
+        watcher.record(os.path.join(self.directory, "notes.json"), False)
+        self.assertEqual(watcher.apply_pending(), {path})
+        self.codebase.apply_changes.assert_called_once_with(
+            changed=set(), removed={path}
+        )
+        self.assertEqual(watcher.apply_pending(), set())
+
+
+def legacy_tree(file_paths, directory):
+    # The original MyCodebase.tree() algorithm, kept to check the trie renders the same
+    tree = {}
+    start_from = os.path.basename(directory)
+    for file_path in sorted(p for p in file_paths if p.startswith(directory)):
+        parts = file_path.split(os.path.sep)
+        if start_from in parts:
+            parts = parts[parts.index(start_from) :]
+        current_level = tree
+        for part in parts:
+            current_level = current_level.setdefault(part, {})
+
+    def build_tree_string(current_level, indent=""):
+        tree_string = ""
+        for part in current_level:
+            tree_string += f"{indent}+--{part}\n"
+            tree_string += build_tree_string(current_level[part], indent + "    ")
+        return tree_string
+
+    return build_tree_string(tree)
+
+
+class FileTreeTests(unittest.TestCase):
+    DIRECTORY = os.path.join(os.path.sep, "work", "project")
+    PATHS = [
+        "src/app.py",
+        "src/a.b/x.py",
+        "src/a/y.py",
+        "src/a",
+        "docs/index.md",
+        "README.md",
+        "src/a-b.py",
+    ]
+
+    def setUp(self):
+        self.codebase = MyCodebase.__new__(MyCodebase)
+        self.codebase.directory = self.DIRECTORY
+        self.codebase.file_tree = FileTree()
+        self.paths = [os.path.join(self.DIRECTORY, *p.split("/")) for p in self.PATHS]
+        self.paths.remove(os.path.join(self.DIRECTORY, "src", "a"))
+        for path in self.paths:
+            self.codebase._tree_add(path)
+
+    def test_render_matches_legacy_tree(self):
+        self.assertEqual(
+            self.codebase.file_tree.render(), legacy_tree(self.paths, self.DIRECTORY)
+        )
+
+    def test_render_is_memoized_until_changed(self):
+        file_tree = self.codebase.file_tree
+        first = file_tree.render()
+        self.assertIs(file_tree.render(), first)
+        version = file_tree.version
+        self.codebase._tree_add(self.paths[0])
+        self.assertEqual(file_tree.version, version)
+        self.assertIs(file_tree.render(), first)
+
+    def test_remove_prunes_empty_directories(self):
+        removed = os.path.join(self.DIRECTORY, "docs", "index.md")
+        self.codebase._tree_remove(removed)
+        self.paths.remove(removed)
+        rendered = self.codebase.file_tree.render()
+        self.assertNotIn("docs", rendered)
+        self.assertEqual(rendered, legacy_tree(self.paths, self.DIRECTORY))
+        self.assertFalse(self.codebase.file_tree.remove(["project", "missing.py"]))
+
+    def test_budgeted_render_collapses_directories(self):
+        file_tree = self.codebase.file_tree
+        for i in range(40):
+            self.codebase._tree_add(
+                os.path.join(self.DIRECTORY, "tests", f"test_module_{i}.py")
+            )
+        full = file_tree.render()
+        rendered, tokens = file_tree.render_budgeted(40)
+        self.assertLessEqual(tokens, 40)
+        self.assertIn("+--tests/ (40 files)\n", rendered)
+        self.assertLess(len(rendered), len(full))
+
+        focus_path = os.path.join(self.DIRECTORY, "tests", "test_module_3.py")
+        focus = [self.codebase._tree_parts(focus_path)]
+        rendered, _ = file_tree.render_budgeted(40, focus)
+        self.assertIn("+--tests\n", rendered)
+        self.assertIn("test_module_3.py", rendered)
+
+        rendered, _ = file_tree.render_budgeted(10_000)
+        self.assertEqual(rendered, full)
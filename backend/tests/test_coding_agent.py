@@ -59,6 +59,21 @@ class TestCodingAgent(unittest.TestCase):
         # Check that the diffs match what we expect
         self.assertEqual(diffs, expected_diffs)
 
+    def test_resolve_op_file_uses_symbol_index(self):
+        codebase = MagicMock()
+        codebase.find_symbol.return_value = [{"file_path": "pkg/real.py"}]
+        self.agent.codebase = codebase
+        op = DeleteFunction(file_name="guessed.py", function_name="example")
+        self.assertEqual(self.agent.resolve_op_file(op), "pkg/real.py")
+        codebase.find_symbol.assert_called_once_with("example", "function")
+
+        codebase.find_symbol.return_value = [
+            {"file_path": "pkg/real.py"},
+            {"file_path": "pkg/other.py"},
+        ]
+        self.assertEqual(self.agent.resolve_op_file(op), "guessed.py")
+        self.assertEqual(self.agent.resolve_op_file(add_function_op), "example.py")
+
 
 class TestCodingAgent1(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,137 @@
+import unittest
+from unittest.mock import patch
+from memory_fixtures import sqlite_memory_manager, word_tokenizer
+
+
+class ConversationCompactorTests(unittest.TestCase):
+    def setUp(self):
+        self.conn, self.memory_manager = sqlite_memory_manager(max_tokens=40)
+        self.memory_manager.tokenizer = word_tokenizer()
+
+    def tearDown(self):
+        self.memory_manager.close()
+        self.conn.close()
+
+    def add_turns(self, turns):
+        self.conn.executemany(
+            """
+            INSERT INTO default_memory
+            (interaction_index, role, content, content_tokens, project_directory, token_model)
+            VALUES (?, ?, ?, ?, 'project', 'words')
+            """,
+            [
+                (index, role, content, len(content.split()))
+                for index, role, content in turns
+            ],
+        )
+        self.conn.commit()
+
+    def session(self, day, hour, name, count=2):
+        return [
+            (
+                f"2024-03-{day:02d}T{hour:02d}:{minute:02d}:00",
+                "user" if minute % 2 == 0 else "assistant",
+                f"{name}{minute} " + "word " * 9,
+            )
+            for minute in range(count)
+        ]
+
+    def test_sessions_fold_into_days_and_days_into_the_project(self):
+        self.memory_manager.enable_compaction(digest_tokens=1000, fold_limit=100)
+        compactor = self.memory_manager.compactor
+        self.add_turns(
+            self.session(1, 9, "a")
+            + self.session(1, 14, "b")
+            + self.session(2, 9, "c")
+            + self.session(2, 14, "d")
+        )
+        self.assertEqual(compactor.compact("project", "~"), 8)
+        project, day, session = compactor.digests("project")
+        self.assertEqual((project.tier, project.message_count), ("project", 4))
+        self.assertIn("a0", project.text)
+        self.assertIn("b1", project.text)
+        self.assertEqual((day.period, day.message_count), ("2024-03-02", 2))
+        self.assertIn("c1", day.text)
+        self.assertEqual((session.tier, session.message_count), ("session", 2))
+        self.assertTrue(session.text.startswith("user: d0"))
+        # The current digests are read back from the table
+        compactor.clear()
+        self.assertEqual(compactor.digests("project"), [project, day, session])
+        self.assertEqual(compactor.compact("project", "~"), 0)
+
+    def test_each_turn_folds_a_bounded_number_of_old_turns(self):
+        self.memory_manager.enable_compaction(digest_tokens=15, fold_limit=2)
+        self.add_turns(self.session(1, 9, "t", count=20))
+        messages = self.memory_manager.get_messages()
+        self.memory_manager.compactor.wait(5)
+        # Four turns of ten tokens fit, the rest only leaves the window
+        self.assertEqual(len(messages), 5)
+        self.assertEqual(
+            self.memory_manager.compactor.digests("project")[0].message_count, 2
+        )
+        for _ in range(20):
+            messages = self.memory_manager.get_messages()
+            self.memory_manager.compactor.wait(5)
+        (session,) = self.memory_manager.compactor.digests("project")
+        self.assertLessEqual(self.memory_manager.tokenizer.count(session.text), 15)
+        self.assertIn("Earlier in this session:", messages[0]["content"])
+        # The digest takes its share of the budget, the window shrinks to fit it
+        tokens = sum(
+            self.memory_manager.tokenizer.count(message["content"])
+            for message in messages[1:]
+        )
+        self.assertLessEqual(
+            tokens, 40 - self.memory_manager.tokenizer.count(session.text)
+        )
+        # Every turn left out of the window has been folded, the chat box shows no digests
+        self.assertEqual(session.message_count + len(messages) - 1, 20)
+        self.assertNotIn(
+            "Earlier", self.memory_manager.get_messages(chat_box=True)[0]["content"]
+        )
+
+    def test_window_is_unchanged_without_compaction(self):
+        # Compaction is opt-in, the default window keeps the whole budget for recent turns
+        self.assertIsNone(self.memory_manager.compactor)
+        self.add_turns(self.session(1, 9, "t", count=20))
+        messages = self.memory_manager.get_messages()
+        self.assertEqual(
+            messages[0]["content"], self.memory_manager.prompt_handler.system
+        )
+        self.assertEqual(
+            [message["content"].split()[0] for message in messages[1:]],
+            ["t16", "t17", "t18", "t19"],
+        )
+
+    def test_turns_in_the_window_cost_no_folding(self):
+        self.memory_manager.enable_compaction(digest_tokens=1000)
+        compactor = self.memory_manager.compactor
+        self.add_turns(self.session(1, 9, "t", count=2))
+        self.memory_manager.get_messages()
+        self.assertTrue(compactor.wait(5))
+        with patch.object(compactor, "compact") as compact:
+            self.memory_manager.get_messages()
+            self.memory_manager.get_messages()
+        compact.assert_not_called()
+
+    def test_queued_turns_are_not_flushed_for_folding(self):
+        self.memory_manager.write_behind = True
+        self.memory_manager.flush_interval_ms = 60000
+        self.memory_manager.enable_compaction(digest_tokens=1000, fold_limit=100)
+        self.add_turns(self.session(1, 9, "t", count=8))
+        # Loads the cache, the window is served from it from now on
+        self.memory_manager.get_messages()
+        self.assertTrue(self.memory_manager.compactor.wait(5))
+        for i in range(4):
+            self.memory_manager.add_message(
+                "user" if i % 2 else "assistant", "new " * 9
+            )
+        self.memory_manager.get_messages()
+        self.assertTrue(self.memory_manager.compactor.wait(5))
+        count = self.conn.execute("SELECT COUNT(*) FROM default_memory").fetchone()[0]
+        self.assertEqual(count, 8)
+        (session,) = self.memory_manager.compactor.digests("project")
+        self.assertEqual(session.message_count, 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+from database.compression import compress_text, decompress_text, train_dictionary
+
+SOURCES = [
+    f"import os\nimport sys\nfrom typing import List\n\n\ndef handler_{i}(event):\n    return {i}\n"
+    for i in range(20)
+]
+
+
+class CompressionTests(unittest.TestCase):
+    def test_round_trip(self):
+        for codec in (None, "zlib"):
+            stored = compress_text(SOURCES[0], codec)
+            self.assertEqual(decompress_text(stored, codec), SOURCES[0])
+        self.assertIsNone(decompress_text(None, "zlib"))
+
+    def test_dictionary_shrinks_small_files(self):
+        dictionary = train_dictionary(SOURCES[:10], "zlib")
+        self.assertIn(b"from typing import List\n", dictionary)
+        text = SOURCES[15]
+        plain = compress_text(text, "zlib")
+        shared = compress_text(text, "zlib", dictionary)
+        self.assertLess(len(shared), len(plain))
+        self.assertEqual(decompress_text(shared, "zlib", dictionary), text)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            compress_text("x", "lz4")
@@ -0,0 +1,173 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from database.connection import ConnectionManager, run_blocking
+from database.my_codebase import MyCodebase
+
+
+class ConnectionManagerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.manager = ConnectionManager(
+            os.path.join(self.tmp.name, "test.db"), pool_size=2
+        )
+        with self.manager.write() as conn:
+            conn.execute("CREATE TABLE t (a INT)")
+            conn.execute("INSERT INTO t (a) VALUES (1)")
+
+    def tearDown(self):
+        self.manager.close()
+        self.tmp.cleanup()
+
+    def test_wal_and_pragmas(self):
+        self.assertTrue(self.manager.has_readers)
+        with self.manager.read() as conn:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            # NORMAL
+            self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 1)
+            self.assertEqual(conn.execute("PRAGMA cache_size").fetchone()[0], -65536)
+            self.assertEqual(conn.execute("PRAGMA query_only").fetchone()[0], 1)
+            # INCREMENTAL, for the memory retention
+            self.assertEqual(conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+
+    def test_reads_do_not_wait_for_an_open_write(self):
+        started, finish = threading.Event(), threading.Event()
+
+        def write():
+            with self.manager.write() as conn:
+                conn.execute("INSERT INTO t (a) VALUES (2)")
+                started.set()
+                finish.wait(5)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        started.wait(5)
+        try:
+            # The writer holds the lock with its insert uncommitted
+            self.assertFalse(self.manager.lock.acquire(blocking=False))
+            with self.manager.read() as conn:
+                rows = conn.execute("SELECT a FROM t").fetchall()
+            self.assertEqual(rows, [(1,)])
+        finally:
+            finish.set()
+            writer.join()
+        with self.manager.read() as conn:
+            self.assertEqual(conn.execute("SELECT count(*) FROM t").fetchone()[0], 2)
+
+    def test_failed_write_is_rolled_back(self):
+        with self.assertRaises(ValueError):
+            with self.manager.write() as conn:
+                conn.execute("INSERT INTO t (a) VALUES (2)")
+                raise ValueError("boom")
+        with self.manager.read() as conn:
+            self.assertEqual(conn.execute("SELECT count(*) FROM t").fetchone()[0], 1)
+
+    def test_readers_are_pooled(self):
+        with self.manager.read() as first, self.manager.read() as second:
+            self.assertIsNot(first, second)
+        with self.manager.read() as again:
+            self.assertIn(again, (first, second))
+        self.assertEqual(len(self.manager._readers), 2)
+
+    def test_in_memory_database_reads_through_the_writer(self):
+        manager = ConnectionManager(":memory:")
+        self.assertFalse(manager.has_readers)
+        with manager.read() as conn:
+            self.assertIs(conn, manager.writer)
+        manager.close()
+
+
+class SharedConnectionTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp.name, "repo")
+        os.makedirs(self.directory)
+        with open(os.path.join(self.directory, "a.py"), "w") as f:
+            f.write("def handle_request():\n    pass\n")
+        self.manager = ConnectionManager(os.path.join(self.tmp.name, "test.db"))
+        with patch("database.my_codebase.ENCODER.encode", return_value=[1]):
+            self.codebase = MyCodebase(
+                self.directory,
+                db_connection=self.manager,
+                file_extensions=[".py"],
+                ignore_dirs=[],
+            )
+
+    def tearDown(self):
+        self.manager.close()
+        self.tmp.cleanup()
+
+    def test_codebase_reads_while_a_write_is_open(self):
+        self.assertIs(self.codebase.write_lock, self.manager.lock)
+        done = threading.Event()
+
+        def search():
+            self.results = self.codebase.search("handle_request")
+            self.text = self.codebase.get_file_text(
+                os.path.join(self.directory, "a.py")
+            )
+            done.set()
+
+        with self.manager.lock:
+            self.manager.execute(
+                "INSERT INTO config (field, value) VALUES ('pending', 'x')"
+            )
+            reader = threading.Thread(target=search)
+            reader.start()
+            self.assertTrue(done.wait(5))
+            self.manager.rollback()
+        reader.join()
+        self.assertEqual(len(self.results), 1)
+        self.assertIn("handle_request", self.text)
+
+
+class RunBlockingTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp.name, "repo")
+        os.makedirs(self.directory)
+        with open(os.path.join(self.directory, "a.py"), "w") as f:
+            f.write("def handle_request():\n    pass\n")
+        self.manager = ConnectionManager(os.path.join(self.tmp.name, "test.db"))
+        with patch("database.my_codebase.ENCODER.encode", return_value=[1]):
+            self.codebase = MyCodebase(
+                self.directory,
+                db_connection=self.manager,
+                file_extensions=[".py"],
+                ignore_dirs=[],
+            )
+
+    async def asyncTearDown(self):
+        self.manager.close()
+        self.tmp.cleanup()
+
+    async def test_reads_and_writes_run_on_their_own_threads(self):
+        def thread_name():
+            return threading.current_thread().name
+
+        read = await run_blocking(self.manager, thread_name)
+        write = await run_blocking(self.manager, thread_name, kind="write")
+        self.assertTrue(read.startswith("db-read"))
+        self.assertTrue(write.startswith("db-write"))
+
+    async def test_slow_rescan_does_not_block_reads(self):
+        def slow_scan():
+            with self.codebase.lock:
+                time.sleep(0.5)
+
+        with patch.object(self.codebase, "_update_files_and_embeddings", slow_scan):
+            rescan = asyncio.ensure_future(self.codebase.arescan())
+            started = time.monotonic()
+            results = await self.codebase.asearch("handle_request")
+            self.assertLess(time.monotonic() - started, 0.4)
+            self.assertFalse(rescan.done())
+            await rescan
+        self.assertEqual(len(results), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
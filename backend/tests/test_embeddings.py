@@ -0,0 +1,64 @@
+import unittest
+import numpy as np
+from database.embeddings import (
+    HashingEmbedder,
+    VectorIndex,
+    create_vector_index,
+    pack_vector,
+    unpack_vector,
+)
+
+
+class HashingEmbedderTests(unittest.TestCase):
+    def setUp(self):
+        self.embedder = HashingEmbedder(dimensions=128)
+
+    def test_embedding_is_deterministic_and_normalized(self):
+        first = self.embedder.embed("def get_file_contents(self): pass")
+        second = HashingEmbedder(dimensions=128).embed(
+            "def get_file_contents(self): pass"
+        )
+        self.assertEqual(first.dtype, np.float32)
+        self.assertEqual(first.shape, (128,))
+        np.testing.assert_array_equal(first, second)
+        self.assertAlmostEqual(float(np.linalg.norm(first)), 1.0, places=5)
+
+    def test_identifier_styles_share_features(self):
+        snake = self.embedder.embed("get_file_contents")
+        camel = self.embedder.embed("getFileContents")
+        other = self.embedder.embed("tokenizer budget window")
+        self.assertGreater(float(snake @ camel), float(snake @ other))
+
+    def test_empty_text(self):
+        vector = self.embedder.embed("")
+        self.assertEqual(float(np.abs(vector).sum()), 0.0)
+
+    def test_pack_round_trip(self):
+        vector = self.embedder.embed("class MemoryManager")
+        np.testing.assert_array_equal(unpack_vector(pack_vector(vector)), vector)
+
+
+class VectorIndexTests(unittest.TestCase):
+    def test_search_returns_most_similar_first(self):
+        embedder = HashingEmbedder(dimensions=128)
+        index = create_vector_index(128)
+        self.assertIsInstance(index, VectorIndex)
+        documents = {
+            "memory.py": "class MemoryManager: def get_messages(self): window tokens",
+            "tree.py": "class FileTree: def render(self): directory trie",
+            "watcher.py": "class CodebaseWatcher: inotify debounce events",
+        }
+        for key, text in documents.items():
+            index.add(key, embedder.embed(text))
+        results = index.search(embedder.embed("render the directory tree"), k=2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0][0], "tree.py")
+        self.assertGreaterEqual(results[0][1], results[1][1])
+
+        index.remove("tree.py")
+        keys = [key for key, _ in index.search(embedder.embed("directory"), k=5)]
+        self.assertEqual(sorted(keys), ["memory.py", "watcher.py"])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            create_vector_index(8, "faiss")
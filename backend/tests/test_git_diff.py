@@ -0,0 +1,163 @@
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from memory import git_diff
+from memory.git_diff import GitDiffCache, find_git_dir, read_ref
+
+
+def git(directory, *args):
+    return subprocess.run(
+        ["git", "-C", directory, "-c", "user.email=t@t", "-c", "user.name=t", *args],
+        check=True,
+        stdout=subprocess.PIPE,
+        text=True,
+    ).stdout.strip()
+
+
+class GitDiffCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repo = os.path.realpath(self.tmp.name)
+        git(self.repo, "init", "-q", "-b", "main")
+        self.write("app.py", "print('hello')\n")
+        git(self.repo, "add", "app.py")
+        git(self.repo, "commit", "-q", "-m", "initial")
+        self.cache = GitDiffCache(stat_interval_ms=0)
+        self.runs = 0
+        run = git_diff.git_diff
+
+        def counted(*args):
+            self.runs += 1
+            return run(*args)
+
+        patcher = patch.object(git_diff, "git_diff", side_effect=counted)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.repo, name)
+        with open(path, "w") as f:
+            f.write(text)
+        # Coarse file system timestamps would hide quick successive writes
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    def settle(self):
+        # Background refreshes started by earlier gets finish before the worktree changes
+        for thread in list(self.cache._refreshing.values()):
+            thread.join()
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_refs_are_read_without_git(self):
+        self.assertEqual(find_git_dir(self.repo), os.path.join(self.repo, ".git"))
+        head = git(self.repo, "rev-parse", "HEAD")
+        self.assertEqual(read_ref(find_git_dir(self.repo), "HEAD"), head)
+        git(self.repo, "pack-refs", "--all")
+        self.assertEqual(read_ref(find_git_dir(self.repo), "main"), head)
+        self.assertIsNone(read_ref(find_git_dir(self.repo), "missing"))
+        self.assertIsNone(find_git_dir("/"))
+
+    def test_unchanged_worktree_is_served_from_the_cache(self):
+        self.assertEqual(self.cache.get(self.repo), "")
+        self.assertEqual(self.cache.get(self.repo), "")
+        self.assertEqual(self.runs, 1)
+        self.settle()
+        self.write("app.py", "print('changed')\n")
+        # The previous diff is served while the new one is computed
+        self.assertEqual(self.cache.get(self.repo), "")
+        self.assertTrue(self.wait_for(lambda: "changed" in self.cache.get(self.repo)))
+        self.assertEqual(self.runs, 2)
+        # A commit moves HEAD
+        self.settle()
+        git(self.repo, "checkout", "-q", "-b", "feature")
+        git(self.repo, "commit", "-q", "-am", "change")
+        self.assertIn("changed", self.cache.get(self.repo, wait=True))
+        self.assertEqual(self.runs, 3)
+
+    def test_files_the_watcher_ignores_are_noticed(self):
+        self.write("style.css", "body { color: red; }\n")
+        git(self.repo, "add", "style.css")
+        git(self.repo, "commit", "-q", "-m", "style")
+        self.cache.get(self.repo)
+        self.cache.notify_changed(self.repo)
+        self.settle()
+        # The watcher only reports source files, the files git reports changed cover the rest
+        self.write("style.css", "body { color: blue; }\n")
+        self.assertTrue(self.wait_for(lambda: "blue" in self.cache.get(self.repo)))
+
+    def test_worktree_is_checked_off_the_callers_thread(self):
+        self.cache.get(self.repo)
+        threads = []
+        stat_worktree = GitDiffCache._stat_worktree
+
+        def recorded(cache, directory):
+            threads.append(threading.current_thread())
+            return stat_worktree(cache, directory)
+
+        with patch.object(GitDiffCache, "_stat_worktree", recorded):
+            self.write("app.py", "print('changed')\n")
+            self.assertEqual(self.cache.get(self.repo), "")
+            self.assertTrue(
+                self.wait_for(lambda: "changed" in self.cache.get(self.repo))
+            )
+        self.assertTrue(threads)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_checks_are_throttled(self):
+        self.cache.stat_interval_ms = 60 * 1000
+        self.cache.get(self.repo)
+        with patch.object(GitDiffCache, "_stat_worktree") as stat_worktree:
+            self.write("app.py", "print('changed')\n")
+            self.assertEqual(self.cache.get(self.repo), "")
+            self.assertEqual(self.cache.get(self.repo), "")
+            stat_worktree.assert_not_called()
+            # A watcher notification is picked up right away
+            self.cache.notify_changed(self.repo)
+            self.assertTrue(
+                self.wait_for(lambda: "changed" in self.cache.get(self.repo))
+            )
+
+    def test_only_files_git_reports_are_checked(self):
+        os.makedirs(os.path.join(self.repo, "node_modules"))
+        self.write("node_modules/lib.js", "x\n")
+        self.write("notes.txt", "todo\n")
+        self.assertEqual(
+            [path for path, _, _ in self.cache._stat_worktree(self.repo)],
+            ["notes.txt"],
+        )
+        self.write("app.py", "print('changed')\n")
+        os.makedirs(os.path.join(self.repo, "sub"))
+        # Changes outside the directory are part of its diff too
+        self.assertEqual(
+            [
+                path
+                for path, _, _ in self.cache._stat_worktree(
+                    os.path.join(self.repo, "sub")
+                )
+            ],
+            ["../app.py", "../notes.txt"],
+        )
+
+    def test_own_writes_are_diffed_before_returning(self):
+        self.cache.stat_interval_ms = 60 * 1000
+        self.assertEqual(self.cache.get(self.repo), "")
+        self.write("app.py", "print('changed')\n")
+        self.cache.notify_changed(self.repo, wait=True)
+        self.assertIn("changed", self.cache.get(self.repo))
+        self.assertEqual(self.runs, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,10 @@
+import sqlite3
+import time
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
+from database.tokenizer import get_tokenizer
 from memory.memory_manager import MemoryManager
+from memory_fixtures import sqlite_memory_manager
 
 
 class TestMemoryManager:
@@ -79,6 +83,121 @@ class TestMemoryManager1(unittest.TestCase):
         self.assertIn(role, params)
         self.assertIn(content, params)
 
+    def test_write_behind_serves_turns_from_the_cache(self):
+        conn, memory_manager = sqlite_memory_manager(
+            write_behind=True, flush_interval_ms=60000
+        )
+        self.assertEqual(memory_manager.get_messages()[1:], [])
+        memory_manager.add_message("user", "question")
+        memory_manager.add_message("assistant", "answer")
+        with patch.object(
+            memory_manager, "_read_message_window", side_effect=AssertionError
+        ):
+            messages = memory_manager.get_messages()
+        self.assertEqual(
+            [message["content"] for message in messages[1:]], ["question", "answer"]
+        )
+        count = "SELECT COUNT(*) FROM default_memory"
+        self.assertEqual(conn.execute(count).fetchone()[0], 0)
+        memory_manager.close()
+        self.assertEqual(conn.execute(count).fetchone()[0], 2)
+        # Once closed, messages are inserted right away
+        memory_manager.add_message("user", "late")
+        self.assertEqual(conn.execute(count).fetchone()[0], 3)
+        conn.close()
+
+    def test_write_behind_flushes_full_batches(self):
+        conn, memory_manager = sqlite_memory_manager(
+            write_behind=True, batch_size=2, flush_interval_ms=60000
+        )
+        memory_manager.add_message("user", "question")
+        memory_manager.add_message("assistant", "answer")
+        count = "SELECT COUNT(*) FROM default_memory"
+        deadline = time.monotonic() + 5
+        while conn.execute(count).fetchone()[0] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(conn.execute(count).fetchone()[0], 2)
+        memory_manager.close()
+        conn.close()
+
+    def test_failed_flush_keeps_the_queued_turns(self):
+        conn, memory_manager = sqlite_memory_manager(
+            write_behind=True, flush_interval_ms=60000
+        )
+        for i in range(4):
+            memory_manager.add_message(
+                "user" if i % 2 == 0 else "assistant", f"turn {i}"
+            )
+        # Another writer took the primary key of the second turn
+        taken = memory_manager._pending_messages[1][0]
+        conn.execute(
+            "INSERT INTO default_memory (interaction_index, content, project_directory) VALUES (?, 'other', 'elsewhere')",
+            (taken,),
+        )
+        conn.commit()
+        self.assertEqual(memory_manager.flush(), 3)
+        stored = conn.execute(
+            "SELECT content FROM default_memory WHERE project_directory = 'project' ORDER BY interaction_index"
+        ).fetchall()
+        self.assertEqual(stored, [("turn 0",), ("turn 2",), ("turn 3",)])
+        # A database that is unavailable keeps the queue for the next flush
+        memory_manager.add_message("user", "turn 4")
+        cur = memory_manager.cur
+        memory_manager.cur = Mock()
+        memory_manager.cur.executemany.side_effect = sqlite3.OperationalError("locked")
+        self.assertEqual(memory_manager.flush(), 0)
+        memory_manager.cur = cur
+        self.assertEqual(memory_manager.flush(), 1)
+        memory_manager.close()
+        conn.close()
+
+    def test_message_window_walks_back_over_pages(self):
+        conn, memory_manager = sqlite_memory_manager()
+        conn.executemany(
+            """
+            INSERT INTO default_memory
+            (interaction_index, role, content, content_tokens, project_directory, token_model)
+            VALUES (?, ?, ?, 10, ?, ?)
+            """,
+            [
+                (
+                    f"2024-01-01T00:{i // 60:02d}:{i % 60:02d}",
+                    "user" if i % 2 else "assistant",
+                    f"message {i}",
+                    "other" if i == 99 else "project",
+                    memory_manager.tokenizer.name,
+                )
+                for i in range(100)
+            ],
+        )
+        window = memory_manager.get_message_window(555)
+        self.assertEqual(
+            [row[2] for row in window], [f"message {i}" for i in range(98, 43, -1)]
+        )
+        self.assertEqual(len(memory_manager.get_message_window(10**6)), 99)
+        conn.close()
+
+    def test_model_change_recounts_stored_messages(self):
+        conn, memory_manager = sqlite_memory_manager()
+        memory_manager.add_message("user", "one two three four five")
+        memory_manager.enable_compaction()
+        tokenizer = get_tokenizer("anthropic")
+        tokenizer.clear()
+        memory_manager.set_model("anthropic")
+        self.assertIs(memory_manager.compactor.summarizer.tokenizer, tokenizer)
+        with patch.object(
+            tokenizer.encoding, "encode", return_value=[1] * 5
+        ) as mock_encode:
+            memory_manager.get_messages()
+            memory_manager.get_messages()
+        mock_encode.assert_called_once_with("one two three four five")
+        rows = conn.execute(
+            "SELECT content_tokens, token_model FROM default_memory"
+        ).fetchall()
+        self.assertEqual(rows, [(6, tokenizer.name)])
+        memory_manager.compactor.stop()
+        conn.close()
+
     # def test_get_context(self):
     #     # Arrange: Prepare the context to be added
     #     messages = [
@@ -0,0 +1,103 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch
+from database.migrations import Migration, prefix_range, run_migrations
+from database.my_codebase import (
+    DIRECTORY_FILES_QUERY,
+    FILE_INDEX_QUERY,
+    OTHER_FILES_QUERY,
+    MyCodebase,
+)
+from memory.memory_manager import MESSAGE_PAGE_QUERY, MemoryManager
+
+
+def query_plan(conn, query, params=()):
+    return " | ".join(
+        row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)
+    )
+
+
+class RunMigrationsTests(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.migrations = [
+            Migration(1, "table", ["CREATE TABLE t (a INT)"]),
+            Migration(
+                2, "index", [lambda cur: cur.execute("CREATE INDEX t_a ON t (a)")]
+            ),
+        ]
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_versions_are_applied_once(self):
+        self.assertEqual(run_migrations(self.conn, "test", self.migrations), [1, 2])
+        self.assertEqual(run_migrations(self.conn, "test", self.migrations), [])
+        self.assertEqual(run_migrations(self.conn, "other", self.migrations[:0]), [])
+        versions = self.conn.execute(
+            "SELECT version FROM schema_migrations WHERE scope = 'test'"
+        ).fetchall()
+        self.assertEqual(versions, [(1,), (2,)])
+
+    def test_failed_migration_is_rolled_back(self):
+        broken = Migration(3, "broken", ["CREATE TABLE u (a INT)", "NOT SQL"])
+        with self.assertRaises(sqlite3.OperationalError):
+            run_migrations(self.conn, "test", self.migrations + [broken])
+        tables = {row[0] for row in self.conn.execute("SELECT name FROM sqlite_master")}
+        self.assertIn("t", tables)
+        self.assertNotIn("u", tables)
+        self.assertEqual(run_migrations(self.conn, "test", self.migrations), [])
+
+    def test_prefix_range(self):
+        self.assertEqual(prefix_range("/repo/"), ("/repo/", "/repo0"))
+
+
+class QueryPlanTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmp.name, "a.py"), "w") as f:
+            f.write("x = 1\n")
+        self.conn = sqlite3.connect(":memory:")
+        with patch("database.my_codebase.ENCODER.encode", return_value=[1]):
+            self.codebase = MyCodebase(
+                self.tmp.name,
+                db_connection=self.conn,
+                ignore_dirs=[],
+                file_extensions=[".py"],
+            )
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp.cleanup()
+
+    def test_message_window_uses_project_index(self):
+        self.codebase.set_directory(self.tmp.name)
+        MemoryManager(db_connection=self.conn)
+        plan = query_plan(
+            self.conn,
+            MESSAGE_PAGE_QUERY.format(table="default_memory"),
+            ("p", "~", 10),
+        )
+        self.assertIn(
+            "SEARCH default_memory USING INDEX default_memory_project_interaction",
+            plan,
+        )
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_directory_filters_use_file_path_index(self):
+        directory_range = self.codebase._directory_range()
+        for query in (
+            DIRECTORY_FILES_QUERY,
+            OTHER_FILES_QUERY,
+            "SELECT * FROM symbols WHERE file_path >= ? AND file_path < ?",
+            "SELECT * FROM chunks WHERE file_path >= ? AND file_path < ?",
+        ):
+            plan = query_plan(self.conn, query, directory_range)
+            self.assertIn("SEARCH", plan)
+            self.assertNotRegex(plan, r"SCAN \w+$")
+
+    def test_rescan_reads_covering_index(self):
+        plan = query_plan(self.conn, FILE_INDEX_QUERY, (MyCodebase.INDEX_VERSION,))
+        self.assertIn("COVERING INDEX files_stat", plan)
@@ -0,0 +1,96 @@
+import sqlite3
+import unittest
+from unittest.mock import MagicMock
+from memory.prompt_snapshots import (
+    PromptSnapshotStore,
+    apply_delta,
+    make_delta,
+    prompt_hash,
+)
+
+
+def prompt(turn, files=200):
+    # A tree and file contents that stay put, and a diff that grows every turn
+    tree = "".join(f"src/module_{i}.py\n" for i in range(files))
+    diff = "".join(f"+ change {i}\n" for i in range(turn))
+    return f"You are a pair programmer.\n{tree}Diff:\n{diff}"
+
+
+class DeltaTests(unittest.TestCase):
+    def test_delta_rebuilds_the_text(self):
+        base = "a\nb\nc\nd\n"
+        for text in ("a\nb\nc\nd\n", "a\nx\nc\nd\ne", "", "d\nc\nb\na\n"):
+            self.assertEqual(apply_delta(base, make_delta(base, text)), text)
+        self.assertEqual(apply_delta("", make_delta("", "new\n")), "new\n")
+
+
+class PromptSnapshotStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute(
+            """
+            CREATE TABLE snapshots (
+                prompt_hash TEXT PRIMARY KEY, prompt TEXT, created TIMESTAMP,
+                base_hash TEXT, delta BLOB, depth INT DEFAULT 0
+            )
+            """
+        )
+        self.conn.execute("CREATE TABLE messages (system_prompt_hash TEXT)")
+        self.store = PromptSnapshotStore("snapshots", max_chain=3)
+
+    def add(self, text):
+        hash_ = prompt_hash(text)
+        self.store.store(self.conn.cursor(), {hash_: text})
+        self.conn.execute("INSERT INTO messages VALUES (?)", (hash_,))
+        return hash_
+
+    def test_similar_prompts_are_stored_as_bounded_delta_chains(self):
+        hashes = [self.add(prompt(turn)) for turn in range(6)]
+        rows = self.conn.execute(
+            "SELECT prompt IS NULL, depth, length(COALESCE(prompt, delta)) FROM snapshots ORDER BY rowid"
+        ).fetchall()
+        self.assertEqual([row[1] for row in rows], [0, 1, 2, 3, 0, 1])
+        self.assertEqual([row[0] for row in rows], [0, 1, 1, 1, 0, 1])
+        # A delta is a small fraction of the prompt it stands for
+        self.assertLess(rows[1][2] * 20, len(prompt(1)))
+        cur = self.conn.cursor()
+        for turn, hash_ in enumerate(hashes):
+            self.assertEqual(self.store.read(cur, hash_), prompt(turn))
+        self.assertIsNone(self.store.read(cur, "missing"))
+
+    def test_known_prompts_skip_the_insert(self):
+        self.add(prompt(1))
+        cur = MagicMock()
+        self.assertEqual(self.store.store(cur, {prompt_hash(prompt(1)): prompt(1)}), 0)
+        cur.execute.assert_not_called()
+        # Stored by an earlier run, the insert is ignored and no delta is based on it
+        store = PromptSnapshotStore("snapshots")
+        self.assertEqual(
+            store.store(self.conn.cursor(), {prompt_hash(prompt(1)): prompt(1)}), 0
+        )
+        store.store(self.conn.cursor(), {prompt_hash(prompt(2)): prompt(2)})
+        self.assertEqual(
+            self.conn.execute(
+                "SELECT depth FROM snapshots WHERE prompt_hash = ?",
+                (prompt_hash(prompt(2)),),
+            ).fetchone(),
+            (0,),
+        )
+
+    def test_garbage_collection_keeps_the_bases_of_referenced_snapshots(self):
+        first, second, third = (self.add(prompt(turn)) for turn in range(3))
+        self.conn.execute(
+            "DELETE FROM messages WHERE system_prompt_hash IN (?, ?)", (first, second)
+        )
+        cur = self.conn.cursor()
+        self.assertEqual(self.store.collect_garbage(cur, "messages"), 0)
+        self.assertEqual(self.store.read(cur, third), prompt(2))
+        self.conn.execute("DELETE FROM messages")
+        self.assertEqual(self.store.collect_garbage(cur, "messages"), 3)
+        # The next snapshot is not based on one that was collected
+        fourth = self.add(prompt(3))
+        self.assertEqual(self.store.read(cur, fourth), prompt(3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from memory.memory_manager import prompt_hash
+from memory.retention import (
+    RetentionPolicy,
+    RetentionWorker,
+    enable_incremental_vacuum,
+    read_segment,
+)
+from memory_fixtures import sqlite_memory_manager, word_tokenizer
+
+
+class RetentionWorkerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.conn, self.memory_manager = sqlite_memory_manager()
+        self.memory_manager.tokenizer = word_tokenizer()
+
+    def tearDown(self):
+        self.memory_manager.close()
+        self.conn.close()
+        self.tmp.cleanup()
+
+    def add_turns(self, turns):
+        self.conn.executemany(
+            """
+            INSERT INTO default_memory
+            (interaction_index, role, content, content_tokens, project_directory, system_prompt_hash, token_model)
+            VALUES (?, 'user', ?, 1, 'project', ?, 'words')
+            """,
+            turns,
+        )
+        self.conn.commit()
+
+    def stored(self):
+        return [
+            row[0]
+            for row in self.conn.execute(
+                "SELECT content FROM default_memory ORDER BY interaction_index"
+            )
+        ]
+
+    def worker(self, policy, **kwargs):
+        return RetentionWorker(
+            self.memory_manager,
+            policy,
+            os.path.join(self.tmp.name, "archive"),
+            **kwargs,
+        )
+
+    def test_system_prompts_are_stored_once(self):
+        self.memory_manager.add_message("user", "one", system_prompt="be helpful")
+        self.memory_manager.add_message("assistant", "two", system_prompt="be helpful")
+        rows = self.conn.execute(
+            "SELECT system_prompt, system_prompt_hash FROM default_memory"
+        ).fetchall()
+        self.assertEqual(rows, [(None, prompt_hash("be helpful"))] * 2)
+        self.assertEqual(
+            self.memory_manager.get_system_prompt(prompt_hash("be helpful")),
+            "be helpful",
+        )
+        self.assertEqual(
+            self.conn.execute(
+                "SELECT COUNT(*) FROM default_memory_prompt_snapshots"
+            ).fetchone()[0],
+            1,
+        )
+
+    def test_copied_system_prompts_are_moved_to_snapshots(self):
+        self.conn.executemany(
+            "INSERT INTO default_memory (interaction_index, content, system_prompt) VALUES (?, ?, ?)",
+            [("1", "a", "old prompt"), ("2", "b", "old prompt"), ("3", "c", None)],
+        )
+        self.memory_manager._move_system_prompts(self.conn.cursor())
+        rows = self.conn.execute(
+            "SELECT system_prompt, system_prompt_hash FROM default_memory ORDER BY interaction_index"
+        ).fetchall()
+        self.assertEqual(rows, [(None, prompt_hash("old prompt"))] * 2 + [(None, None)])
+        self.assertEqual(
+            self.memory_manager.get_system_prompt(prompt_hash("old prompt")),
+            "old prompt",
+        )
+
+    def test_old_messages_are_archived_with_their_snapshots(self):
+        old = (datetime.now() - timedelta(days=10)).isoformat()
+        new = datetime.now().isoformat()
+        self.conn.executemany(
+            "INSERT INTO default_memory_prompt_snapshots (prompt_hash, prompt) VALUES (?, ?)",
+            [("old", "old prompt"), ("kept", "kept prompt")],
+        )
+        self.add_turns(
+            [(old + "1", "a", "old"), (old + "2", "b", "kept"), (new, "c", "kept")]
+        )
+        worker = self.worker(RetentionPolicy(max_age_days=7))
+        self.assertEqual(worker.run_once(), 2)
+        self.assertEqual(self.stored(), ["c"])
+        snapshots = self.conn.execute(
+            "SELECT prompt_hash FROM default_memory_prompt_snapshots"
+        ).fetchall()
+        self.assertEqual(snapshots, [("kept",)])
+        (segment,) = os.listdir(os.path.join(self.tmp.name, "archive"))
+        self.assertTrue(segment.endswith(".jsonl.zlib"))
+        records = read_segment(os.path.join(self.tmp.name, "archive", segment))
+        self.assertEqual(
+            [record["type"] for record in records],
+            ["prompt_snapshot", "prompt_snapshot", "message", "message"],
+        )
+        self.assertEqual(
+            {record["prompt"] for record in records[:2]}, {"old prompt", "kept prompt"}
+        )
+        self.assertEqual([record["content"] for record in records[2:]], ["a", "b"])
+        self.assertEqual(worker.run_once(), 0)
+
+    def test_oldest_messages_are_archived_down_to_the_size_budget(self):
+        self.add_turns(
+            [(f"2024-03-01T09:00:{second:02d}", "x" * 10, None) for second in range(10)]
+        )
+        worker = self.worker(RetentionPolicy(max_bytes=35), codec=None, batch_size=4)
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        self.assertEqual(worker.run_once(), 7)
+        self.conn.set_trace_callback(None)
+        self.assertEqual(len(self.stored()), 3)
+        segments = sorted(os.listdir(os.path.join(self.tmp.name, "archive")))
+        self.assertEqual(len(segments), 2)
+        self.assertTrue(segments[0].startswith("default_memory-2024-03-01T090000-"))
+        # The table is summed once per run, batches only read the rows added since
+        sums = [statement for statement in statements if "SUM(" in statement]
+        self.assertEqual(len(sums), 3)
+        self.assertEqual(len([s for s in sums if "WHERE" not in s]), 1)
+        # Only switched to incremental vacuum by the startup step
+        self.assertEqual(self.conn.execute("PRAGMA auto_vacuum").fetchone()[0], 0)
+        self.assertTrue(enable_incremental_vacuum(self.conn))
+        self.assertFalse(enable_incremental_vacuum(self.conn))
+        self.assertEqual(self.conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+
+    def test_new_messages_count_towards_the_size_budget(self):
+        self.add_turns([("2024-03-01T09:00:00", "x" * 10, None)])
+        worker = self.worker(RetentionPolicy(max_bytes=15), codec=None)
+        self.assertEqual(worker.run_once(), 0)
+        self.add_turns([("2024-03-01T09:00:01", "x" * 10, None)])
+        self.assertEqual(len(worker.archive_batch()), 1)
+        self.assertEqual(worker.archive_batch(), [])
+
+    def test_archived_messages_leave_the_cached_window(self):
+        self.memory_manager.add_message("user", "first")
+        self.memory_manager.add_message("assistant", "second")
+        self.memory_manager.add_message("user", "third")
+        self.assertEqual(len(self.memory_manager.get_messages()), 4)
+        self.worker(RetentionPolicy(max_bytes=5)).run_once()
+        messages = self.memory_manager.get_messages()
+        self.assertEqual([message["content"] for message in messages[1:]], ["third"])
+
+
+if __name__ == "__main__":
+    unittest.main()
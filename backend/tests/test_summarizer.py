@@ -0,0 +1,88 @@
+import time
+import unittest
+from unittest.mock import MagicMock
+from memory.summarizer import (
+    OMISSION_MARKER,
+    SummarizationWorker,
+    TruncatingSummarizer,
+)
+from memory_fixtures import sqlite_memory_manager, word_tokenizer
+
+
+class TruncatingSummarizerTests(unittest.TestCase):
+    def test_long_text_keeps_head_and_tail_within_budget(self):
+        tokenizer = word_tokenizer()
+        summarizer = TruncatingSummarizer(max_tokens=10, tokenizer=tokenizer)
+        text = " ".join(f"w{i}" for i in range(100))
+        summary = summarizer.summarize(text)
+        self.assertIn(OMISSION_MARKER, summary)
+        self.assertTrue(summary.startswith("w0 "))
+        self.assertTrue(summary.endswith(" w99"))
+        self.assertLessEqual(tokenizer.count(summary), 10)
+        self.assertEqual(summarizer.summarize("short text"), "short text")
+
+
+class SummarizationWorkerTests(unittest.TestCase):
+    def setUp(self):
+        self.conn, self.memory_manager = sqlite_memory_manager()
+        self.memory_manager.tokenizer = word_tokenizer()
+        self.long_message = " ".join(f"w{i}" for i in range(50))
+
+    def tearDown(self):
+        self.memory_manager.close()
+        self.conn.close()
+
+    def summaries(self):
+        return self.conn.execute(
+            "SELECT content, summarized_message, summarized_message_tokens FROM default_memory ORDER BY interaction_index"
+        ).fetchall()
+
+    def test_long_messages_are_summarized_in_one_batch(self):
+        self.memory_manager.add_message("user", "short question")
+        self.memory_manager.add_message("assistant", self.long_message)
+        self.assertEqual(
+            self.memory_manager.get_messages()[2]["content"], self.long_message
+        )
+        worker = SummarizationWorker(
+            self.memory_manager,
+            TruncatingSummarizer(10, self.memory_manager.tokenizer),
+            threshold_tokens=20,
+        )
+        self.assertEqual(worker.run_once(), 1)
+        self.assertEqual(worker.run_once(), 0)
+        (_, short_summary, _), (_, summary, tokens) = self.summaries()
+        self.assertIsNone(short_summary)
+        self.assertIn(OMISSION_MARKER, summary)
+        self.assertLessEqual(tokens, 10)
+        # The cached window follows the summaries
+        messages = self.memory_manager.get_messages()
+        self.assertEqual(messages[2]["content"], summary)
+        self.assertEqual(messages[2]["full_content"], self.long_message)
+
+    def test_failing_summaries_are_skipped(self):
+        self.memory_manager.add_message("user", self.long_message)
+        summarizer = MagicMock()
+        summarizer.summarize.side_effect = RuntimeError("unavailable")
+        worker = SummarizationWorker(
+            self.memory_manager, summarizer, threshold_tokens=20
+        )
+        self.assertEqual(worker.run_once(), 0)
+        self.assertEqual(worker.run_once(), 0)
+        summarizer.summarize.assert_called_once()
+        self.assertIsNone(self.summaries()[0][1])
+
+    def test_background_worker_picks_up_new_messages(self):
+        self.memory_manager.start_summarizer(
+            TruncatingSummarizer(10, self.memory_manager.tokenizer),
+            threshold_tokens=20,
+            interval_ms=60000,
+        )
+        self.memory_manager.add_message("user", self.long_message)
+        deadline = time.monotonic() + 5
+        while self.summaries()[0][1] is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIn(OMISSION_MARKER, self.summaries()[0][1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+from unittest.mock import MagicMock
+from database.tokenizer import (
+    ApproximateTokenizer,
+    Tokenizer,
+    get_encoding,
+    get_tokenizer,
+)
+
+
+def word_encoding():
+    encoding = MagicMock()
+    encoding.encode.side_effect = lambda text: text.split()
+    encoding.encode_batch.side_effect = lambda texts: [text.split() for text in texts]
+    return encoding
+
+
+class TokenizerTests(unittest.TestCase):
+    def setUp(self):
+        self.encoding = word_encoding()
+        self.tokenizer = Tokenizer(self.encoding, cache_size=2)
+
+    def test_counts_are_cached_by_content(self):
+        self.assertEqual(self.tokenizer.count("a b c"), 3)
+        self.assertEqual(self.tokenizer.count("a b c"), 3)
+        self.encoding.encode.assert_called_once_with("a b c")
+        self.assertEqual((self.tokenizer.hits, self.tokenizer.misses), (1, 1))
+
+    def test_caller_key_replaces_the_hash(self):
+        self.assertEqual(self.tokenizer.count("a b", key="h1"), 2)
+        self.assertEqual(self.tokenizer.count("ignored", key="h1"), 2)
+        self.assertEqual(self.encoding.encode.call_count, 1)
+
+    def test_least_recently_used_count_is_evicted(self):
+        self.tokenizer.count("a")
+        self.tokenizer.count("b")
+        self.tokenizer.count("a")
+        self.tokenizer.count("c")
+        self.encoding.encode.reset_mock()
+        self.tokenizer.count("a")
+        self.encoding.encode.assert_not_called()
+        self.tokenizer.count("b")
+        self.encoding.encode.assert_called_once_with("b")
+
+    def test_count_many_encodes_misses_in_one_batch(self):
+        self.tokenizer.count("a b")
+        counts = self.tokenizer.count_many(["a b", "c", "d e f"])
+        self.assertEqual(counts, [2, 1, 3])
+        self.encoding.encode_batch.assert_called_once_with(["c", "d e f"])
+
+    def test_tokenizers_are_shared_per_model(self):
+        self.assertIs(get_tokenizer("gpt-3.5-turbo"), get_tokenizer("gpt-3.5-turbo"))
+        self.assertIs(
+            get_tokenizer("gpt-3.5-turbo").encoding, get_encoding("gpt-3.5-turbo")
+        )
+
+    def test_approximate_counts_are_scaled_up(self):
+        tokenizer = ApproximateTokenizer(self.encoding, 1.2, name="approx")
+        self.assertEqual(tokenizer.count("a b c d e"), 6)
+        self.assertEqual(tokenizer.count_many(["a", "a b c d e f"]), [2, 8])
+        self.assertEqual(tokenizer.name, "approx")
+
+    def test_tokenizer_follows_the_model(self):
+        anthropic = get_tokenizer("anthropic")
+        self.assertIsInstance(anthropic, ApproximateTokenizer)
+        self.assertIs(get_tokenizer("claude-3-opus-20240229"), anthropic)
+        self.assertNotIsInstance(get_tokenizer("gpt-4-turbo"), ApproximateTokenizer)
+        self.assertNotEqual(anthropic.name, get_tokenizer("gpt-4-turbo").name)
+        self.assertIs(get_tokenizer(None), get_tokenizer("gpt-3.5-turbo"))
+
+
+if __name__ == "__main__":
+    unittest.main()